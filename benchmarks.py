@@ -0,0 +1,285 @@
+"""
+Micro benchmarks for pynch. Nothing in here talks to a database, so the
+numbers only reflect the cost of pynch itself.
+
+    python benchmarks.py
+"""
+import importlib
+import inspect
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+
+def timed(fn, repeat=5):
+    """
+    Returns the best wall clock time, in seconds, of `repeat` calls to `fn`
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def models_source(n_models, n_fields):
+    lines = ['from pynch.db import DB',
+             'from pynch.model import Model',
+             'from pynch.fields import *', '']
+    for i in range(n_models):
+        lines.append('class Model%d(Model):' % i)
+        lines.append("    _meta = {'database': DB()}")
+        for j in range(n_fields):
+            lines.append('    field%d = StringField()' % j)
+        if i:
+            lines.append("    parent = ReferenceField('Model%d')" % (i - 1))
+        lines.append('')
+    return '\n'.join(lines)
+
+
+def stack_lookup(init):
+    # what `Field.__new__` did before models were registered: find the
+    # module the field is declared in by walking the whole stack (done
+    # from `__init__` here, which unlike `__new__` can be put back)
+    def walking_init(field, *args, **kwargs):
+        frame = inspect.stack()[-1][0]
+        field._context = frame.f_locals.get('__name__', '')
+        del frame
+        init(field, *args, **kwargs)
+    return walking_init
+
+
+def bench_import(registry, n_models=300, n_fields=8, depth=50):
+    """
+    Time taken to import a module declaring `n_models` models, each with
+    `n_fields` fields, from `depth` frames down the stack (test runners and
+    app servers rarely import models from the top of the stack), either
+    with the model registry or with every field walking the stack
+    """
+    from pynch.fields import Field
+
+    init = Field.__init__
+    directory = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(directory, 'bench_models.py'), 'w') as f:
+            f.write(models_source(n_models, n_fields))
+        sys.path.insert(0, directory)
+
+        def nested(n):
+            if n:
+                return nested(n - 1)
+            sys.modules.pop('bench_models', None)
+            importlib.import_module('bench_models')
+
+        if registry:
+            return timed(lambda: nested(depth))
+        # walking the stack is slow enough that once will do
+        Field.__init__ = stack_lookup(init)
+        return timed(lambda: nested(depth), repeat=1)
+    finally:
+        Field.__init__ = init
+        sys.path.remove(directory)
+        sys.modules.pop('bench_models', None)
+        shutil.rmtree(directory)
+
+
+def allocated(fn):
+    """
+    Returns the memory, in MB, held on to by whatever `fn` returns
+    """
+    tracemalloc.start()
+    try:
+        kept = fn()
+        size, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del kept
+    return size / 1024.0 / 1024.0
+
+
+def flat_model(n_fields, compact=False):
+    from pynch.db import DB
+    from pynch.model import Model
+    from pynch.fields import StringField, IntegerField, FloatField
+
+    attrs = {'_meta': {'database': DB(), 'compact': compact}}
+    for i in range(n_fields):
+        field = (StringField, IntegerField, FloatField)[i % 3]
+        attrs['field%d' % i] = field(db_field='f%d' % i)
+    model = type(Model)('BenchFlat', (Model,), attrs)
+    mongo = dict(('f%d' % i, ('x', 1, 1.0)[i % 3]) for i in range(n_fields))
+    return model, mongo
+
+
+def loop_decode(model, mongo):
+    # what `Model.to_python` did before converters were generated
+    python_fields = {}
+    for field in model.pynch.fields:
+        fieldname = field.db_field or field.name
+        mongo_value = mongo[fieldname] if \
+                    fieldname in mongo else field.default
+        python_fields[field.name] = field.to_python(mongo_value)
+    return python_fields
+
+
+def loop_load(model, mongo):
+    # what `Model._from_mongo` does without the generated loader
+    document = model.__new__(model)
+    for name, value in loop_decode(model, mongo).items():
+        if value is not None:
+            model.pynch.fields_by_name[name].fill(document, value)
+    return document
+
+
+def loop_encode(document):
+    # what `Model.to_mongo` did before converters were generated
+    return dict((field.db_field or field.name,
+                 field.to_mongo(getattr(document, field.name, None)))
+                                for field in document.pynch.fields)
+
+
+def bench_decode(generated, n_docs=10000, n_fields=20):
+    """
+    Time taken to decode `n_docs` flat documents into blank documents,
+    either with the generated loader or by looping over the fields
+    """
+    model, mongo = flat_model(n_fields)
+    load, new = model.pynch.codec.load, model.__new__
+
+    def generated_load():
+        document = new(model)
+        load(document, mongo)
+        return document
+    if generated:
+        return timed(lambda: [generated_load() for _ in range(n_docs)])
+    return timed(lambda: [loop_load(model, mongo) for _ in range(n_docs)])
+
+
+def bench_encode(generated, n_docs=10000, n_fields=20):
+    """
+    Time taken to encode `n_docs` flat documents, either with the
+    generated encoder or by looping over the fields
+    """
+    model, mongo = flat_model(n_fields)
+    document = model.to_python(mongo)
+    encode = model.pynch.codec.to_mongo
+    if generated:
+        return timed(lambda: [encode(document) for _ in range(n_docs)])
+    return timed(lambda: [loop_encode(document) for _ in range(n_docs)])
+
+
+def construct(model, mongo):
+    # what `Model.to_python` did before trusting what it loads
+    document = model(**loop_decode(model, mongo))
+    document._changes.clear()
+    document._persisted = True
+    return document
+
+
+def bench_hydrate(trusted, n_docs=10000, n_fields=20):
+    """
+    Time taken to build `n_docs` flat documents from mongo, either with
+    `Model._from_mongo` or by way of the (validating) constructor
+    """
+    model, mongo = flat_model(n_fields)
+    if trusted:
+        return timed(lambda: [model._from_mongo(mongo) for _ in range(n_docs)])
+    return timed(lambda: [construct(model, mongo) for _ in range(n_docs)])
+
+
+def bench_memory(compact, n_docs=100000, n_fields=5):
+    """
+    Memory taken up by `n_docs` small documents, loaded into either
+    regular or compact models
+    """
+    model, mongo = flat_model(n_fields, compact)
+    return allocated(lambda: [model._from_mongo(mongo) for _ in range(n_docs)])
+
+
+def bench_lookup(indexed, n_docs=10000, n_queries=100, n_fields=5):
+    """
+    Time taken by `n_queries` equality queries against `n_docs` documents
+    of the in memory store, with or without an index on the queried field
+    """
+    model, mongo = flat_model(n_fields)
+    collection = model.pynch.collection
+    collection.drop_indexes()
+    collection.delete_many({})
+    collection.insert_many([dict(mongo, f1=i) for i in range(n_docs)])
+    if indexed:
+        collection.create_index('f1')
+    return timed(lambda: [collection.find_one({'f1': i})
+                                        for i in range(n_queries)])
+
+
+def bench_columns(columnar, n_docs=10000, n_fields=6):
+    """
+    Time taken to load `n_docs` documents of the in memory store into
+    numpy arrays, either as columns or by way of documents
+    """
+    import numpy
+    model, mongo = flat_model(n_fields)
+    collection = model.pynch.collection
+    collection.delete_many({})
+    collection.insert_many([dict(mongo) for _ in range(n_docs)])
+    names = [field.name for field in model.pynch.fields if field.name != '_id']
+    if columnar:
+        return timed(lambda: model.pynch.objects.to_columns(fields=names))
+
+    def arrays():
+        documents = list(model.pynch.objects)
+        return dict((name, numpy.array([getattr(document, name, None)
+                                        for document in documents]))
+                                                    for name in names)
+    return timed(arrays)
+
+
+BENCHMARKS = [
+    ('import 300 models x 8 fields, stack',
+        lambda: bench_import(registry=False)),
+    ('import 300 models x 8 fields, registry',
+        lambda: bench_import(registry=True)),
+    ('decode 10000 docs x 20 fields, loop',
+        lambda: bench_decode(generated=False)),
+    ('decode 10000 docs x 20 fields, codec',
+        lambda: bench_decode(generated=True)),
+    ('encode 10000 docs x 20 fields, loop',
+        lambda: bench_encode(generated=False)),
+    ('encode 10000 docs x 20 fields, codec',
+        lambda: bench_encode(generated=True)),
+    ('hydrate 10000 docs x 20 fields, __init__',
+        lambda: bench_hydrate(trusted=False)),
+    ('hydrate 10000 docs x 20 fields, _from_mongo',
+        lambda: bench_hydrate(trusted=True)),
+    ('memory 100000 docs x 5 fields, regular',
+        lambda: bench_memory(compact=False), 'MB'),
+    ('memory 100000 docs x 5 fields, compact',
+        lambda: bench_memory(compact=True), 'MB'),
+    ('lookup 100 x 10000 docs in memory, scan',
+        lambda: bench_lookup(indexed=False)),
+    ('lookup 100 x 10000 docs in memory, index',
+        lambda: bench_lookup(indexed=True)),
+]
+
+
+try:
+    import numpy
+except ImportError:
+    pass
+else:
+    BENCHMARKS.extend([
+        ('columns 10000 docs x 6 fields, documents',
+            lambda: bench_columns(columnar=False)),
+        ('columns 10000 docs x 6 fields, to_columns',
+            lambda: bench_columns(columnar=True)),
+    ])
+
+
+if __name__ == '__main__':
+    for name, bench, *unit in BENCHMARKS:
+        print('%-44s %10.4f%s' % (name, bench(), unit[0] if unit else 's'))
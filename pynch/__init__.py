@@ -0,0 +1,4 @@
+from pynch.indexes import ensure_indexes
+from pynch.lookups import Q
+from pynch.aggregation import (Sum, Avg, Min, Max, Push, AddToSet, First,
+                               Last, Count)
@@ -0,0 +1,259 @@
+"""
+Aggregation pipelines built against a model's fields. Like query sets,
+aggregations are immutable: each chained call returns a new one, and
+nothing runs until the aggregation is iterated.
+
+    from pynch import Count, Sum
+
+    # acres per gardener, largest first
+    Garden.pynch.aggregate() \
+        .match(acres__gt=0) \
+        .group('gardener', acres=Sum('acres'), gardens=Count()) \
+        .sort('-acres')
+
+Field names (and `$field` references within expressions) are translated
+to their `db_field` for as long as the documents flowing through the
+pipeline are the model's, that is until a `$group` or a `$project`
+computing new fields reshapes them. Past that point names are taken as
+they are. Results are plain dictionaries, unless `hydrate` is called.
+Pipelines run with `allowDiskUse`, so that large groups can spill to
+disk, and their results are streamed from the cursor.
+"""
+import copy
+from pynch.errors import QueryException
+from pynch.fields import ReferenceField
+from pynch.lookups import Q, compile_query, element, resolve
+
+
+class Accumulator(object):
+    """
+    A `$group` accumulator over a field, given by name, or over an
+    expression
+    """
+    operator = None
+
+    def __init__(self, expression):
+        self.expression = expression
+
+    def to_mongo(self, aggregation):
+        expression = self.expression
+        if isinstance(expression, str) and not expression.startswith('$'):
+            # a field name, already translated
+            return {self.operator: '$' + aggregation._path(expression)}
+        return {self.operator: aggregation._expression(expression)}
+
+
+class Sum(Accumulator):
+    operator = '$sum'
+
+
+class Avg(Accumulator):
+    operator = '$avg'
+
+
+class Min(Accumulator):
+    operator = '$min'
+
+
+class Max(Accumulator):
+    operator = '$max'
+
+
+class Push(Accumulator):
+    operator = '$push'
+
+
+class AddToSet(Accumulator):
+    operator = '$addToSet'
+
+
+class First(Accumulator):
+    operator = '$first'
+
+
+class Last(Accumulator):
+    operator = '$last'
+
+
+class Count(Sum):
+    def __init__(self):
+        super(Count, self).__init__(1)
+
+
+def join(model, reference, path, into, many=False):
+    """
+    The stages joining the documents of `reference` pointed to by the
+    dbref (or list of dbrefs, when `many`) at `path` in the documents of
+    `model`, as a list under `into`
+    """
+    # `$lookup` only reaches collections of the same database
+    if reference._meta['database'] != model._meta['database']:
+        raise QueryException('Cannot join %s to %s, they are stored in '
+                             'different databases (%s)'
+                             % (reference.__name__, model.__name__, path))
+    # dbrefs keep their id under `$id`, which field paths can't name,
+    # hence the detour
+    def dbref_id(dbref):
+        return {'$arrayElemAt': [{'$objectToArray': dbref}, 1]}
+    ids = {'$map': {'input': '$' + path, 'in': dbref_id('$$this')}} \
+                if many else dbref_id('$' + path)
+    return [{'$addFields': {into: ids}},
+            {'$lookup': {'from': reference.pynch.collection.name,
+                         'localField': into + '.v',
+                         'foreignField': '_id',
+                         'as': into}}]
+
+
+class Aggregation(object):
+    def __init__(self, model):
+        self.model = model
+        # the model of the documents flowing through the pipeline, None
+        # once they've been reshaped
+        self._shape = model
+        self._stages = ()
+        self._hydrate = None
+        self._batch_size = 0
+
+    def _clone(self, stages=(), **changes):
+        clone = copy.copy(self)
+        clone.__dict__.update(changes)
+        clone._stages = self._stages + tuple(stages)
+        return clone
+
+    def _path(self, fieldname):
+        if self._shape is None:
+            return fieldname.replace('__', '.')
+        path, _, _ = resolve(self._shape, fieldname)
+        # references are grouped, sorted, etc by dbref rather than by id
+        return path[:-len('.$id')] if path.endswith('.$id') else path
+
+    def _expression(self, expression):
+        if isinstance(expression, str) and expression.startswith('$') \
+                and not expression.startswith('$$'):
+            return '$' + self._path(expression[1:])
+        if isinstance(expression, list):
+            return [self._expression(x) for x in expression]
+        if isinstance(expression, dict):
+            return dict((k, self._expression(v))
+                                for k, v in expression.items())
+        return expression
+
+    def match(self, *queries, **lookups):
+        """
+        Filters documents by `Q` objects and lookups, see `pynch.lookups`
+        """
+        query = compile_query(self._shape, Q(*queries, **lookups))
+        return self._clone([{'$match': query}])
+
+    def group(self, by=None, **accumulators):
+        """
+        Groups documents by a field (a list of fields, or everything when
+        `by` is None), computing each of the `accumulators` per group
+
+            .group(['gardener', 'acres'], flowers=Push('name'))
+        """
+        if by is None:
+            key = None
+        elif isinstance(by, (list, tuple)):
+            key = dict((fieldname.replace('__', '_'),
+                        '$' + self._path(fieldname)) for fieldname in by)
+        else:
+            key = '$' + self._path(by)
+        group = {'_id': key}
+        for name, accumulator in accumulators.items():
+            group[name] = accumulator.to_mongo(self)
+        return self._clone([{'$group': group}], _shape=None)
+
+    def project(self, *fieldnames, **expressions):
+        """
+        Keeps the named fields, and adds fields computed from expressions
+        in which `$field` refers to a field of the documents
+        """
+        projection = dict((self._path(fieldname), 1)
+                                    for fieldname in fieldnames)
+        for name, expression in expressions.items():
+            projection[name] = self._expression(expression)
+        shape = self._shape if not expressions else None
+        return self._clone([{'$project': projection}], _shape=shape)
+
+    def sort(self, *fieldnames):
+        """
+        Sorts documents, field names prefixed with a `-` sort in
+        descending order
+        """
+        ordering = {}
+        for fieldname in fieldnames:
+            direction = 1
+            if fieldname.startswith('-'):
+                fieldname, direction = fieldname[1:], -1
+            ordering[self._path(fieldname)] = direction
+        return self._clone([{'$sort': ordering}])
+
+    def lookup(self, fieldname, into=None):
+        """
+        Joins the documents referenced by a reference field (or a list
+        of them) as a list under `into`, by default in place of the
+        references themselves
+        """
+        if self._shape is None:
+            raise QueryException('Can only look up the references of %s '
+                                 'before its documents are reshaped'
+                                 % self.model.__name__)
+        field = self._shape.pynch.fields_by_name.get(fieldname)
+        reference = element(field) if field is not None else None
+        if not isinstance(reference, ReferenceField):
+            raise QueryException('%s is not a reference' % fieldname)
+
+        path = self._path(fieldname)
+        into = into or path
+        stages = join(self.model, reference.reference, path, into,
+                      many=reference is not field)
+        # the references the model expects are gone
+        shape = self._shape if into not in \
+                    self._shape.pynch.fields_by_db_field else None
+        return self._clone(stages, _shape=shape)
+
+    def unwind(self, fieldname, preserve=False):
+        """
+        Outputs a document per element of a list, documents where the
+        list is empty or missing are left out unless `preserve` is set
+        """
+        path = '$' + self._path(fieldname)
+        stage = {'path': path, 'preserveNullAndEmptyArrays': True} \
+                    if preserve else path
+        return self._clone([{'$unwind': stage}])
+
+    def skip(self, n):
+        return self._clone([{'$skip': n}])
+
+    def limit(self, n):
+        return self._clone([{'$limit': n}])
+
+    def stage(self, stage):
+        """
+        Adds a stage as is, the documents it outputs are taken to be
+        reshaped
+        """
+        return self._clone([stage], _shape=None)
+
+    def hydrate(self, model=None):
+        """
+        Builds documents of `model` (by default the aggregated model) out
+        of the results rather than returning them as dictionaries
+        """
+        return self._clone(_hydrate=model or self.model)
+
+    def batch_size(self, n):
+        return self._clone(_batch_size=n)
+
+    def pipeline(self):
+        return list(self._stages)
+
+    def __iter__(self):
+        kwargs = {'allowDiskUse': True}
+        if self._batch_size:
+            kwargs['batchSize'] = self._batch_size
+        cursor = self.model.pynch.collection.aggregate(self.pipeline(), **kwargs)
+        if self._hydrate is None:
+            return iter(cursor)
+        return map(self._hydrate.pynch._loader(), cursor)
@@ -0,0 +1,122 @@
+"""
+Asyncio support. Models share their fields and serialization with the
+synchronous api, only the collections differ: motor's when it's
+installed, otherwise (or for models kept in memory) the model's own
+collection driven from a thread pool.
+
+    garden = await Garden.pynch.aget(name='Eden')
+    async for flower in Flower.pynch.objects.filter(name='rose'):
+        ...
+    await garden.asave()
+"""
+import asyncio
+import functools
+import itertools
+from pynch.db import MockConnection
+
+try:
+    from motor.motor_asyncio import AsyncIOMotorClient
+except ImportError:
+    AsyncIOMotorClient = None
+
+
+def async_collection(model):
+    """
+    Returns the collection the model's documents are read from and
+    written to asynchronously
+    """
+    database = model._meta['database']
+    if AsyncIOMotorClient is None or database.factory() is MockConnection:
+        return ThreadedCollection(model.pynch.collection)
+    # motor clients are kept alongside pymongo's, see `ConnectionManager`
+    client = database.manager.client(database.host, database.port,
+                                     AsyncIOMotorClient)
+    return client[database.name][model.__name__]
+
+
+def run(function, *args, **kwargs):
+    """
+    Runs a blocking call in the event loop's default executor
+    """
+    loop = asyncio.get_running_loop()
+    return loop.run_in_executor(
+                None, functools.partial(function, *args, **kwargs))
+
+
+async def iterate(iterable):
+    """
+    Asynchronous iterator over an iterable at hand
+    """
+    for x in iterable:
+        yield x
+
+
+class ThreadedCollection(object):
+    """
+    Gives a synchronous collection the (subset of) motor's interface
+    pynch relies on, by running each call in a thread pool
+    """
+    def __init__(self, collection):
+        self.collection = collection
+
+    def find(self, *args, **kwargs):
+        return ThreadedCursor(self.collection, args, kwargs)
+
+    def find_one(self, *args, **kwargs):
+        return run(self.collection.find_one, *args, **kwargs)
+
+    def count_documents(self, *args, **kwargs):
+        return run(self.collection.count_documents, *args, **kwargs)
+
+    def bulk_write(self, *args, **kwargs):
+        return run(self.collection.bulk_write, *args, **kwargs)
+
+    def delete_one(self, *args, **kwargs):
+        return run(self.collection.delete_one, *args, **kwargs)
+
+    def with_options(self, **kwargs):
+        return ThreadedCollection(self.collection.with_options(**kwargs))
+
+
+class ThreadedCursor(object):
+    """
+    Asynchronous iterator over a synchronous cursor, fetching results
+    `batch_size` at a time
+    """
+    def __init__(self, collection, args, kwargs):
+        self.collection = collection
+        self.args = args
+        self.kwargs = kwargs
+        self.modifiers = []
+        self.size = 100
+
+    def sort(self, *args):
+        self.modifiers.append(('sort', args))
+        return self
+
+    def skip(self, n):
+        self.modifiers.append(('skip', (n,)))
+        return self
+
+    def limit(self, n):
+        self.modifiers.append(('limit', (n,)))
+        return self
+
+    def batch_size(self, n):
+        self.size = n
+        return self
+
+    def _open(self):
+        cursor = self.collection.find(*self.args, **self.kwargs)
+        for method, args in self.modifiers:
+            cursor = getattr(cursor, method)(*args)
+        return iter(cursor)
+
+    async def __aiter__(self):
+        cursor = await run(self._open)
+        while True:
+            batch = await run(list, itertools.islice(cursor, self.size))
+            if not batch:
+                return
+            for mongo in batch:
+                yield mongo
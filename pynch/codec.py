@@ -0,0 +1,128 @@
+"""
+Generates the functions converting documents of a given model to and
+from their mongo representation. Rather than looping over the model's
+fields, and dispatching to each field's converter, at runtime, the
+generated functions unroll the field list and have every converter
+bound directly (or inlined altogether, for fields which store their
+values as is).
+"""
+from pynch.fields import Field, SimpleField, ComplexField, StringField
+
+
+# converters which return the value they're given
+IDENTITIES = frozenset([SimpleField.to_python, SimpleField.to_save,
+                        StringField.to_python, StringField.to_save,
+                        ComplexField.to_save])
+
+
+def is_identity(field, method):
+    return getattr(type(field), method) in IDENTITIES
+
+
+def compile_function(model, name, lines, namespace):
+    source = '\n'.join(lines)
+    filename = '<pynch %s.%s>' % (model.__name__, name)
+    exec(compile(source, filename, 'exec'), namespace)
+    function = namespace[name]
+    function.__source__ = source
+    return function
+
+
+def compile_decoder(model, fields, method='to_python'):
+    """
+    Returns a function which, given a mongo document, returns the
+    python values of `fields` (by way of each field's `method`, ie
+    `to_plain` for `QuerySet.as_dicts`) keyed by field name. Documents
+    are loaded with `compile_loader` instead. Equivalent to
+
+        dict((field.name, getattr(field, method)(mongo.get(
+                field.db_field or field.name, field.default)))
+             for field in fields)
+    """
+    namespace = {}
+    lines = ['def decode(mongo):', '    get = mongo.get', '    return {']
+    for i, field in enumerate(fields):
+        namespace['default_%d' % i] = field.default
+        value = 'get(%r, default_%d)' % (field.db_field or field.name, i)
+        if not is_identity(field, method):
+            namespace['%s_%d' % (method, i)] = getattr(field, method)
+            value = '%s_%d(%s)' % (method, i, value)
+        lines.append('        %r: %s,' % (field.name, value))
+    lines.append('    }')
+    return compile_function(model, 'decode', lines, namespace)
+
+
+def compile_loader(model, fields):
+    """
+    Returns a function which fills a blank document with the python
+    values of `fields` decoded from a mongo document, by way of each
+    field's `fill`. As with the model's constructor, None values are
+    left out.
+    """
+    compact = model._meta['compact']
+    namespace = {}
+    lines = ['def load(document, mongo):', '    get = mongo.get']
+    if not compact:
+        lines.append('    values = document.__dict__')
+    for i, field in enumerate(fields):
+        namespace['default_%d' % i] = field.default
+        value = 'get(%r, default_%d)' % (field.db_field or field.name, i)
+        if not is_identity(field, 'to_python'):
+            namespace['to_python_%d' % i] = field.to_python
+            value = 'to_python_%d(%s)' % (i, value)
+        lines.append('    value = %s' % value)
+        lines.append('    if value is not None:')
+        plain = type(field).fill is Field.fill
+        if plain and field.slot is not None:
+            lines.append('        document._pynch_%s = value' % field.name)
+        elif plain and not compact:
+            lines.append('        values[%r] = value' % field.name)
+        else:
+            namespace['fill_%d' % i] = field.fill
+            lines.append('        fill_%d(document, value)' % i)
+    return compile_function(model, 'load', lines, namespace)
+
+
+def compile_encoder(model, fields, method='to_mongo'):
+    """
+    Returns a function which, given a document, returns its mongo
+    representation by way of each field's `method` (ie `to_mongo` or
+    `to_save`). Equivalent to
+
+        dict((field.db_field or field.name,
+              getattr(field, method)(getattr(document, field.name, None)))
+             for field in fields)
+    """
+    compact = model._meta['compact']
+    namespace = {'getattr': getattr}
+    lines = ['def encode(document):']
+    if not compact:
+        lines.append('    values = document.__dict__')
+    lines.append('    return {')
+    for i, field in enumerate(fields):
+        name = field.name
+        # plain fields read straight from the document's __dict__,
+        # anything else (defaults, primary keys, deferred fields, slots)
+        # goes through the descriptor
+        value = 'getattr(document, %r, None)' % name
+        if type(field).__get__ is Field.__get__ and not compact:
+            value = 'values[%r] if %r in values else %s' % (name, name, value)
+        if not is_identity(field, method):
+            namespace['%s_%d' % (method, i)] = getattr(field, method)
+            value = '%s_%d(%s)' % (method, i, value)
+        else:
+            value = '(%s)' % value
+        lines.append('        %r: %s,' % (field.db_field or name, value))
+    lines.append('    }')
+    return compile_function(model, 'encode', lines, namespace)
+
+
+class Codec(object):
+    """
+    The generated converters of a model, see `InformationDescriptor.codec`
+    """
+    def __init__(self, model, fields):
+        self.plain = compile_decoder(model, fields, 'to_plain')
+        self.load = compile_loader(model, fields)
+        self.to_mongo = compile_encoder(model, fields, 'to_mongo')
+        self.to_save = compile_encoder(model, fields, 'to_save')
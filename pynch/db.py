@@ -1,27 +1,691 @@
 from collections import namedtuple
+import itertools
+import os
+import re
+import threading
+import bson
+import pymongo
+from bson.objectid import ObjectId
+from pymongo import InsertOne, DeleteOne, DeleteMany, UpdateMany
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from pymongo.results import (InsertOneResult, InsertManyResult, UpdateResult,
+                             DeleteResult, BulkWriteResult)
+from pynch import memory
+from pynch.util import freeze
+
+
+def mongo_client(**options):
+    # sockets are only opened once the client is used
+    return pymongo.MongoClient(connect=False, **options)
+
+
+class ConnectionManager(object):
+    """
+    Holds one client per (host, port), created the first time it's
+    needed and kept until `close_all` is called, so that every model
+    pointing to the same server shares a single connection pool.
+
+    Options are passed on to pymongo's `MongoClient`, ie `maxPoolSize`,
+    `serverSelectionTimeoutMS`, `socketTimeoutMS` or `readPreference`,
+    and can be given for all servers or for a particular one:
+
+        connections.configure(maxPoolSize=50, readPreference='secondary')
+        connections.configure('reports.local', 27017, socketTimeoutMS=60000)
+
+    Clients are not shared across processes: a process forked after
+    clients were created (ie a pre-fork server's worker) starts afresh
+    rather than using its parent's sockets.
+
+    Clients are built by `factory`, which can be swapped for
+    `MockConnection` to keep every database in memory.
+    """
+    def __init__(self, factory=None, **options):
+        self.factory = factory or mongo_client
+        self.options = options
+        self.server_options = {}
+        self.clients = {}
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self._generation = 0
+
+    @property
+    def generation(self):
+        """
+        Bumped whenever clients are dropped, so that whatever was
+        obtained from them can be told apart from the current ones
+        """
+        self._check_pid()
+        return self._generation
+
+    def configure(self, host=None, port=None, **options):
+        """
+        Sets options for the clients to `host` and `port` (to every
+        server when `host` isn't given). Only clients created afterwards
+        are affected, see `close_all`.
+        """
+        if host is None:
+            self.options.update(options)
+        else:
+            self.server_options.setdefault((host, port), {}).update(options)
+
+    def client(self, host, port, factory=None):
+        """
+        Returns the client to `host` and `port`. Clients of another kind
+        (ie motor's) are built and kept separately by way of `factory`.
+        """
+        self._check_pid()
+        factory = factory or self.factory
+        key = (factory, host, port)
+        client = self.clients.get(key)
+        if client is None:
+            with self.lock:
+                client = self.clients.get(key)
+                if client is None:
+                    options = dict(self.options)
+                    options.update(self.server_options.get((host, port), {}))
+                    client = factory(host=host, port=port, **options)
+                    self.clients[key] = client
+        return client
+
+    def _check_pid(self):
+        if self.pid != os.getpid():
+            # the parent's clients (and its lock, which may have been
+            # held when forking) are unusable, but aren't ours to close
+            self.clients = {}
+            self.lock = threading.Lock()
+            self.pid = os.getpid()
+            self._generation += 1
+
+    def close_all(self):
+        """
+        Closes every client, new ones are created as needed
+        """
+        self._check_pid()
+        with self.lock:
+            clients, self.clients = self.clients, {}
+            self._generation += 1
+        for client in clients.values():
+            client.close()
+
+
+# used by every database, unless told otherwise
+connections = ConnectionManager()
 
 
 class DB(namedtuple('DB', 'name host port')):
+    """
+    Where a model's documents are stored. Databases get their clients
+    from `manager`, by default the module level connection manager.
+    Unnamed databases are always kept in memory, see `MockConnection`.
+    """
+    manager = connections
+
     def __new__(cls, *args, **kwargs):
+        manager = kwargs.pop('manager', None)
         if not args:
             args += (kwargs.pop('name', ''),)
             args += (kwargs.pop('host', 'localhost'),)
             args += (kwargs.pop('port', 27017),)
-        return super(DB, cls).__new__(cls, *args)
+        db = super(DB, cls).__new__(cls, *args)
+        if manager is not None:
+            db.manager = manager
+        return db
+
+    def factory(self):
+        if not self.name:
+            return MockConnection
+        return self.manager.factory
+
+    def client(self):
+        return self.manager.client(self.host, self.port, self.factory())
+
+    def database(self):
+        return self.client()[self.name]
 
 
 class MockConnection(object):
-    def __init__(self, host, port):
+    """
+    In memory stand-in for a `MongoClient`, holding its databases for as
+    long as it lives. Unnamed databases (`DB()`) are kept in one, as are
+    every database's when the connection manager is told to do so, ie
+    in tests:
+
+        connections.factory = MockConnection
+    """
+    def __init__(self, host='localhost', port=27017, **options):
+        self.host = host
+        self.port = port
+        self.databases = {}
+        self.lock = threading.Lock()
+
+    def __getitem__(self, name):
+        database = self.databases.get(name)
+        if database is None:
+            with self.lock:
+                database = self.databases.setdefault(
+                                        name, MockDatabase(self, name))
+        return database
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def get_database(self, name):
+        return self[name]
+
+    def list_database_names(self):
+        return list(self.databases)
+
+    def drop_database(self, name_or_database):
+        name = getattr(name_or_database, 'name', name_or_database)
+        self.databases.pop(name, None)
+
+    def close(self):
         pass
 
 
+class MockDatabase(object):
+    def __init__(self, connection, name=''):
+        self.client = connection
+        self.name = name
+        self.collections = {}
+        self.lock = threading.Lock()
+
+    def __getitem__(self, name):
+        collection = self.collections.get(name)
+        if collection is None:
+            with self.lock:
+                collection = self.collections.setdefault(
+                                        name, MockCollection(self, name))
+        return collection
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def get_collection(self, name, **options):
+        return self[name]
+
+    def list_collection_names(self):
+        return list(self.collections)
+
+    def drop_collection(self, name_or_collection):
+        name = getattr(name_or_collection, 'name', name_or_collection)
+        self.collections.pop(name, None)
+
+    def dereference(self, dbref):
+        database = self.client[dbref.database] if \
+                        dbref.database and dbref.database != self.name else self
+        return database[dbref.collection].find_one({'_id': dbref.id})
+
+
+class MockIndex(object):
+    """
+    Hash index over the values of one or more (dotted) fields. Arrays
+    are indexed both as a whole and by element, missing fields as null
+    unless the index is sparse.
+    """
+    def __init__(self, keys, name, unique=False, sparse=False,
+                 partialFilterExpression=None, **options):
+        self.keys = keys
+        self.name = name
+        self.unique = unique
+        self.sparse = sparse
+        self.partial = partialFilterExpression
+        self.options = options
+        # index key -> set of document keys
+        self.entries = {}
+
+    def index_keys(self, document):
+        if self.partial and not memory.match(document, self.partial):
+            return []
+        values, found = [], False
+        for fieldname, _ in self.keys:
+            at = memory.expand(memory.values_at(document, fieldname.split('.')))
+            found = found or bool(at)
+            values.append([freeze(value) for value in at] or [None])
+        if self.sparse and not found:
+            return []
+        return set(itertools.product(*values))
+
+    def add(self, key, document):
+        for index_key in self.index_keys(document):
+            self.entries.setdefault(index_key, set()).add(key)
+
+    def discard(self, key, document):
+        for index_key in self.index_keys(document):
+            keys = self.entries.get(index_key)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.entries[index_key]
+
+    def conflict(self, key, document):
+        """
+        Returns the index key `document` would duplicate, if any
+        """
+        if self.unique:
+            for index_key in self.index_keys(document):
+                if self.entries.get(index_key, set()) - set([key]):
+                    return index_key
+        return None
+
+    def lookup(self, values):
+        keys = set()
+        for value in values:
+            keys.update(self.entries.get((freeze(value),), ()))
+        return keys
+
+    def information(self):
+        info = {'key': list(self.keys), 'v': 2}
+        if self.unique:
+            info['unique'] = True
+        if self.sparse:
+            info['sparse'] = True
+        if self.partial:
+            info['partialFilterExpression'] = self.partial
+        info.update(self.options)
+        return info
+
+
+def normalize(document):
+    # what a round trip to the server does to a document, ie tuples
+    # become lists and datetimes lose their microseconds
+    return bson.decode(bson.encode(document))
+
+
+def equalities(condition):
+    """
+    The values an equality (or `$in`) condition can be looked up by in
+    an index, or None
+    """
+    if isinstance(condition, dict) and condition and \
+            all(key.startswith('$') for key in condition):
+        if list(condition) == ['$eq']:
+            values = [condition['$eq']]
+        elif list(condition) == ['$in']:
+            values = list(condition['$in'])
+        else:
+            return None
+    else:
+        values = [condition]
+    if any(isinstance(value, re.Pattern) for value in values):
+        return None
+    return values
+
+
 class MockCollection(object):
-    pass
+    """
+    In memory collection. Documents are kept keyed by `_id`, and queries
+    on `_id` (or on a field with a single field index which isn't sparse
+    or partial) only look at the documents they can match. Supports the
+    subset of pymongo's api pynch relies on, and like pymongo 4 none of
+    the legacy `save`, `insert`, `update`, `remove` and `count`.
+    """
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        self.full_name = '%s.%s' % (database.name, name)
+        self.documents = {}
+        self.indexes = {}
+        self.lock = threading.RLock()
 
+    def with_options(self, **options):
+        return self
 
-class MockDatabase(object):
-    def __init__(self, conn):
-        self.conn = conn
+    def _spec(self, spec):
+        if spec is None:
+            return {}
+        if not isinstance(spec, dict):
+            return {'_id': spec}
+        return spec
+
+    def _candidates(self, spec):
+        if '_id' in spec:
+            values = equalities(spec['_id'])
+            if values is not None:
+                found = (self.documents.get(freeze(v)) for v in values)
+                return [document for document in found if document is not None]
+        for index in self.indexes.values():
+            fieldname = index.keys[0][0]
+            if len(index.keys) == 1 and fieldname in spec and \
+                    not (index.sparse or index.partial):
+                values = equalities(spec[fieldname])
+                if values is not None:
+                    return [self.documents[key] for key in index.lookup(values)]
+        return list(self.documents.values())
+
+    def _matching(self, spec):
+        spec = self._spec(spec)
+        with self.lock:
+            candidates = self._candidates(spec)
+        return [document for document in candidates
+                            if memory.match(document, spec)]
+
+    def find(self, filter=None, projection=None, skip=0, limit=0, sort=None,
+             batch_size=0, no_cursor_timeout=False, **kwargs):
+        cursor = MockCursor(self, filter, projection)
+        if sort:
+            cursor.sort(sort)
+        return cursor.skip(skip).limit(limit)
+
+    def find_one(self, filter=None, projection=None, *args, **kwargs):
+        for document in self.find(filter, projection, *args, **kwargs).limit(1):
+            return document
+        return None
+
+    def count_documents(self, filter, skip=0, limit=0, **kwargs):
+        return len(list(self.find(filter, {'_id': 1}, skip=skip, limit=limit)))
+
+    def estimated_document_count(self, **kwargs):
+        return len(self.documents)
+
+    def distinct(self, key, filter=None, **kwargs):
+        values = []
+        for document in self._matching(filter):
+            for value in memory.expand(
+                    memory.values_at(document, key.split('.'))):
+                if not isinstance(value, list) and value not in values:
+                    values.append(memory.clone(value))
+        return values
+
+    def aggregate(self, pipeline, **kwargs):
+        """
+        Runs the (in memory) counterparts of the usual pipeline stages,
+        `$lookup` joining with collections of the same database
+        """
+        pipeline = list(pipeline)
+        # a leading `$match` is served by the indexes, as it would be
+        spec = pipeline.pop(0)['$match'] if \
+                    pipeline and '$match' in pipeline[0] else {}
+        documents = memory.aggregate(self._matching(spec), pipeline,
+                                     self.database.__getitem__)
+        return MockCommandCursor(documents)
+
+    # writes
+
+    def _check(self, key, document):
+        for index in self.indexes.values():
+            self._check_index(index, key, document)
+
+    def _store(self, key, document, previous=None):
+        for index in self.indexes.values():
+            if previous is not None:
+                index.discard(key, previous)
+            index.add(key, document)
+        self.documents[key] = document
+
+    def _insert(self, document):
+        if '_id' not in document:
+            # as pymongo does, the generated _id is set on the document
+            document['_id'] = ObjectId()
+        document = normalize(document)
+        key = freeze(document['_id'])
+        with self.lock:
+            if key in self.documents:
+                raise DuplicateKeyError(
+                    'E11000 duplicate key error collection: %s index: _id_ '
+                    'dup key: %r' % (self.full_name, document['_id']),
+                    11000, {'keyValue': {'_id': document['_id']}})
+            self._check(key, document)
+            self._store(key, document)
+        return document['_id']
+
+    def _replace(self, previous, document):
+        key = freeze(previous['_id'])
+        document = normalize(document)
+        document['_id'] = previous['_id']
+        with self.lock:
+            self._check(key, document)
+            self._store(key, document, previous)
+
+    def _update(self, spec, document, upsert, multi):
+        """
+        Applies an update (or, when `document` has no operators, a
+        replacement), returning (matched, modified, upserted _id)
+        """
+        replace = not any(key.startswith('$') for key in document)
+        if not replace:
+            document = normalize(document)
+        with self.lock:
+            matching = self._matching(spec)
+            if not multi:
+                matching = matching[:1]
+            modified = 0
+            for previous in matching:
+                if replace:
+                    updated = document
+                else:
+                    updated = memory.update(memory.clone(previous), document)
+                if updated != previous:
+                    self._replace(previous, updated)
+                    modified += 1
+            if matching or not upsert:
+                return len(matching), modified, None
+
+            if replace:
+                seed = memory.clone(document)
+                if '_id' not in seed and '_id' in self._spec(spec):
+                    seed['_id'] = memory.upserted(self._spec(spec)).get('_id')
+            else:
+                seed = memory.update(memory.upserted(self._spec(spec)),
+                                     document, inserting=True)
+            return 0, 0, self._insert(seed)
+
+    def insert_one(self, document, **kwargs):
+        return InsertOneResult(self._insert(document), True)
+
+    def insert_many(self, documents, ordered=True, **kwargs):
+        self.bulk_write([InsertOne(document) for document in documents],
+                        ordered=ordered)
+        return InsertManyResult([document['_id'] for document in documents], True)
+
+    def _update_result(self, result):
+        matched, modified, upserted = result
+        raw = {'n': matched or int(upserted is not None),
+               'nModified': modified, 'ok': 1.0,
+               'updatedExisting': bool(matched)}
+        if upserted is not None:
+            raw['upserted'] = upserted
+        return UpdateResult(raw, True)
+
+    def replace_one(self, filter, replacement, upsert=False, **kwargs):
+        return self._update_result(
+                        self._update(filter, replacement, upsert, False))
+
+    def update_one(self, filter, update, upsert=False, **kwargs):
+        return self._update_result(self._update(filter, update, upsert, False))
+
+    def update_many(self, filter, update, upsert=False, **kwargs):
+        return self._update_result(self._update(filter, update, upsert, True))
+
+    def _delete(self, spec, multi):
+        with self.lock:
+            matching = self._matching(spec)
+            if not multi:
+                matching = matching[:1]
+            for document in matching:
+                key = freeze(document['_id'])
+                for index in self.indexes.values():
+                    index.discard(key, document)
+                del self.documents[key]
+        return len(matching)
+
+    def delete_one(self, filter, **kwargs):
+        return DeleteResult({'n': self._delete(filter, False), 'ok': 1.0}, True)
+
+    def delete_many(self, filter, **kwargs):
+        return DeleteResult({'n': self._delete(filter, True), 'ok': 1.0}, True)
+
+    def bulk_write(self, requests, ordered=True, **kwargs):
+        result = {'writeErrors': [], 'writeConcernErrors': [], 'upserted': [],
+                  'nInserted': 0, 'nMatched': 0, 'nModified': 0,
+                  'nRemoved': 0, 'nUpserted': 0}
+        for i, request in enumerate(requests):
+            try:
+                if isinstance(request, InsertOne):
+                    self._insert(request._doc)
+                    result['nInserted'] += 1
+                elif isinstance(request, (DeleteOne, DeleteMany)):
+                    result['nRemoved'] += self._delete(
+                        request._filter, isinstance(request, DeleteMany))
+                else:
+                    matched, modified, upserted = self._update(
+                        request._filter, request._doc, request._upsert,
+                        isinstance(request, UpdateMany))
+                    result['nMatched'] += matched
+                    result['nModified'] += modified
+                    if upserted is not None:
+                        result['nUpserted'] += 1
+                        result['upserted'].append({'index': i, '_id': upserted})
+            except DuplicateKeyError as e:
+                result['writeErrors'].append({'index': i, 'code': 11000,
+                                              'errmsg': str(e),
+                                              'op': request._doc if hasattr(
+                                                request, '_doc') else None})
+                if ordered:
+                    break
+        if result['writeErrors']:
+            raise BulkWriteError(result)
+        return BulkWriteResult(result, True)
+
+    # indexes
+
+    def create_index(self, keys, **options):
+        if isinstance(keys, str):
+            keys = [(keys, pymongo.ASCENDING)]
+        keys = list(keys.items()) if isinstance(keys, dict) else list(keys)
+        name = options.pop('name', None) or \
+                    '_'.join('%s_%s' % (field, direction)
+                                for field, direction in keys)
+        options.pop('background', None)
+        index = MockIndex(keys, name, **options)
+        with self.lock:
+            for key, document in self.documents.items():
+                self._check_index(index, key, document)
+                index.add(key, document)
+            self.indexes[name] = index
+        return name
+
+    def _check_index(self, index, key, document):
+        index_key = index.conflict(key, document)
+        if index_key is not None:
+            raise DuplicateKeyError(
+                'E11000 duplicate key error collection: %s index: %s '
+                'dup key: %r' % (self.full_name, index.name, index_key),
+                11000, {'keyValue': index_key})
+
+    def create_indexes(self, indexes, **kwargs):
+        names = []
+        for index in indexes:
+            document = dict(index.document)
+            names.append(self.create_index(list(document.pop('key').items()),
+                                           **document))
+        return names
+
+    def index_information(self):
+        information = {'_id_': {'key': [('_id', 1)], 'v': 2}}
+        for name, index in self.indexes.items():
+            information[name] = index.information()
+        return information
+
+    def drop_index(self, index_or_name):
+        name = index_or_name
+        if not isinstance(name, str):
+            name = '_'.join('%s_%s' % key for key in index_or_name)
+        if self.indexes.pop(name, None) is None:
+            raise OperationFailure('index not found with name [%s]' % name)
+
+    def drop_indexes(self):
+        self.indexes = {}
+
+    def drop(self):
+        self.database.drop_collection(self.name)
+
+
+class MockCursor(object):
+    """
+    Cursor over the documents of a `MockCollection`, which are only
+    matched once the cursor is first iterated
+    """
+    def __init__(self, collection, spec, projection):
+        self.collection = collection
+        self.spec = spec
+        self.projection = projection
+        self.ordering = []
+        self.skipped = 0
+        self.limited = 0
+        self.results = None
+
+    def sort(self, key_or_list, direction=pymongo.ASCENDING):
+        if isinstance(key_or_list, str):
+            key_or_list = [(key_or_list, direction)]
+        self.ordering = list(key_or_list)
+        return self
+
+    def skip(self, n):
+        self.skipped = n
+        return self
+
+    def limit(self, n):
+        self.limited = n
+        return self
+
+    def batch_size(self, n):
+        return self
+
+    def _results(self):
+        documents = self.collection._matching(self.spec)
+        if self.ordering:
+            memory.sort(documents, self.ordering)
+        documents = documents[self.skipped:]
+        if self.limited:
+            documents = documents[:abs(self.limited)]
+        return iter([memory.project(document, self.projection)
+                                        for document in documents])
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.results is None:
+            self.results = self._results()
+        return next(self.results)
+
+    next = __next__
+
+    def close(self):
+        self.results = iter(())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class MockCommandCursor(object):
+    """
+    Cursor over the results of an aggregation
+    """
+    def __init__(self, documents):
+        self.results = iter(documents)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.results)
+
+    next = __next__
+
+    def close(self):
+        self.results = iter(())
+
+    def __enter__(self):
+        return self
 
-    def __getattr__(self, key):
-        return type(key, (MockCollection,), {})
+    def __exit__(self, *exc_info):
+        self.close()
@@ -2,28 +2,15 @@ from pynch.errors import *
 from bson.dbref import DBRef
 from bson.objectid import ObjectId
 import re
-import inspect
-from pynch.util import import_class
+import types
+from pynch.util import import_class, TrackedList, TrackedDict, TrackedSet
+from pynch import session
+from pynch.db import DB
 
 
 class Field(object):
     BASE_TYPES = (str, int, float, bool)
 
-    def __new__(cls, *args, **modifiers):
-        """
-        Necessary so that reference fields can import and
-        bind the correct classes when their models' reside
-        in a module being run as a script (ie in the unittests)
-        """
-        # TODO revamp rebinding to use the py3.X __qualname__ flag
-        # which will make code more performant (ie none of this
-        # frame introspection BS)
-        field = super().__new__(cls)
-        frame = inspect.stack()[-1][0]  # outermost frame
-        field._context = frame.f_locals.get('__name__', '')
-        del frame
-        return field
-
     def __init__(self, db_field=None, required=False, default=None,
                  unique=False, unique_with=None, primary_key=False,
                  choices=None, help_text=None, *args, **kwargs):
@@ -57,6 +44,38 @@ class Field(object):
         """
         self.name = name
         self.model = model
+        # compact models store field values in slots rather than in
+        # each document's __dict__, see `ModelMetaclass`
+        slot = getattr(model, '_pynch_' + name, None)
+        self.slot = slot if \
+            isinstance(slot, types.MemberDescriptorType) else None
+
+    def stored(self, document):
+        """
+        Returns the value stored on the document, raising a KeyError when
+        there's none
+        """
+        if self.slot is None:
+            return document.__dict__[self.name]
+        try:
+            return self.slot.__get__(document)
+        except AttributeError:
+            raise KeyError(self.name)
+
+    def store(self, document, value):
+        if self.slot is None:
+            document.__dict__[self.name] = value
+        else:
+            self.slot.__set__(document, value)
+
+    def unstore(self, document):
+        if self.slot is None:
+            del document.__dict__[self.name]
+            return
+        try:
+            self.slot.__delete__(document)
+        except AttributeError:
+            raise KeyError(self.name)
 
     def is_set(self):
         return hasattr(self, 'name') and hasattr(self, 'model')
@@ -67,8 +86,12 @@ class Field(object):
     def get_field_value_or_default(self, document):
         # must convert KeyErrors to AttributeErrors
         try:
-            return document.__dict__[self.name]
+            return self.stored(document)
         except KeyError:
+            # fields left out of a query are fetched on first access
+            if self.name in document._deferred:
+                document._load_deferred()
+                return self.get_field_value_or_default(document)
             if self.default is not None:
                 return self.default
             raise AttributeError
@@ -83,14 +106,23 @@ class Field(object):
         return self.get_field_value_or_default(document)
 
     def __set__(self, document, value):
-        document.__dict__[self.name] = self.validate(value)
+        self.store(document, self.validate(value))
+        document._mark_changed(self.name)
+
+    def fill(self, document, value):
+        """
+        Stores a value loaded from the database, which is trusted and
+        therefore neither validated nor recorded as a change
+        """
+        self.store(document, value)
 
     def __delete__(self, document):
         # convert KeyErrors to AttributeErrors
         try:
-            del document.__dict__[self.name]
+            self.unstore(document)
         except KeyError:
             raise AttributeError
+        document._mark_changed(self.name)
 
     def __str__(self):
         field_unset_msg = '<%s %s field object (not set)>' % (type(self), id(self))
@@ -105,6 +137,34 @@ class Field(object):
     def validate(self, value):
         raise DelegationException('Define in a subclass')
 
+    def to_plain(self, value):
+        """
+        Converts a raw mongo value to plain python data, which unlike
+        `to_python` never builds (or fetches) documents
+        """
+        return None if value is None else self.to_python(value)
+
+    def references(self, value):
+        """
+        Yields a (field, dbref) tuple for every reference found in
+        `value`, a raw mongo value stored under this field.
+        """
+        return ()
+
+    def embedded(self, value):
+        """
+        Yields the embedded documents held by `value`, so that changes
+        made to them can be detected when their parent is saved.
+        """
+        return ()
+
+    def referenced(self, value):
+        """
+        Yields the documents referenced by `value`, so that they can be
+        saved along with the document holding them.
+        """
+        return ()
+
 
 class DynamicField(Field):
     """
@@ -169,7 +229,7 @@ class ComplexField(Field):
         # important to manually call `set` so that string references
         # are rebound with the actual classes
         if isinstance(self.field, DocumentField):
-            self.field.set(name, self.field.reference)
+            self.field.set(name, model)
 
         super(ComplexField, self).set(name, model)
 
@@ -183,6 +243,16 @@ class ComplexField(Field):
             if isinstance(self.field.reference, str):
                 raise ValidationException('Failed to rebind references')
         super(ComplexField, self).__set__(document, value)
+        # swap in a container which reports in place mutations
+        value = self.stored(document)
+        if value is not None:
+            self.store(document, self.track(document, value))
+
+    def fill(self, document, value):
+        self.store(document, self.track(document, value))
+
+    def track(self, document, value):
+        raise DelegationException('Define in a subclass')
 
     def to_save(self, value):
         return value
@@ -196,6 +266,28 @@ class ComplexField(Field):
         basetypes = Field.BASE_TYPES
         return x if isinstance(x, basetypes) else self.field.to_python(x)
 
+    def _to_plain_caller(self, x):
+        basetypes = Field.BASE_TYPES
+        return x if isinstance(x, basetypes) else self.field.to_plain(x)
+
+    def references(self, iterable):
+        basetypes = Field.BASE_TYPES
+        for x in iterable or ():
+            if not isinstance(x, basetypes):
+                yield from self.field.references(x)
+
+    def embedded(self, iterable):
+        # only containers of documents (or of other containers) can
+        # hold embedded documents, so don't bother looking otherwise
+        if isinstance(self.field, (EmbeddedDocumentField, ComplexField)):
+            for x in iterable or ():
+                yield from self.field.embedded(x)
+
+    def referenced(self, iterable):
+        if isinstance(self.field, (DocumentField, ComplexField)):
+            for x in iterable or ():
+                yield from self.field.referenced(x)
+
 
 class DocumentField(Field):
     def __init__(self, reference, **params):
@@ -214,7 +306,7 @@ class DocumentField(Field):
         if isinstance(self.reference, str):
             name = self.reference
             self.reference = self.model if 'self' == name else \
-                    (import_class(name, self._context) or name)
+                    (import_class(name, self.model.__module__) or name)
 
     def __set__(self, document, value):
         # rebind reference with an actual class (this handles the
@@ -226,11 +318,13 @@ class DocumentField(Field):
             # reference is invalid
             if isinstance(self.reference, str):
                 raise ValidationException('Failed to rebind references')
-        # cannot use a subclass or a superclass (types must match)
-        if type(value) != self.reference:
+        # cannot use a subclass or a superclass (types must match).
+        # notice that `__class__` is used, rather than `type`, so that
+        # lazy references pass for the documents they stand in for
+        if value.__class__ != self.reference:
             raise ValidationException(
                 'Value of type %s must be exactly of type %s' \
-                        % (type(value), self.reference))
+                        % (value.__class__, self.reference))
         super(DocumentField, self).__set__(document, value)
 
     def validate(self, value):
@@ -260,11 +354,19 @@ class ListField(ComplexField):
             pc = self._to_python_caller          # optimization
             return [pc(x) for x in lst]
 
+    def to_plain(self, lst):
+        if lst is not None:
+            pc = self._to_plain_caller           # optimization
+            return [pc(x) for x in lst]
+
     def validate(self, lst):
         if lst is not None:
             validate = self.field.validate       # optimization
             return [validate(x) for x in lst]
 
+    def track(self, document, lst):
+        return TrackedList(lst).track(document, self.name)
+
     to_mongo = to_save
 
 
@@ -304,6 +406,12 @@ class DictField(ComplexField):
             pc = self._to_python_caller          # optimization
             return dict((k, pc(k, v)) for k, v in dct.items())
 
+    def to_plain(self, dct):
+        if dct is not None:
+            basetypes = SimpleField.BASE_TYPES
+            return dict((k, v if isinstance(v, basetypes) else
+                            self.field[k].to_plain(v)) for k, v in dct.items())
+
     def validate(self, dct):
         if dct is not None:
             return dict((k, self.field[k].validate(v)) for k, v in dct.items())
@@ -312,6 +420,23 @@ class DictField(ComplexField):
         basetypes = SimpleField.BASE_TYPES
         return x if isinstance(x, basetypes) else self.field[k].to_python(x)
 
+    def references(self, dct):
+        basetypes = SimpleField.BASE_TYPES
+        for k, x in (dct or {}).items():
+            if not isinstance(x, basetypes):
+                yield from self.field[k].references(x)
+
+    def embedded(self, dct):
+        for k, x in (dct or {}).items():
+            yield from self.field[k].embedded(x)
+
+    def referenced(self, dct):
+        for k, x in (dct or {}).items():
+            yield from self.field[k].referenced(x)
+
+    def track(self, document, dct):
+        return TrackedDict(dct).track(document, self.name)
+
     to_mongo = to_save
 
 
@@ -336,15 +461,31 @@ class SetField(ComplexField):
             pc = self._to_python_caller          # optimization
             return set(pc(s) for s in lst)
 
+    def to_plain(self, lst):
+        if lst is not None:
+            pc = self._to_plain_caller           # optimization
+            return set(pc(s) for s in lst)
+
     def validate(self, iterable):
         if iterable is not None:
             validate = self.field.validate       # optimization
             return [validate(s) for s in iterable]
 
+    def track(self, document, iterable):
+        return TrackedSet(iterable).track(document, self.name)
+
     to_mongo = to_save
 
 
 class ReferenceField(DocumentField):
+    def __init__(self, reference, lazy=False, **params):
+        """
+        Lazy reference fields load their documents as `LazyReference`
+        proxies, which are only fetched when first accessed.
+        """
+        self.lazy = lazy
+        super(ReferenceField, self).__init__(reference, **params)
+
     def rebind(self):
         super(ReferenceField, self).rebind()
         # only add backrefs when the reference has been rebound
@@ -365,25 +506,118 @@ class ReferenceField(DocumentField):
         return None
 
     def to_save(self, document):
-        if document is not None:
-            document.save()
-            return self.to_mongo(document)
-        # in this case, document will be None
-        return None
+        # the referenced document itself is written by the unit of
+        # work saving the document holding the reference
+        return self.to_mongo(document)
 
     def to_python(self, dbref):
         # if the dbref is not None then delegate to
         # the field's model
         if dbref:
-            return self.reference.to_python(
-                        self.dereference(dbref) or {})
+            if self.lazy or session.loading_lazily():
+                return LazyReference(self, dbref)
+            return self.load(dbref)
         # Empty dbref, implies was not set in the db
         return None
 
+    def to_plain(self, dbref):
+        # references are left as they're stored
+        return dbref or None
+
+    def load(self, dbref):
+        """
+        Builds the document pointed to by `dbref`, unless the open session
+        (if any) already holds it
+        """
+        open_session = session.current_session()
+        if open_session is not None:
+            key = session.dbref_identity(dbref)
+            document = open_session.get(key)
+            if document is None:
+                document = open_session.add(key, self._load(dbref))
+            return document
+        return self._load(dbref)
+
+    def _load(self, dbref):
+        # documents being loaded in batches share an identity
+        # map, which will already have fetched the reference
+        identity_map = session.current()
+        if identity_map is not None:
+            return identity_map.hydrate(self, dbref)
+        return self.reference.to_python(self.dereference(dbref) or {})
+
+    def references(self, dbref):
+        # lazy references are not fetched up front
+        if dbref and not self.lazy:
+            yield (self, dbref)
+
+    def referenced(self, document):
+        if document is not None:
+            yield document
+
     def dereference(self, dbref):
-        key = (dbref.host, dbref.port)
-        db = self.model.pynch._connection_pool[key][dbref.database]
-        return db.dereference(dbref)
+        # references point to wherever the referenced model was stored
+        # at the time, which needn't be where it's stored now
+        database = self.reference._meta['database']
+        database = DB(dbref.database or database.name,
+                      getattr(dbref, 'host', database.host),
+                      getattr(dbref, 'port', database.port),
+                      manager=database.manager)
+        return database.database()[dbref.collection].find_one({'_id': dbref.id})
+
+
+class LazyReference(object):
+    """
+    Stands in for a referenced document, which is only fetched the first
+    time one of its attributes is accessed. Its primary key is known
+    without a round trip to the database.
+    """
+    __slots__ = ('_field', '_dbref', '_document')
+
+    def __init__(self, field, dbref):
+        object.__setattr__(self, '_field', field)
+        object.__setattr__(self, '_dbref', dbref)
+        object.__setattr__(self, '_document', None)
+
+    @property
+    def __class__(self):
+        # makes isinstance checks against the referenced model pass
+        return self._field.reference
+
+    @property
+    def pk(self):
+        if self._document is None:
+            return self._dbref.id
+        return self._document.pk
+
+    def _is_loaded(self):
+        return self._document is not None
+
+    def _fetch(self):
+        if self._document is None:
+            document = self._field.load(self._dbref)
+            object.__setattr__(self, '_document', document)
+        return self._document
+
+    def __getattr__(self, name):
+        return getattr(self._fetch(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._fetch(), name, value)
+
+    def __delattr__(self, name):
+        delattr(self._fetch(), name)
+
+    def __eq__(self, other):
+        if isinstance(other, LazyReference):
+            other = other._fetch()
+        return self._fetch() == other
+
+    def __str__(self):
+        return str(self._fetch())
+
+    def __repr__(self):
+        return '<LazyReference %r>' % (self._dbref,)
 
 
 class EmbeddedDocumentField(DocumentField):
@@ -399,6 +633,25 @@ class EmbeddedDocumentField(DocumentField):
             return self.reference.to_python(document)
         return None
 
+    def to_plain(self, document):
+        if document is not None:
+            return self.reference.pynch.codec.plain(document)
+        return None
+
+    def references(self, document):
+        if document is not None:
+            yield from self.reference.pynch.references(document)
+
+    def embedded(self, document):
+        if document is not None:
+            yield document
+
+    def referenced(self, document):
+        if document is not None:
+            for field in document.pynch.fields:
+                value = getattr(document, field.name, None)
+                yield from field.referenced(value)
+
     def validate(self, value):
         return value.validate()
 
@@ -412,7 +665,12 @@ class PrimaryKey(SimpleField):
     def __get__(self, document, model=None):
         if document is None:
             return self
-        return document.__dict__.setdefault('_id', ObjectId())
+        try:
+            return self.stored(document)
+        except KeyError:
+            pk = ObjectId()
+            self.store(document, pk)
+            return pk
 
 
 class ComplexPrimaryKey(DictField):
@@ -469,7 +727,7 @@ class IntegerField(SimpleField):
         return super(IntegerField, self).to_save(value)
 
     def to_python(self, value):
-        return int(value)
+        return int(value) if value is not None else value
 
     def validate(self, value):
         if not isinstance(value, int) and value is not None:
@@ -499,7 +757,7 @@ class FloatField(SimpleField):
         return super(FloatField, self).to_save(value)
 
     def to_python(self, value):
-        return float(value)
+        return float(value) if value is not None else value
 
     def validate(self, value):
         if not isinstance(value, float) and value is not None:
@@ -646,8 +904,9 @@ def check_fields(document):
     Validate the fields, if a failure occurs then yield
     a tuple containing the field name and exception
     """
-    # validate the fields' relationships to each other
-    for field in document.pynch.fields:
+    # validate the fields' relationships to each other, fields which
+    # haven't been loaded haven't changed, so needn't be checked
+    for field in document._loaded_fields():
         try:
             check_required(field, document)
         except ValidationException as e:
@@ -0,0 +1,179 @@
+"""
+Index management. Indexes are never built as a side effect of defining
+a model, instead they're built for a whole set of models at once, ie
+when deploying or once the application is configured:
+
+    import pynch
+    pynch.ensure_indexes([Garden, Gardener, Flower])
+
+Besides fields marked as `unique` (or `unique_with` other fields, which
+makes for a compound unique index) models declare their indexes in
+`_meta['index']`, each of which is either
+
+    'acres'                         # a single field
+    '-acres'                        # in descending order
+    ['gardener', '-acres']          # a compound index
+    {'fields': ['name'],            # or any of the above with options,
+     'unique': True,                # all of which are optional
+     'sparse': True,
+     'expire_after': 3600,          # seconds, for TTL indexes
+     'partial': {'acres': {'$gt': 1}},
+     'name': 'big_gardens'}
+
+Field names are translated to their `db_field`.
+"""
+import pymongo
+from pymongo import IndexModel
+from pynch.errors import ValidationException
+from pynch.util import model_registry
+
+
+# index options which tell two indexes on the same keys apart
+OPTIONS = ('unique', 'sparse', 'expireAfterSeconds', 'partialFilterExpression')
+
+
+def db_fieldname(model, fieldname):
+    field = model.pynch.fields_by_name.get(fieldname)
+    return (field.db_field or field.name) if field else fieldname
+
+
+def index_keys(model, fieldnames):
+    if isinstance(fieldnames, str):
+        fieldnames = [fieldnames]
+    keys = []
+    for fieldname in fieldnames:
+        direction = pymongo.ASCENDING
+        if fieldname.startswith('-'):
+            fieldname, direction = fieldname[1:], pymongo.DESCENDING
+        keys.append((db_fieldname(model, fieldname), direction))
+    return keys
+
+
+def index_model(model, spec):
+    """
+    Translates one of the specs of `_meta['index']` to an `IndexModel`
+    """
+    if not isinstance(spec, dict):
+        return IndexModel(index_keys(model, spec))
+
+    unknown = set(spec) - set(['fields', 'unique', 'sparse', 'expire_after',
+                               'partial', 'name'])
+    if unknown or 'fields' not in spec:
+        raise ValidationException(
+            'Invalid index %r on %s' % (spec, model.__name__))
+
+    options = {}
+    if spec.get('unique'):
+        options['unique'] = True
+    if spec.get('sparse'):
+        options['sparse'] = True
+    if spec.get('expire_after') is not None:
+        options['expireAfterSeconds'] = spec['expire_after']
+    if spec.get('partial'):
+        options['partialFilterExpression'] = dict(
+            (db_fieldname(model, fieldname), value)
+                for fieldname, value in spec['partial'].items())
+    if spec.get('name'):
+        options['name'] = spec['name']
+    return IndexModel(index_keys(model, spec['fields']), **options)
+
+
+def index_models(model):
+    """
+    The indexes declared by `model`: one per field marked as unique
+    (or per field, when `_meta['auto_index']` is set), a compound
+    unique index per field declaring `unique_with`, and those of
+    `_meta['index']`.
+    """
+    meta = model._meta
+    pk_field = model.pynch.primary_key_field
+    indexes = []
+    for field in model.pynch.fields:
+        if field is pk_field:
+            # `_id` is always indexed by mongo
+            continue
+        fieldname = field.db_field or field.name
+        if field.unique or meta['auto_index']:
+            indexes.append(IndexModel([(fieldname, pymongo.ASCENDING)],
+                                      unique=field.unique))
+        if field.unique_with:
+            unique_with = field.unique_with if \
+                    isinstance(field.unique_with, list) else [field.unique_with]
+            keys = index_keys(model, [field.name] + unique_with)
+            indexes.append(IndexModel(keys, unique=True))
+
+    indexes.extend(index_model(model, spec) for spec in meta['index'])
+
+    return distinct(indexes)
+
+
+def distinct(indexes):
+    # the same index can be declared more than once, ie both as a
+    # unique field and in `_meta['index']`, the first declaration wins
+    by_name = {}
+    for index in indexes:
+        by_name.setdefault(index.document['name'], index)
+    return list(by_name.values())
+
+
+def index_key(keys):
+    # servers can report directions as floats
+    return tuple((name, int(direction) if isinstance(direction, float)
+                        else direction) for name, direction in keys)
+
+
+def index_options(index):
+    # `unique=False` and the like are the same as leaving them out
+    return dict((option, index[option]) for option in OPTIONS
+                    if index.get(option) not in (None, False))
+
+
+def index_plan(indexes, existing):
+    """
+    Compares the wanted `indexes` with the `existing` ones (as returned
+    by `index_information`), returning the names of the indexes to drop
+    and the indexes to create. Indexes which already exist, with the
+    same options, are left alone.
+    """
+    by_key = dict((index_key(info['key']), (name, info))
+                        for name, info in existing.items())
+    drop, create = [], []
+    for index in indexes:
+        document = index.document
+        key = index_key(document['key'].items())
+        if key in by_key:
+            name, info = by_key[key]
+            if index_options(info) == index_options(document):
+                continue
+            # indexes on the same keys with other options must be replaced
+            drop.append(name)
+        create.append(index)
+    return drop, create
+
+
+def ensure_indexes(models=None):
+    """
+    Brings the indexes of `models` (of every model defined so far by
+    default) up to date, creating those which are missing with one
+    `create_indexes` call per collection. Existing indexes are never
+    rebuilt, unless their options changed.
+    """
+    if models is None:
+        models = set(model_registry.values())
+
+    # models can share a collection, ie models with the same name
+    by_collection = {}
+    for model in models:
+        indexes = index_models(model)
+        if indexes:
+            collection = model.pynch.collection
+            key = (collection.full_name, id(collection.database.client))
+            by_collection.setdefault(key, (collection, []))[1].extend(indexes)
+
+    for collection, indexes in by_collection.values():
+        drop, create = index_plan(distinct(indexes),
+                                  collection.index_information())
+        for name in drop:
+            collection.drop_index(name)
+        if create:
+            collection.create_indexes(create)
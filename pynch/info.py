@@ -1,10 +1,16 @@
-from pynch.query import QueryManager
-from pynch.db import MockDatabase, MockConnection
-import pymongo
-import weakref
-from pynch.util import dir_
-from pynch.errors import ConnectionException, QueryException
-from pynch.fields import Field
+from pynch.query import QuerySet
+from pynch.aggregation import Aggregation
+from pynch.codec import Codec
+from pynch import aio
+from pynch.session import IdentityMap, current_session, lazy_references
+import functools
+import itertools
+from pymongo.errors import BulkWriteError, DuplicateKeyError, WriteError
+from pymongo.write_concern import WriteConcern
+from pynch.errors import ValidationException
+from pynch.fields import Field, LazyReference
+from pynch.indexes import ensure_indexes
+from pynch.lookups import to_query
 
 
 class InformationDescriptor(object):
@@ -13,29 +19,24 @@ class InformationDescriptor(object):
     pynch connections to the database.
     """
 
-    _connection_pool = weakref.WeakValueDictionary()
-
     def __init__(self, model):
         # extremely important that we retain a reference to
         # the model which owns this descriptor
         self.model = model
         self.backrefs = {}
         self.primary_key_field = None
+        # (fields, fields by name, fields by db_field), built lazily
+        # or by the metaclass once all the fields have been attached
+        self._registry = None
+        # generated converters, see `codec`
+        self._codec = None
+        # compiled queries by shape, see `pynch.lookups`
+        self.query_shapes = {}
+        # see `async_collection`
+        self._async_collection = None
 
-        # do some more prep
-        db_name, host, port = self.model._meta.get('database')
-        try:
-            self.connection = self.connect(host, port)
-        except ConnectionException:
-            self.connection = MockConnection(host, port)
-
-        # generate the actual database if it is named, otherwise
-        # create an in memory mockup
-        self.db = self.connection[db_name] if \
-                        db_name else MockDatabase(self.connection)
-
-        # and make the collection we're going to use
-        self.collection = getattr(self.db, self.model.__name__)
+        # (manager generation, collection), resolved on first use
+        self._collection = None
 
     def __get__(self, document, model=None):
         # always returns itself
@@ -45,52 +46,455 @@ class InformationDescriptor(object):
         # bad things happen if pynch goes away
         raise NotImplementedError('Cannot overwrite pynch')
 
-    def connect(self, host, port):
+    @property
+    def connection(self):
+        return self.model._meta['database'].client()
+
+    @property
+    def db(self):
+        return self.model._meta['database'].database()
+
+    @property
+    def collection(self):
+        """
+        The model's collection. Nothing is resolved (let alone connected
+        to) until the collection is first used, and it's resolved again
+        after the database's clients have been closed or the process has
+        forked, see `ConnectionManager`.
+        """
+        manager = self.model._meta['database'].manager
+        cached = self._collection
+        if cached is not None and cached[0] in (None, manager.generation):
+            return cached[1]
+
+        collection = getattr(self.db, self.model.__name__)
+        self._collection = (manager.generation, collection)
+        if self.model._meta['auto_index'] and cached is None:
+            ensure_indexes([self.model])
+        return collection
+
+    @collection.setter
+    def collection(self, collection):
+        # a collection set by hand is kept for good
+        self._collection = (None, collection)
+
+    @property
+    def write_collection(self):
+        """
+        The collection, configured with the model's write concern
         """
-        We need to establish a connection to the db and want the
-        option of hooking into multiple databases but don't want
-        to unecessarily spawn connections. Therefore models which
-        declare (or inherit) the same host and port values in their
-        respective _meta's will share a connection.
+        write_concern = WriteConcern(w=self.model._meta['write_concern'])
+        return self.collection.with_options(write_concern=write_concern)
+
+    @property
+    def async_collection(self):
         """
-        key = (host, port)
-        if key not in self._connection_pool:
-            # build the connection
-            connection = pymongo.MongoClient(host=host, port=port)
-            # set value in the connection pool
-            return self._connection_pool.setdefault(key, connection)
-        # otherwise just get what's already there
-        return self._connection_pool[key]
+        The collection used by the asynchronous api, see `pynch.aio`.
+        It's resolved again along with `collection`, and can be set, ie
+        to stand in for the database in tests.
+        """
+        manager = self.model._meta['database'].manager
+        cached = self._async_collection
+        if cached is not None and cached[0] in (None, manager.generation):
+            return cached[1]
+
+        collection = aio.async_collection(self.model)
+        self._async_collection = (manager.generation, collection)
+        return collection
+
+    @async_collection.setter
+    def async_collection(self, collection):
+        # like `collection`, a collection set by hand is kept for good
+        self._async_collection = (None, collection)
+
+    @property
+    def async_write_collection(self):
+        write_concern = WriteConcern(w=self.model._meta['write_concern'])
+        return self.async_collection.with_options(write_concern=write_concern)
 
     @property
     def objects(self):
-        return QueryManager(self.model)
+        return QuerySet(self.model)
 
     @property
     def fields(self):
-        values = dir_(self.model).values()
-        return tuple(v for v in values if isinstance(v, Field))
+        return (self._registry or self.build_field_registry())[0]
+
+    @property
+    def fields_by_name(self):
+        return (self._registry or self.build_field_registry())[1]
+
+    @property
+    def fields_by_db_field(self):
+        return (self._registry or self.build_field_registry())[2]
+
+    @property
+    def codec(self):
+        """
+        The functions, generated for this model's fields, converting its
+        documents to and from mongo. Rebuilt whenever the fields change.
+        """
+        if self._codec is None:
+            self._codec = Codec(self.model, self.fields)
+        return self._codec
+
+    def build_field_registry(self):
+        """
+        Collects the model's fields into an ordered tuple along with
+        lookup tables keyed by attribute name and by db_field. Walks
+        the mro from the top down so inherited fields come first and
+        are overridden by those declared further down the hierarchy.
+        """
+        by_name = {}
+        for klass in reversed(self.model.__mro__):
+            for name, value in vars(klass).items():
+                if isinstance(value, Field):
+                    by_name[name] = value
+                # a subclass can hide an inherited field by overwriting
+                # it with a non-field attribute
+                elif name in by_name:
+                    del by_name[name]
+
+        # primary keys can be reachable under two names (their own
+        # and `_id`), but should only ever be listed once
+        fields, seen = [], set()
+        for field in by_name.values():
+            if id(field) not in seen:
+                seen.add(id(field))
+                fields.append(field)
+
+        by_db_field = {}
+        for name, field in by_name.items():
+            by_db_field[field.db_field or getattr(field, 'name', name)] = field
+
+        self._registry = (tuple(fields), by_name, by_db_field)
+        return self._registry
+
+    def invalidate_fields(self):
+        """
+        Drops the cached field registry of the model and every one of
+        its subclasses, which is necessary whenever a field is added
+        to or removed from a model after its class has been created.
+        """
+        self._registry = None
+        self._codec = None
+        self.query_shapes = {}
+        for subclass in type.__subclasses__(self.model):
+            subclass.pynch.invalidate_fields()
+
+    def _to_query(self, dictionary):
+        """
+        Translates a dictionary of lookups into a mongo query, see
+        `pynch.lookups`
+        """
+        return to_query(self.model, dictionary)
 
     def _raw_find(self, dictionary):
-        for fieldname in dictionary.keys():
-            field = getattr(self.model, fieldname)
-            if field.primary_key and field.name != '_id':
-                dictionary['_id'] = dictionary.pop(fieldname)
-        return self.collection.find(dictionary)
-
-    def find(self, dictionary):
-        results = self._raw_find(dictionary)
-        if results is not None:
-            return (self.model.to_python(x) for x in results)
-        raise QueryException('No matching documents')
-
-    def get(self, **kwargs):
-        results = self._raw_find(kwargs)
-        # query returns nothing
-        if results is None:
-            raise QueryException('No matching documents')
-        # whoops query doesnt have unique result
-        if results.count() > 1:
-            raise QueryException('Multiple objects fouund')
-
-        return self.model.to_python(results.next())
+        return self.collection.find(self._to_query(dictionary))
+
+    def references(self, mongo):
+        """
+        Yields a (field, dbref) tuple for every reference held by the
+        raw mongo document, including those nested in containers and
+        embedded documents.
+        """
+        for field in self.fields:
+            fieldname = field.db_field or field.name
+            if fieldname in mongo:
+                yield from field.references(mongo[fieldname])
+
+    def find(self, dictionary, batched=False, lazy=False):
+        """
+        When `batched` is set the references of each page of results
+        are fetched with a single `$in` query per referenced model,
+        rather than with one query per reference.
+
+        When `lazy` is set references are loaded as proxies which are
+        only fetched when touched.
+        """
+        return self._hydrate(self._raw_find(dictionary), batched, lazy)
+
+    def stream(self, query=None, **kwargs):
+        """
+        Streams the documents matching `query`, either a dictionary or a
+        query set, in lists. See `QuerySet.stream` for the arguments.
+
+            for gardens in Garden.pynch.stream({'acres': 1}, chunk=500):
+                export(gardens)
+        """
+        if not isinstance(query, QuerySet):
+            query = self.objects.filter(**query) if query else self.objects
+        return query.stream(**kwargs)
+
+    def aggregate(self):
+        """
+        Returns an aggregation pipeline builder over the model's
+        collection, see `pynch.aggregation`
+        """
+        return Aggregation(self.model)
+
+    def _loader(self, deferred=()):
+        """
+        Returns the function building documents out of query results
+        """
+        to_python = self.model.to_python
+        if deferred:
+            to_python = functools.partial(to_python, deferred=deferred)
+        # hand out the documents an open session already holds
+        session = current_session()
+        if session is not None:
+            to_python = session.loader(self.model, to_python)
+        return to_python
+
+    def _hydrate(self, results, batched=False, lazy=False, deferred=()):
+        to_python = self._loader(deferred)
+        if lazy:
+            return self._lazy(results, to_python)
+        if batched:
+            return self._batched(results, to_python)
+        return (to_python(x) for x in results)
+
+    async def _ahydrate(self, results, lazy=False, deferred=(),
+                        page_size=100):
+        """
+        Asynchronous counterpart of `_hydrate`. Unless `lazy`, references
+        are always fetched page by page ahead of time, as building a
+        document mustn't block the event loop.
+        """
+        to_python = self._loader(deferred)
+        page = []
+        async for mongo in results:
+            page.append(mongo)
+            if len(page) == page_size:
+                for document in await self._ahydrate_page(page, to_python,
+                                                          lazy):
+                    yield document
+                page = []
+        for document in await self._ahydrate_page(page, to_python, lazy):
+            yield document
+
+    async def _ahydrate_page(self, page, to_python, lazy):
+        if lazy:
+            return list(self._lazy(page, to_python))
+        identity_map = IdentityMap()
+        await identity_map.aprefetch(self.model, page)
+        with identity_map:
+            return [to_python(mongo) for mongo in page]
+
+    def _lazy(self, results, to_python):
+        for mongo in results:
+            with lazy_references():
+                document = to_python(mongo)
+            yield document
+
+    def _batched(self, results, to_python, page_size=100):
+        results = iter(results)
+        while True:
+            page = list(itertools.islice(results, page_size))
+            if not page:
+                return
+            identity_map = IdentityMap()
+            identity_map.prefetch(self.model, page)
+            for mongo in page:
+                # documents are built one at a time, so that the map is
+                # never left active while control is handed back
+                with identity_map:
+                    document = to_python(mongo)
+                yield document
+
+    def get(self, batched=False, lazy=False, **kwargs):
+        """
+        Returns the one document matching the query, see `QuerySet.get`
+        """
+        return self.objects.batched(batched).lazy(lazy).get(**kwargs)
+
+    async def aget(self, lazy=False, **kwargs):
+        """
+        Asynchronous counterpart of `get`
+        """
+        return await self.objects.lazy(lazy).aget(**kwargs)
+
+    def get_or_none(self, **kwargs):
+        """
+        Returns the first document matching the query or None, see
+        `QuerySet.get_or_none`
+        """
+        return self.objects.get_or_none(**kwargs)
+
+    def bulk_save(self, documents, batch_size=1000, ordered=False, **kwargs):
+        """
+        Saves the documents of an iterable `batch_size` at a time, along
+        with whatever they reference, using one bulk write per collection
+        per batch. Documents which fail to validate or to be written are
+        reported on the returned `BulkSaveResult` without aborting their
+        batch, unless `ordered`, in which case saving stops at the first
+        failure. Keyword arguments are passed on to pymongo's `bulk_write`.
+        """
+        result = BulkSaveResult()
+        documents = iter(documents)
+        while True:
+            batch = list(itertools.islice(documents, batch_size))
+            if not batch:
+                return result
+
+            unit, failed = UnitOfWork(), False
+            for document in batch:
+                queued = dict((model, len(operations))
+                                for model, operations in unit.writes.items())
+                visited = len(unit.visited)
+                try:
+                    unit.add(document)
+                except (ValidationException, AssertionError) as e:
+                    result.errors.append((document, e))
+                    # nothing the failing document queued is written, so
+                    # that it isn't saved pointing at documents which
+                    # weren't, and what it visited can be visited again
+                    unit.writes = dict(
+                        (model, operations[:queued[model]])
+                            for model, operations in unit.writes.items()
+                            if model in queued)
+                    for key in list(unit.visited)[visited:]:
+                        del unit.visited[key]
+                    if ordered:
+                        failed = True
+                        break
+
+            writes = sum(len(operations) for operations in unit.writes.values())
+            errors = unit.flush(ordered=ordered, **kwargs)
+            result.saved += writes - len(errors)
+            result.errors.extend(errors)
+            # nothing gets written past the first failure of an ordered save
+            if (failed or errors) and ordered:
+                return result
+
+
+class BulkSaveResult(object):
+    def __init__(self):
+        # number of documents written, including referenced documents
+        self.saved = 0
+        # (document, exception) tuples for the documents not written
+        self.errors = []
+
+
+class UnitOfWork(object):
+    """
+    Collects the writes needed to save a graph of documents. The reference
+    graph is walked once, each document being visited at most once (so
+    cycles are harmless), documents which haven't changed since they were
+    loaded or saved are skipped, and the remaining writes are flushed with
+    one bulk write per collection.
+    """
+    def __init__(self):
+        # visited documents by id, the documents are kept around so
+        # that their ids can't be reused while the unit is alive
+        self.visited = {}
+        # model -> [(document, write operation)]
+        self.writes = {}
+
+    def add(self, document):
+        pending = [document]
+        while pending:
+            document = pending.pop()
+            # references which were never fetched can't have changed
+            if isinstance(document, LazyReference):
+                if not document._is_loaded():
+                    continue
+                document = document._fetch()
+
+            if id(document) in self.visited:
+                continue
+            self.visited[id(document)] = document
+
+            for field in document._loaded_fields():
+                value = getattr(document, field.name, None)
+                pending.extend(field.referenced(value))
+
+            if document._persisted and not document._is_dirty():
+                continue
+
+            operation = document.validate()._write_operation()
+            if operation is None:
+                document._mark_saved()
+            else:
+                self.writes.setdefault(type(document), []).append(
+                                                    (document, operation))
+        return self
+
+    def flush(self, ordered=False, **kwargs):
+        """
+        Sends the collected writes, returning a list of (document,
+        exception) tuples for the documents which couldn't be written.
+        When `ordered`, writing stops at the first failure and the
+        documents which weren't attempted are reported as well.
+        """
+        errors = []
+        writes, self.writes = self.writes, {}
+        for model, operations in writes.items():
+            if errors and ordered:
+                errors.extend(self._not_attempted(operations))
+                continue
+            try:
+                model.pynch.write_collection.bulk_write(
+                        [operation for _, operation in operations],
+                        ordered=ordered, **kwargs)
+            except BulkWriteError as e:
+                errors.extend(self._settle(operations, ordered, e))
+            else:
+                errors.extend(self._settle(operations, ordered))
+        return errors
+
+    async def aflush(self, ordered=False, **kwargs):
+        """
+        Asynchronous counterpart of `flush`
+        """
+        errors = []
+        writes, self.writes = self.writes, {}
+        for model, operations in writes.items():
+            if errors and ordered:
+                errors.extend(self._not_attempted(operations))
+                continue
+            try:
+                await model.pynch.async_write_collection.bulk_write(
+                        [operation for _, operation in operations],
+                        ordered=ordered, **kwargs)
+            except BulkWriteError as e:
+                errors.extend(self._settle(operations, ordered, e))
+            else:
+                errors.extend(self._settle(operations, ordered))
+        return errors
+
+    def _not_attempted(self, operations):
+        return [(document, WriteError(
+                    'Not attempted, an earlier write failed', None, {}))
+                                        for document, _ in operations]
+
+    def _settle(self, operations, ordered, exception=None):
+        """
+        Marks the documents of a bulk write as saved, less those which
+        failed to be written, which are returned along with their errors
+        """
+        failed = {}
+        if exception is not None:
+            for error in exception.details.get('writeErrors', []):
+                # keep duplicate key errors recognizable as such
+                cls = DuplicateKeyError if \
+                        error.get('code') == 11000 else WriteError
+                failed[error['index']] = cls(
+                        error.get('errmsg'), error.get('code'), error)
+            if ordered and failed:
+                # mongo stops at the first failure of an ordered write
+                for index in range(min(failed) + 1, len(operations)):
+                    failed[index] = WriteError(
+                        'Not attempted, an earlier write failed', None, {})
+
+        errors = []
+        session = current_session()
+        for index, (document, _) in enumerate(operations):
+            if index in failed:
+                errors.append((document, failed[index]))
+            else:
+                document._mark_saved()
+                # the saved document supersedes whatever was held
+                if session is not None:
+                    session.add_document(document)
+        return errors
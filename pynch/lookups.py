@@ -0,0 +1,347 @@
+"""
+Compiles lookups written against a model's fields into mongo queries.
+A lookup is a keyword argument naming a field, or a path of fields
+through embedded documents separated by `__`, optionally followed by
+an operator:
+
+    Garden.pynch.objects.filter(acres__gt=1, name__in=['Eden', 'Kew'])
+    Garden.pynch.objects.filter(flowers__size=3, flowers__name='rose')
+
+Lookups combine, by way of `Q` objects, with `&`, `|` and `~`:
+
+    Garden.pynch.objects.filter(Q(acres__lt=1) | ~Q(name__startswith='E'))
+
+Field names are translated to their `db_field`, and values to their
+mongo representation by the field they're compared with (references
+are compared by primary key, so either a document or its primary key
+will do). Names which aren't fields are passed on as they are.
+
+Translating a query is done once per model and query shape, ie the
+lookups and the way they're combined but not their values, so running
+the same query over and over only costs filling in the values.
+"""
+import re
+from bson.dbref import DBRef
+from pynch.errors import QueryException
+from pynch.fields import (ComplexField, DictField, DynamicField,
+                          DocumentField, ReferenceField, EmbeddedDocumentField)
+
+
+def comparison(operator):
+    return lambda value, convert: {operator: convert(value)}
+
+
+def each(operator):
+    return lambda values, convert: {operator: [convert(v) for v in values]}
+
+
+def pattern(template, options=None):
+    def build(value, convert):
+        condition = {'$regex': template % re.escape(value)}
+        if options:
+            condition['$options'] = options
+        return condition
+    return build
+
+
+# lookup operators, each building the condition on a field given the
+# value looked up and the field's converter
+OPERATORS = {
+    'exact': lambda value, convert: convert(value),
+    'ne': comparison('$ne'),
+    'gt': comparison('$gt'),
+    'gte': comparison('$gte'),
+    'lt': comparison('$lt'),
+    'lte': comparison('$lte'),
+    'in': each('$in'),
+    'nin': each('$nin'),
+    'all': each('$all'),
+    'size': lambda value, convert: {'$size': value},
+    'exists': lambda value, convert: {'$exists': bool(value)},
+    'regex': lambda value, convert: {'$regex': value},
+    'iregex': lambda value, convert: {'$regex': value, '$options': 'i'},
+    'contains': pattern('%s'),
+    'icontains': pattern('%s', 'i'),
+    'startswith': pattern('^%s'),
+    'istartswith': pattern('^%s', 'i'),
+    'endswith': pattern('%s$'),
+    'iendswith': pattern('%s$', 'i'),
+}
+
+# operators of raw conditions, ie `acres={'$gt': 1}`, whose operands
+# are converted
+CONVERTED = frozenset(['$eq', '$ne', '$gt', '$gte', '$lt', '$lte'])
+CONVERTED_EACH = frozenset(['$in', '$nin', '$all'])
+
+# operators looking for text within strings, their values are taken as
+# they are rather than converted
+TEXT = frozenset(['contains', 'icontains', 'startswith', 'istartswith',
+                  'endswith', 'iendswith'])
+
+
+class Q(object):
+    """
+    A query on a model's fields, which combines with other queries by
+    way of `&` (and), `|` (or) and `~` (not)
+    """
+    AND, OR = '$and', '$or'
+
+    def __init__(self, *children, **lookups):
+        self.connector = Q.AND
+        self.negated = False
+        # lookups are sorted so that their order doesn't make for
+        # another query shape
+        self.children = list(children) + sorted(lookups.items())
+
+    def _combine(self, other, connector):
+        if not isinstance(other, Q):
+            raise TypeError(other)
+        q = Q(self, other)
+        q.connector = connector
+        return q
+
+    def __and__(self, other):
+        return self._combine(other, Q.AND)
+
+    def __or__(self, other):
+        return self._combine(other, Q.OR)
+
+    def __invert__(self):
+        q = Q(self)
+        q.negated = True
+        return q
+
+    def shape(self):
+        """
+        Hashable description of the query, less the values looked up
+        """
+        return (self.connector, self.negated,
+                tuple(child.shape() if isinstance(child, Q) else child[0]
+                                            for child in self.children))
+
+    def values(self):
+        """
+        The values looked up, in the order of `shape`
+        """
+        for child in self.children:
+            if isinstance(child, Q):
+                yield from child.values()
+            else:
+                yield child[1]
+
+    def __repr__(self):
+        children = ', '.join(repr(child) for child in self.children)
+        return '%sQ(%s: %s)' % ('~' if self.negated else '',
+                                self.connector, children)
+
+
+def element(field):
+    # the field of the elements of a container (of containers)
+    while isinstance(field, ComplexField) and not isinstance(field, DictField):
+        field = field.field
+    return field
+
+
+def converter(field):
+    """
+    Returns the function converting a value compared with `field` to its
+    mongo representation
+    """
+    if isinstance(field, ReferenceField):
+        # references are looked up by the primary key of the document
+        # they point to, see `resolve`
+        def convert(value):
+            if isinstance(value, DBRef):
+                return value.id
+            if hasattr(value, 'pynch'):
+                value = value.pk
+            return field.reference.pynch.primary_key_field.to_mongo(value)
+        return convert
+
+    if isinstance(field, EmbeddedDocumentField):
+        return lambda value: value.to_mongo() if \
+                    hasattr(value, 'pynch') else value
+
+    if element(field) is not field:
+        # containers are compared either with one of their elements or
+        # as a whole, element by element
+        convert_element = converter(element(field))
+        def convert(value):
+            if isinstance(value, (list, tuple, set, frozenset)):
+                return [convert_element(x) for x in value]
+            return convert_element(value)
+        return convert
+
+    if isinstance(field, (DictField, DynamicField)):
+        return identity
+
+    def convert(value):
+        if value is None or isinstance(value, re.Pattern):
+            return value
+        return field.to_mongo(value)
+    return convert
+
+
+def identity(value):
+    return value
+
+
+def resolve(model, lookup):
+    """
+    Returns the mongo path a lookup refers to, its operator and the
+    function converting the values looked up
+    """
+    terms = lookup.split('__')
+    operator = 'exact'
+    # `current` is the (embedded) model the path is in, None once the
+    # path has gone past a field of unknown structure
+    path, current, field = [], model, None
+    for i, term in enumerate(terms):
+        found = current.pynch.fields_by_name.get(term) \
+                    if current is not None else None
+        if found is None and i > 0 and i == len(terms) - 1 and \
+                term in OPERATORS:
+            operator = term
+            break
+        if found is None:
+            if current is not None and i > 0:
+                raise QueryException(
+                    '%s has no field %s' % (current.__name__, term))
+            if isinstance(element(field), ReferenceField):
+                raise QueryException('Cannot query across references (%s), '
+                                     'see `pynch.query.search`' % lookup)
+            # not a field, or within a field of unknown structure (ie
+            # a dict field), passed on as is
+            path.append(term)
+            current = field = None
+            continue
+
+        field = found
+        path.append(field.db_field or field.name)
+        inner = element(field)
+        if isinstance(inner, DocumentField) and \
+                isinstance(inner.reference, str):
+            inner.rebind()
+        current = inner.reference if \
+                    isinstance(inner, EmbeddedDocumentField) else None
+
+    if field is None:
+        return '.'.join(path), operator, identity
+    if isinstance(element(field), ReferenceField) and \
+            operator not in ('exists', 'size'):
+        # dbrefs are compared by id, wherever they point to
+        path.append('$id')
+    return '.'.join(path), operator, converter(field)
+
+
+def is_condition(value):
+    return isinstance(value, dict) and bool(value) and \
+            all(key.startswith('$') for key in value)
+
+
+def compile_lookup(model, lookup):
+    """
+    Returns the function building the (path, condition) of a lookup,
+    given the value looked up
+    """
+    if lookup in ('$and', '$or', '$nor'):
+        # raw boolean operators, ie from `find({'$or': [...]})`
+        return lambda queries: (lookup, [to_query(model, query)
+                                                for query in queries])
+
+    path, operator, convert = resolve(model, lookup)
+    build = OPERATORS[operator]
+    def compiled(value):
+        try:
+            return path, condition(value)
+        except (TypeError, ValueError) as e:
+            # ie a value the field can't convert
+            raise QueryException('Bad value for %s, %r (%s)'
+                                 % (lookup, value, e))
+
+    def condition(value):
+        if operator == 'exact' and is_condition(value):
+            # a raw condition, ie `acres={'$gt': 1}`
+            raw = {}
+            for op, operand in value.items():
+                if op in CONVERTED:
+                    operand = convert(operand)
+                elif op in CONVERTED_EACH:
+                    operand = [convert(x) for x in operand]
+                raw[op] = operand
+            return raw
+        if operator in TEXT and not isinstance(value, str):
+            raise QueryException('%s looks for text, not %r' % (lookup, value))
+        return build(value, convert)
+    return compiled
+
+
+def conjunction(queries):
+    """
+    Combines queries which must all hold, into a single query when their
+    conditions are on different fields (or are mergeable conditions on
+    the same field)
+    """
+    combined = {}
+    for query in queries:
+        for path, condition in query.items():
+            if path not in combined:
+                combined[path] = condition
+            elif is_condition(combined[path]) and is_condition(condition) \
+                    and not set(combined[path]) & set(condition):
+                combined[path] = dict(combined[path], **condition)
+            else:
+                return {'$and': list(queries)}
+    return combined
+
+
+def compile_shape(model, shape):
+    connector, negated, children = shape
+    parts = []
+    for child in children:
+        if isinstance(child, tuple):
+            parts.append(compile_shape(model, child))
+        else:
+            parts.append(leaf(compile_lookup(model, child)))
+
+    def build(values):
+        queries = [part(values) for part in parts]
+        if connector == Q.OR and len(queries) > 1:
+            query = {'$or': queries}
+        else:
+            query = conjunction(queries)
+        return {'$nor': [query]} if negated else query
+    return build
+
+
+def leaf(compiled):
+    return lambda values: dict([compiled(next(values))])
+
+
+# compiled query shapes kept per model, beyond which the cache starts
+# over (hot queries are compiled again soon enough)
+MAX_SHAPES = 1000
+
+
+def compile_query(model, q):
+    """
+    Returns the mongo query of a `Q` object, on the fields of `model` or,
+    when it's None, on raw field names
+    """
+    if model is None:
+        return compile_shape(None, q.shape())(iter(q.values()))
+    shapes = model.pynch.query_shapes
+    shape = q.shape()
+    build = shapes.get(shape)
+    if build is None:
+        if len(shapes) >= MAX_SHAPES:
+            shapes.clear()
+        build = shapes[shape] = compile_shape(model, shape)
+    return build(iter(q.values()))
+
+
+def to_query(model, dictionary):
+    """
+    Returns the mongo query of lookups given as a dictionary
+    """
+    return compile_query(model, Q(**dictionary))
@@ -0,0 +1,727 @@
+"""
+Mongo's query, projection, sort and update semantics applied to plain
+python documents, which is what the in memory collections of `pynch.db`
+are made of. Only the operators pynch (and its users, by and large)
+rely on are supported, anything else raises NotImplementedError.
+"""
+import datetime
+import functools
+import operator
+import re
+from bson.dbref import DBRef
+from bson.objectid import ObjectId
+
+
+def clone(value):
+    """
+    Copies the containers of a document, leaving the (immutable) values
+    they hold as they are
+    """
+    if isinstance(value, dict):
+        return dict((k, clone(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return [clone(v) for v in value]
+    return value
+
+
+def is_operator(condition):
+    return isinstance(condition, dict) and bool(condition) and \
+            all(key.startswith('$') for key in condition)
+
+
+def values_at(value, parts):
+    """
+    Returns the values found at a (split up) dotted path, which can run
+    through embedded documents and arrays
+    """
+    if not parts:
+        return [value]
+    if isinstance(value, DBRef):
+        # ie `gardener.$id`
+        value = value.as_doc()
+    head, rest = parts[0], parts[1:]
+    if isinstance(value, dict):
+        return values_at(value[head], rest) if head in value else []
+    if isinstance(value, list):
+        results = []
+        if head.isdigit() and int(head) < len(value):
+            results.extend(values_at(value[int(head)], rest))
+        # `a.b` reaches into every document (or dbref) of the array `a`
+        for item in value:
+            if isinstance(item, (dict, DBRef)):
+                results.extend(values_at(item, parts))
+        return results
+    return []
+
+
+def expand(values):
+    """
+    Values along with the elements of those which are arrays, as
+    conditions on an array field hold when they hold for any element
+    """
+    expanded = []
+    for value in values:
+        expanded.append(value)
+        if isinstance(value, list):
+            expanded.extend(value)
+    return expanded
+
+
+# the order in which mongo sorts values of different types
+def type_rank(value):
+    if value is None:
+        return 1
+    if isinstance(value, bool):
+        return 8
+    if isinstance(value, (int, float)):
+        return 2
+    if isinstance(value, str):
+        return 3
+    if isinstance(value, (dict, DBRef)):
+        return 4
+    if isinstance(value, list):
+        return 5
+    if isinstance(value, bytes):
+        return 6
+    if isinstance(value, ObjectId):
+        return 7
+    if isinstance(value, datetime.datetime):
+        return 9
+    if isinstance(value, re.Pattern):
+        return 11
+    return 10
+
+
+def sort_key(value):
+    rank = type_rank(value)
+    if isinstance(value, dict):
+        return (rank, tuple((k, sort_key(v)) for k, v in value.items()))
+    if isinstance(value, DBRef):
+        return (rank, (value.collection, sort_key(value.id)))
+    if isinstance(value, list):
+        return (rank, tuple(sort_key(v) for v in value))
+    if value is None or isinstance(value, re.Pattern):
+        return (rank, 0)
+    return (rank, value)
+
+
+def compare(value, other):
+    """
+    Returns -1, 0 or 1, or None for values of types that don't compare
+    (comparison operators only ever match values of the same type)
+    """
+    if type_rank(value) != type_rank(other) or value is None:
+        return None
+    value, other = sort_key(value), sort_key(other)
+    return (value > other) - (value < other)
+
+
+def equals(value, condition):
+    if type(value) is type(condition):
+        return value == condition
+    if isinstance(condition, re.Pattern):
+        return isinstance(value, str) and bool(condition.search(value))
+    if type_rank(value) != type_rank(condition):
+        return False
+    return value == condition
+
+
+def equals_any(values, condition):
+    if condition is None and not values:
+        # missing fields equal null
+        return True
+    for value in values:
+        if equals(value, condition) or (isinstance(value, list) and
+                any(equals(item, condition) for item in value)):
+            return True
+    return False
+
+
+def regex(pattern, options=''):
+    if isinstance(pattern, re.Pattern):
+        return pattern
+    flags = 0
+    for option, flag in (('i', re.I), ('m', re.M), ('s', re.S), ('x', re.X)):
+        if option in options:
+            flags |= flag
+    return re.compile(pattern, flags)
+
+
+def match_condition(values, condition):
+    """
+    Whether the values found at a path satisfy a condition, either a
+    value or a document of operators
+    """
+    if not is_operator(condition):
+        return equals_any(values, condition)
+
+    for op, arg in condition.items():
+        if op == '$eq':
+            matched = equals_any(values, arg)
+        elif op == '$ne':
+            matched = not equals_any(values, arg)
+        elif op in ('$gt', '$gte', '$lt', '$lte'):
+            accept = {'$gt': (1,), '$gte': (0, 1),
+                      '$lt': (-1,), '$lte': (-1, 0)}[op]
+            matched = any(compare(value, arg) in accept
+                                for value in expand(values))
+        elif op == '$in':
+            matched = any(equals_any(values, x) for x in arg)
+        elif op == '$nin':
+            matched = not any(equals_any(values, x) for x in arg)
+        elif op == '$exists':
+            matched = bool(values) == bool(arg)
+        elif op == '$all':
+            matched = bool(arg) and all(equals_any(values, x) for x in arg)
+        elif op == '$size':
+            matched = any(isinstance(value, list) and len(value) == arg
+                                for value in values)
+        elif op == '$elemMatch':
+            matched = any(isinstance(value, list) and
+                          any(match_element(item, arg) for item in value)
+                                for value in values)
+        elif op == '$not':
+            matched = not match_condition(values, arg)
+        elif op == '$regex':
+            pattern = regex(arg, condition.get('$options', ''))
+            matched = any(isinstance(value, str) and pattern.search(value)
+                                for value in expand(values))
+        elif op == '$options':
+            continue
+        else:
+            raise NotImplementedError(
+                '%s is not supported by the in memory store' % op)
+        if not matched:
+            return False
+    return True
+
+
+def match_element(item, condition):
+    if is_operator(condition):
+        return match_condition([item], condition)
+    return isinstance(item, dict) and match(item, condition)
+
+
+def match(document, query):
+    """
+    Whether the document matches the query
+    """
+    for key, condition in (query or {}).items():
+        if key == '$and':
+            matched = all(match(document, q) for q in condition)
+        elif key == '$or':
+            matched = any(match(document, q) for q in condition)
+        elif key == '$nor':
+            matched = not any(match(document, q) for q in condition)
+        elif key.startswith('$'):
+            raise NotImplementedError(
+                '%s is not supported by the in memory store' % key)
+        elif '.' not in key:
+            values = [document[key]] if key in document else []
+            matched = match_condition(values, condition)
+        else:
+            matched = match_condition(
+                        values_at(document, key.split('.')), condition)
+        if not matched:
+            return False
+    return True
+
+
+def path_tree(paths):
+    tree = {}
+    for path in paths:
+        node, parts = tree, path.split('.')
+        for part in parts[:-1]:
+            child = node.setdefault(part, {})
+            if child is True:
+                break
+            node = child
+        else:
+            node[parts[-1]] = True
+    return tree
+
+
+def include(value, tree):
+    result = {}
+    for key, subtree in tree.items():
+        if key not in value:
+            continue
+        x = value[key]
+        if subtree is True:
+            result[key] = clone(x)
+        elif isinstance(x, dict):
+            result[key] = include(x, subtree)
+        elif isinstance(x, list):
+            result[key] = [include(item, subtree)
+                                for item in x if isinstance(item, dict)]
+    return result
+
+
+def exclude(value, tree):
+    for key, subtree in tree.items():
+        if key not in value:
+            continue
+        if subtree is True:
+            del value[key]
+        elif isinstance(value[key], dict):
+            exclude(value[key], subtree)
+        elif isinstance(value[key], list):
+            for item in value[key]:
+                if isinstance(item, dict):
+                    exclude(item, subtree)
+
+
+def project(document, projection):
+    """
+    Returns a copy of the document, restricted to a projection
+    """
+    if not projection:
+        return clone(document)
+    if not isinstance(projection, dict):
+        projection = dict((fieldname, 1) for fieldname in projection)
+
+    paths = dict((k, v) for k, v in projection.items() if k != '_id')
+    if any(paths.values()):
+        result = include(document, path_tree(paths))
+        if projection.get('_id', 1) and '_id' in document:
+            result['_id'] = document['_id']
+        return result
+
+    result = clone(document)
+    exclude(result, path_tree(paths))
+    if not projection.get('_id', 1):
+        result.pop('_id', None)
+    return result
+
+
+def sort_value(document, path, direction):
+    values = expand(values_at(document, path.split('.')))
+    # arrays sort by their smallest element when ascending, largest
+    # when descending
+    values = [v for v in values if not isinstance(v, list)] or [None]
+    pick = min if direction > 0 else max
+    return sort_key(pick(values, key=sort_key))
+
+
+def sort(documents, spec):
+    """
+    Sorts documents in place, given a list of (path, direction)
+    """
+    for path, direction in reversed(list(spec)):
+        documents.sort(key=lambda d: sort_value(d, path, direction),
+                       reverse=direction < 0)
+    return documents
+
+
+def walk(document, parts, create=False):
+    """
+    Returns the container holding the last part of a path, or None
+    """
+    node = document
+    for part in parts[:-1]:
+        if isinstance(node, list):
+            if not part.isdigit() or int(part) >= len(node):
+                return None
+            node = node[int(part)]
+        elif isinstance(node, dict):
+            if part not in node:
+                if not create:
+                    return None
+                node[part] = {}
+            node = node[part]
+        else:
+            return None
+    return node if isinstance(node, (dict, list)) else None
+
+
+def get_path(document, parts, default=None):
+    node = walk(document, parts)
+    key = parts[-1]
+    if isinstance(node, dict):
+        return node.get(key, default)
+    if isinstance(node, list) and key.isdigit() and int(key) < len(node):
+        return node[int(key)]
+    return default
+
+
+def set_path(document, parts, value):
+    node = walk(document, parts, create=True)
+    key = parts[-1]
+    if isinstance(node, list):
+        node[int(key)] = value
+    elif node is not None:
+        node[key] = value
+
+
+def unset_path(document, parts):
+    node = walk(document, parts)
+    key = parts[-1]
+    if isinstance(node, dict):
+        node.pop(key, None)
+    elif isinstance(node, list) and key.isdigit() and int(key) < len(node):
+        node[int(key)] = None
+
+
+def each(arg):
+    if isinstance(arg, dict) and '$each' in arg:
+        return list(arg['$each'])
+    return [arg]
+
+
+def update(document, spec, inserting=False):
+    """
+    Applies the update operators of `spec` to the document, in place
+    """
+    for op, changes in spec.items():
+        for path, arg in changes.items():
+            parts = path.split('.')
+            current = get_path(document, parts)
+            if op == '$set' or (op == '$setOnInsert' and inserting):
+                set_path(document, parts, clone(arg))
+            elif op == '$setOnInsert':
+                continue
+            elif op == '$unset':
+                unset_path(document, parts)
+            elif op == '$inc':
+                set_path(document, parts, (current or 0) + arg)
+            elif op == '$mul':
+                set_path(document, parts, (current or 0) * arg)
+            elif op in ('$min', '$max'):
+                order = compare(arg, current) if current is not None else None
+                if current is None or order == (-1 if op == '$min' else 1):
+                    set_path(document, parts, clone(arg))
+            elif op in ('$push', '$addToSet'):
+                if current is None:
+                    current = []
+                    set_path(document, parts, current)
+                for x in each(arg):
+                    if op == '$push' or not any(equals(y, x) for y in current):
+                        current.append(clone(x))
+            elif op in ('$pull', '$pullAll'):
+                if isinstance(current, list):
+                    if op == '$pullAll':
+                        kept = [y for y in current
+                                    if not any(equals(y, x) for x in arg)]
+                    elif is_operator(arg) or isinstance(arg, dict):
+                        kept = [y for y in current
+                                    if not match_element(y, arg)]
+                    else:
+                        kept = [y for y in current if not equals(y, arg)]
+                    current[:] = kept
+            elif op == '$pop':
+                if isinstance(current, list) and current:
+                    current.pop(0 if arg < 0 else -1)
+            elif op == '$rename':
+                if current is not None:
+                    unset_path(document, parts)
+                    set_path(document, arg.split('.'), current)
+            else:
+                raise NotImplementedError(
+                    '%s is not supported by the in memory store' % op)
+    return document
+
+
+def upserted(query):
+    """
+    The document an upsert starts from, ie the equality conditions of
+    its query
+    """
+    document = {}
+    for key, condition in (query or {}).items():
+        if key == '$and':
+            for q in condition:
+                document.update(upserted(q))
+        elif not key.startswith('$'):
+            if is_operator(condition):
+                if '$eq' in condition:
+                    set_path(document, key.split('.'), clone(condition['$eq']))
+            else:
+                set_path(document, key.split('.'), clone(condition))
+    return document
+
+
+class Missing(object):
+    # the value of a path which doesn't lead anywhere
+    def __repr__(self):
+        return 'MISSING'
+
+MISSING = Missing()
+
+
+def resolve(value, parts):
+    """
+    The value of a field path within an expression: paths through arrays
+    of documents collect the values found in each of them
+    """
+    for i, part in enumerate(parts):
+        if isinstance(value, list):
+            found = [resolve(item, parts[i:]) for item in value
+                                                if isinstance(item, dict)]
+            return [x for x in found if x is not MISSING]
+        if not isinstance(value, dict) or part not in value:
+            return MISSING
+        value = value[part]
+    return value
+
+
+def evaluate(expression, document, variables=None):
+    """
+    Evaluates an aggregation expression against a document
+    """
+    variables = variables or {}
+    if isinstance(expression, str) and expression.startswith('$$'):
+        name, _, path = expression[2:].partition('.')
+        value = document if name in ('ROOT', 'CURRENT') else variables[name]
+        return resolve(value, path.split('.')) if path else value
+    if isinstance(expression, str) and expression.startswith('$'):
+        return resolve(document, expression[1:].split('.'))
+    if isinstance(expression, list):
+        return [evaluate(x, document, variables) for x in expression]
+    if not isinstance(expression, dict):
+        return expression
+    if not is_operator(expression):
+        return dict((k, evaluate(v, document, variables))
+                                for k, v in expression.items())
+
+    (op, arg), = expression.items()
+    if op == '$literal':
+        return arg
+    if op in ('$map', '$filter'):
+        name = arg.get('as', 'this')
+        items = evaluate(arg['input'], document, variables)
+        if not isinstance(items, list):
+            return None
+        results = []
+        for item in items:
+            scope = dict(variables, **{name: item})
+            if op == '$map':
+                results.append(evaluate(arg['in'], document, scope))
+            elif truthy(evaluate(arg['cond'], document, scope)):
+                results.append(item)
+        return results
+    if op == '$cond':
+        if isinstance(arg, dict):
+            arg = [arg['if'], arg['then'], arg['else']]
+        branch = arg[1] if truthy(evaluate(arg[0], document, variables)) \
+                        else arg[2]
+        return evaluate(branch, document, variables)
+    if op == '$and':
+        return all(truthy(evaluate(x, document, variables)) for x in arg)
+    if op == '$or':
+        return any(truthy(evaluate(x, document, variables)) for x in arg)
+
+    args = evaluate(arg, document, variables)
+    if not isinstance(arg, list):
+        args = [args]
+    args = [None if x is MISSING else x for x in args]
+    return OPERATORS[op](*args) if op in OPERATORS else unsupported(op)
+
+
+def unsupported(op):
+    raise NotImplementedError('%s is not supported by the in memory store' % op)
+
+
+def truthy(value):
+    return value not in (None, False, 0, MISSING)
+
+
+def object_to_array(value):
+    if isinstance(value, DBRef):
+        value = value.as_doc()
+    if value is None:
+        return None
+    return [{'k': k, 'v': v} for k, v in value.items()]
+
+
+def array_elem_at(array, index):
+    if not isinstance(array, list) or not -len(array) <= index < len(array):
+        return MISSING
+    return array[index]
+
+
+def total(*values):
+    if len(values) == 1 and isinstance(values[0], list):
+        values = values[0]
+    return sum(v for v in values if isinstance(v, (int, float))
+                                    and not isinstance(v, bool))
+
+
+OPERATORS = {
+    '$objectToArray': object_to_array,
+    '$arrayElemAt': array_elem_at,
+    '$size': len,
+    '$ifNull': lambda *values: next(
+                    (v for v in values if v is not None), None),
+    '$not': lambda value: not truthy(value),
+    '$in': lambda value, array: any(equals(value, x) for x in array),
+    '$eq': lambda a, b: sort_key(a) == sort_key(b),
+    '$ne': lambda a, b: sort_key(a) != sort_key(b),
+    '$gt': lambda a, b: sort_key(a) > sort_key(b),
+    '$gte': lambda a, b: sort_key(a) >= sort_key(b),
+    '$lt': lambda a, b: sort_key(a) < sort_key(b),
+    '$lte': lambda a, b: sort_key(a) <= sort_key(b),
+    '$add': total,
+    '$sum': total,
+    '$subtract': lambda a, b: None if None in (a, b) else a - b,
+    '$multiply': lambda *values: None if None in values else
+                    functools.reduce(operator.mul, values, 1),
+    '$divide': lambda a, b: None if None in (a, b) else a / b,
+    '$concat': lambda *values: None if None in values else ''.join(values),
+    '$toLower': lambda value: (value or '').lower(),
+    '$toUpper': lambda value: (value or '').upper(),
+}
+
+
+def accumulate(op, values):
+    """
+    The result of a `$group` accumulator over the values of a group
+    """
+    present = [v for v in values if v is not MISSING]
+    if op == '$sum':
+        return total(present)
+    if op == '$avg':
+        numbers = [v for v in present if isinstance(v, (int, float))
+                                        and not isinstance(v, bool)]
+        return sum(numbers) / float(len(numbers)) if numbers else None
+    if op in ('$min', '$max'):
+        present = [v for v in present if v is not None]
+        if not present:
+            return None
+        return (min if op == '$min' else max)(present, key=sort_key)
+    if op == '$push':
+        return present
+    if op == '$addToSet':
+        distinct = []
+        for v in present:
+            if not any(equals(v, x) for x in distinct):
+                distinct.append(v)
+        return distinct
+    if op == '$first':
+        return values[0] if values and values[0] is not MISSING else None
+    if op == '$last':
+        return values[-1] if values and values[-1] is not MISSING else None
+    unsupported(op)
+
+
+def group(documents, spec):
+    groups, keys = {}, []
+    for document in documents:
+        key = evaluate(spec['_id'], document)
+        key = None if key is MISSING else key
+        frozen = repr(sort_key(key))
+        if frozen not in groups:
+            groups[frozen] = (key, [])
+            keys.append(frozen)
+        groups[frozen][1].append(document)
+
+    results = []
+    for frozen in keys:
+        key, members = groups[frozen]
+        result = {'_id': key}
+        for name, accumulator in spec.items():
+            if name == '_id':
+                continue
+            (op, expression), = accumulator.items()
+            result[name] = accumulate(
+                op, [evaluate(expression, member) for member in members])
+        results.append(result)
+    return results
+
+
+def project_stage(document, spec):
+    if all(v in (0, 1, True, False) for v in spec.values()):
+        return project(document, spec)
+    result = {}
+    if spec.get('_id', 1) and '_id' in document:
+        result['_id'] = document['_id']
+    for path, expression in spec.items():
+        if expression in (0, False):
+            continue
+        if expression in (1, True):
+            value = resolve(document, path.split('.'))
+        else:
+            value = evaluate(expression, document)
+        if value is not MISSING:
+            set_path(result, path.split('.'), clone(value))
+    return result
+
+
+def unwind(documents, spec):
+    if isinstance(spec, str):
+        spec = {'path': spec}
+    path = spec['path'][1:].split('.')
+    preserve = spec.get('preserveNullAndEmptyArrays', False)
+    index = spec.get('includeArrayIndex')
+    results = []
+    for document in documents:
+        value = resolve(document, path)
+        if isinstance(value, list) and value:
+            for i, item in enumerate(value):
+                unwound = clone(document)
+                set_path(unwound, path, clone(item))
+                if index:
+                    unwound[index] = i
+                results.append(unwound)
+        elif value not in (MISSING, None) and not isinstance(value, list):
+            results.append(document)
+        elif preserve:
+            results.append(document)
+    return results
+
+
+def lookup(documents, spec, collection):
+    """
+    Joins the documents of `collection` whose `foreignField` equals the
+    `localField` of each document (or any of its values, for arrays)
+    """
+    foreign = collection(spec['from'])
+    for document in documents:
+        local = expand(values_at(document, spec['localField'].split('.')))
+        local = [v for v in local if not isinstance(v, list)] or [None]
+        joined = foreign.find({spec['foreignField']: {'$in': local}})
+        set_path(document, spec['as'].split('.'), list(joined))
+    return documents
+
+
+def aggregate(documents, pipeline, collection):
+    """
+    Runs an aggregation pipeline over a list of documents, `collection`
+    returns the collection `$lookup` stages join with given its name
+    """
+    documents = [clone(document) for document in documents]
+    for stage in pipeline:
+        (op, spec), = stage.items()
+        if op == '$match':
+            documents = [d for d in documents if match(d, spec)]
+        elif op == '$project':
+            documents = [project_stage(d, spec) for d in documents]
+        elif op in ('$addFields', '$set'):
+            for document in documents:
+                for path, expression in spec.items():
+                    value = evaluate(expression, document)
+                    if value is not MISSING:
+                        set_path(document, path.split('.'), value)
+        elif op == '$unset':
+            spec = [spec] if isinstance(spec, str) else spec
+            documents = [project(d, dict((path, 0) for path in spec))
+                                                        for d in documents]
+        elif op in ('$replaceRoot', '$replaceWith'):
+            root = spec['newRoot'] if op == '$replaceRoot' else spec
+            documents = [evaluate(root, d) for d in documents]
+        elif op == '$unwind':
+            documents = unwind(documents, spec)
+        elif op == '$lookup':
+            documents = lookup(documents, spec, collection)
+        elif op == '$group':
+            documents = group(documents, spec)
+        elif op == '$sort':
+            documents = sort(documents, list(spec.items()))
+        elif op == '$skip':
+            documents = documents[spec:]
+        elif op == '$limit':
+            documents = documents[:spec]
+        elif op == '$count':
+            documents = [{spec: len(documents)}] if documents else []
+        else:
+            unsupported(op)
+    return documents
@@ -1,8 +1,16 @@
+import copy
 from pynch.db import DB
 from pynch.errors import InheritanceException, DocumentValidationException
-from pynch.util import MultiDict
+from pynch.util import MultiDict, register_model
 from pynch.fields import Field, PrimaryKey, check_fields
-from pynch.info import InformationDescriptor
+from pynch.info import InformationDescriptor, UnitOfWork
+from pynch.session import current_session
+from pymongo import ReplaceOne, UpdateOne
+
+
+# shared by every document which has no deferred fields, empty
+# frozensets aren't interned
+NOTHING_DEFERRED = frozenset()
 
 
 class ModelMetaclass(type):
@@ -22,12 +30,15 @@ class ModelMetaclass(type):
 
         # default _meta
         _meta = {'index': [], 'max_size': 10000000, 'database': DB(),
-                 'write_concern': 1, 'auto_index': False}
+                 'write_concern': 1, 'auto_index': False, 'compact': False}
 
         # pull out _meta modifier, then merge with that of current class
         _meta.update(base_attrs.pop('_meta', {}))
         _meta.update(attrs.pop('_meta', {}))
 
+        # slots belong to the class which declares them
+        base_attrs.pop('__slots__', None)
+
         # initialize namespace with newly updated _meta
         namespace = {'_meta': _meta}
 
@@ -36,9 +47,16 @@ class ModelMetaclass(type):
         namespace.update(base_attrs)
         namespace.update(attrs)
 
+        if _meta['compact'] and '__slots__' not in attrs:
+            meta.make_compact(bases, namespace)
+
         model = super(ModelMetaclass, meta).__new__(
                             meta, name, bases, namespace)
 
+        # register the model before attaching its fields so that string
+        # references (including those to the model itself) can be bound
+        register_model(model)
+
         # information descriptor allows class level access to
         # orm functionality
         model.pynch = InformationDescriptor(model)
@@ -50,12 +68,6 @@ class ModelMetaclass(type):
                 if field.primary_key or fieldname == '_id':
                     model._id = model.pynch.primary_key_field = field
 
-                # fields named `_id` are automatically indexed by
-                # mongo, so skip them
-                if fieldname != '_id' and namespace['_meta']['auto_index']:
-                    model.pynch.collection.create_index(
-                            field.db_field or fieldname, unique=field.unique)
-
                 # Necessary so that field descriptors can determine
                 # what classes they are attached to.
                 field.set(fieldname, model)
@@ -64,8 +76,65 @@ class ModelMetaclass(type):
             model._id = PrimaryKey()
             model._id.set('_id', model)
             model.pynch.primary_key_field = model._id
+
+        # now that all the fields are attached, precompute the field
+        # registry so documents never have to introspect their class
+        model.pynch.build_field_registry()
         return model
 
+    @staticmethod
+    def make_compact(bases, namespace):
+        """
+        Compact models keep their documents' field values in slots named
+        `_pynch_<field name>` rather than in a per document __dict__,
+        which is most of the memory a small document takes up.
+        """
+        base = bases[0] if bases else object
+        # a document with a __dict__ wouldn't be any smaller
+        if base.__dictoffset__:
+            raise InheritanceException(
+                'Compact models can only inherit from compact models')
+
+        slots = []
+        if not base._meta['compact']:
+            # the bookkeeping attributes of the document (see `Model`)
+            slots.extend(['_changes', '_persisted', '_deferred',
+                          '__weakref__'])
+            # fields are bound to the slots of their model, so those
+            # inherited from a regular model can't be shared with it
+            for name, value in base.__dict__.items():
+                if isinstance(value, Field) and namespace[name] is value:
+                    namespace[name] = copy.copy(value)
+
+        names = [name for name, value in namespace.items()
+                        if isinstance(value, Field)]
+        # models without a primary key are given one, see below
+        if not any(namespace[name].primary_key or name == '_id'
+                                                    for name in names):
+            names.append('_id')
+        slots.extend('_pynch_' + name for name in names
+                            if not hasattr(base, '_pynch_' + name))
+        namespace['__slots__'] = tuple(slots)
+
+    def __setattr__(model, name, value):
+        replaces_field = isinstance(model.__dict__.get(name), Field)
+        super(ModelMetaclass, model).__setattr__(name, value)
+        if isinstance(value, Field) or replaces_field:
+            model._invalidate_fields()
+
+    def __delattr__(model, name):
+        replaces_field = isinstance(model.__dict__.get(name), Field)
+        super(ModelMetaclass, model).__delattr__(name)
+        if replaces_field:
+            model._invalidate_fields()
+
+    def _invalidate_fields(model):
+        # the namespace is seeded with the base's descriptor, so make
+        # sure the model has been given its own before touching it
+        pynch = model.__dict__.get('pynch')
+        if pynch is not None and pynch.model is model:
+            pynch.invalidate_fields()
+
 
 class Model(metaclass=ModelMetaclass):
     """
@@ -75,10 +144,26 @@ class Model(metaclass=ModelMetaclass):
     bases.  In other words, _meta attributes "stack".
 
     Can upcast or downcast types but type enforcement is weak atm
+
+    Models holding a great many documents in memory can set
+    `_meta['compact']`, in which case field values are stored in slots.
+    Compact documents have no __dict__, so they can't be given
+    attributes other than their fields.
     """
+    __slots__ = ()
+
     def __init__(self, *castable, **values):
         super(Model, self).__init__()
 
+        # changes made since the document was loaded or saved, keyed
+        # by field name, see `_mark_changed`
+        self._changes = {}
+        # whether the document is known to exist in the database
+        self._persisted = False
+        # names of the fields left out when the document was loaded,
+        # which are fetched the first time one of them is accessed
+        self._deferred = NOTHING_DEFERRED
+
         # collect all validation failures
         exceptions = MultiDict()
 
@@ -105,7 +190,28 @@ class Model(metaclass=ModelMetaclass):
             # of castable's model
             assert (isinstance(castable, type(self)) or \
                     isinstance(self, type(castable)))
-            self.__dict__.update(castable.__dict__)
+            if hasattr(self, '__dict__') and hasattr(castable, '__dict__'):
+                self.__dict__.update(castable.__dict__)
+            else:
+                self.copy_fields(castable)
+            self._changes = dict(castable._changes)
+
+    def copy_fields(self, document):
+        """
+        Copies the values stored on `document` to the fields of the
+        same name, and the document's bookkeeping along with them
+        """
+        fields_by_name = self.pynch.fields_by_name
+        for field in document.pynch.fields:
+            own = fields_by_name.get(field.name)
+            try:
+                value = field.stored(document)
+            except KeyError:
+                continue
+            if own is not None:
+                own.store(self, value)
+        self._persisted = document._persisted
+        self._deferred = document._deferred
 
     def __eq__(self, document):
         """
@@ -131,13 +237,38 @@ class Model(metaclass=ModelMetaclass):
         """
         Finds the model's primary key, and sets one if one not already set.
         """
-        primary_key_field = self.pynch.primary_key_field
-        return self.__dict__.setdefault(primary_key_field.name, self._id)
+        # `_id` is always the primary key field, whatever its name
+        return self._id
+
+    @classmethod
+    def to_python(cls, mongo, deferred=()):
+        """
+        Builds a document from its mongo representation. The fields named
+        in `deferred` are left out, to be fetched when first accessed.
+        """
+        return cls._from_mongo(mongo, deferred)
 
     @classmethod
-    def to_python(cls, mongo):
-        python_fields = {}
+    def _from_mongo(cls, mongo, deferred=()):
+        """
+        Trusted counterpart of the constructor for documents read from
+        the database: values are decoded straight into the document's
+        __dict__ without being validated again.
+        """
+        document = cls.__new__(cls)
+        # what was just loaded is, by definition, what's in the db
+        document._changes = {}
+        document._persisted = True
+        document._deferred = \
+            frozenset(deferred) if deferred else NOTHING_DEFERRED
+
+        if not deferred:
+            cls.pynch.codec.load(document, mongo)
+            return document
+
         for field in cls.pynch.fields:
+            if field.name in deferred:
+                continue
             # rememeber mongo info is stored with key `field.db_field`
             # if it is different from `field.name`
             fieldname = field.db_field or field.name
@@ -146,19 +277,45 @@ class Model(metaclass=ModelMetaclass):
             mongo_value = mongo[fieldname] if \
                         fieldname in mongo else field.default
             # (secretly) traverse the document hierarchy top down
-            python_fields[field.name] = field.to_python(mongo_value)
-        # cast the resulting dict to this particular model type
-        return cls(**python_fields)
+            value = field.to_python(mongo_value)
+            if value is not None:
+                field.fill(document, value)
+        return document
+
+    def _loaded_fields(self):
+        """
+        The model's fields, less those deferred and not yet loaded
+        """
+        fields = self.pynch.fields
+        if self._deferred:
+            deferred = self._deferred
+            return tuple(f for f in fields if f.name not in deferred)
+        return fields
+
+    def _load_deferred(self):
+        """
+        Fetches all the deferred fields in a single round trip
+        """
+        deferred, self._deferred = self._deferred, NOTHING_DEFERRED
+        fields = [self.pynch.fields_by_name[name] for name in deferred]
+        projection = dict((field.db_field or field.name, 1) for field in fields)
+
+        pk_field = self.pynch.primary_key_field
+        mongo = self.pynch.collection.find_one(
+                    {'_id': pk_field.to_mongo(self.pk)}, projection) or {}
+
+        for field in fields:
+            fieldname = field.db_field or field.name
+            mongo_value = mongo[fieldname] if \
+                        fieldname in mongo else field.default
+            value = field.to_python(mongo_value)
+            # loading a field doesn't count as changing it
+            if value is not None:
+                field.fill(self, value)
 
     def to_mongo(self):
-        # returns tuples with value (field name, mongo value)
-        def field_to_mongo_tuple(field):
-            attr = getattr(self, field.name, None)
-            return (field.db_field or field.name, field.to_mongo(attr))
-        # collect mongo tuples into a dictionary
-        mongo = dict(field_to_mongo_tuple(field) \
-                                for field in self.pynch.fields)
-        return mongo
+        # see `pynch.codec`
+        return self.pynch.codec.to_mongo(self)
 
     def validate(self):
         assert self.pk, 'Document is missing a primary key'
@@ -175,31 +332,147 @@ class Model(metaclass=ModelMetaclass):
         raise DocumentValidationException(
             'Document failed to validate', exceptions=exceptions)
 
-    def save(self, **kwargs):
-        # start at the top of the hierarchy and work your way down
-        document = self.validate()
-
-        def do_save():
-            # loop through the fields creating tuples that can be
-            # used to construct a dictionary
-            for field in self.pynch.fields:
-                # remember that defining a field on a document is
-                # not the same as the field value being set
-                attr = getattr(self, field.name, None)
-                yield (field.db_field or field.name, field.to_save(attr))
-
-        # build a mongo compatible dictionary
-        mongo = dict(do_save())
+    def _mark_changed(self, name, appended=None):
+        """
+        Records that a field has changed. `appended` holds the items
+        appended to a list field, which can be sent with a `$push`
+        rather than rewriting the whole list, as long as no other
+        change has been made to the field since the last save.
+        """
+        # a deferred field which is overwritten needn't be loaded anymore
+        if name in self._deferred:
+            self._deferred = self._deferred - {name}
+
+        changes = self._changes
+        if appended is None:
+            changes[name] = None
+        elif name not in changes:
+            changes[name] = list(appended)
+        elif changes[name] is not None:
+            changes[name].extend(appended)
+
+    def _is_dirty(self):
+        if self._changes:
+            return True
+        for field in self._loaded_fields():
+            value = getattr(self, field.name, None)
+            if any(doc._is_dirty() for doc in field.embedded(value)):
+                return True
+        return False
+
+    def _mark_saved(self):
+        self._changes.clear()
+        self._persisted = True
+        for field in self._loaded_fields():
+            for document in field.embedded(getattr(self, field.name, None)):
+                document._mark_saved()
+
+    def _update_spec(self, mongo):
+        """
+        Builds the `$set`, `$unset` and `$push` operations which bring
+        the stored document up to date with this one, given the
+        document's full `mongo` representation.
+        """
+        update = {}
+        for field in self._loaded_fields():
+            name = field.name
+            if name in self._changes:
+                appended = self._changes[name]
+            else:
+                # changes to embedded documents rewrite the whole field
+                value = getattr(self, name, None)
+                if not any(doc._is_dirty() for doc in field.embedded(value)):
+                    continue
+                appended = None
+
+            fieldname = field.db_field or name
+            if mongo[fieldname] is None:
+                update.setdefault('$unset', {})[fieldname] = ''
+            elif appended is not None and isinstance(mongo[fieldname], list):
+                # the appended items are necessarily at the end
+                pushed = mongo[fieldname][len(mongo[fieldname]) - len(appended):]
+                update.setdefault('$push', {})[fieldname] = {'$each': pushed}
+            else:
+                update.setdefault('$set', {})[fieldname] = mongo[fieldname]
+        return update
+
+    def _write_operation(self):
+        """
+        Returns the bulk write operation which saves the document, or
+        None when there is nothing to write. Documents which have already
+        been saved (or were loaded from the database) only send the
+        fields that changed since, by way of an update. Everything else
+        is written in full.
+        """
+        # a new primary key means a new document
+        pk_field = self.pynch.primary_key_field
+        pk_changed = pk_field.name in self._changes or \
+            any(doc._is_dirty() for doc in pk_field.embedded(self.pk))
+
+        full = pk_changed or not self._persisted
+        # a document is only ever written in full once it is complete
+        if full and self._deferred:
+            self._load_deferred()
+
+        # build a mongo compatible dictionary, remember that defining a
+        # field on a document is not the same as the field value being set
+        if self._deferred:
+            mongo = dict((field.db_field or field.name,
+                          field.to_save(getattr(self, field.name, None)))
+                                            for field in self._loaded_fields())
+        else:
+            mongo = self.pynch.codec.to_save(self)
+
+        if not full:
+            update = self._update_spec(mongo)
+            # nothing to do if nothing changed
+            return UpdateOne({'_id': mongo['_id']}, update) if update else None
+        return ReplaceOne({'_id': mongo['_id']}, mongo, upsert=True)
 
-        # save to the database
-        self.pynch.collection.save(
-                    mongo, w=self._meta['write_concern'], **kwargs)
+    def save(self, **kwargs):
+        """
+        Saves the document along with every document it references,
+        directly or not, which is new or has changed. See `UnitOfWork`.
+        Keyword arguments are passed on to pymongo's `bulk_write`.
+        """
+        errors = UnitOfWork().add(self).flush(**kwargs)
+        if errors:
+            document, exception = errors[0]
+            raise exception
+        return self
 
-        return document
+    async def asave(self, **kwargs):
+        """
+        Asynchronous counterpart of `save`
+        """
+        errors = await UnitOfWork().add(self).aflush(**kwargs)
+        if errors:
+            document, exception = errors[0]
+            raise exception
+        return self
 
     def delete(self):
-        oid = self.pk if self.pk else None
-        if oid is None:
+        if not self.pk:
+            raise Exception('Cant delete documents which '
+                            'have no _id or primary key')
+        pk_field = self.pynch.primary_key_field
+        self.pynch.collection.delete_one({'_id': pk_field.to_mongo(self.pk)})
+        self._persisted = False
+        session = current_session()
+        if session is not None:
+            session.invalidate(self)
+
+    async def adelete(self):
+        """
+        Asynchronous counterpart of `delete`
+        """
+        if not self.pk:
             raise Exception('Cant delete documents which '
                             'have no _id or primary key')
-        self.pynch.collection.remove(oid)
+        pk_field = self.pynch.primary_key_field
+        await self.pynch.async_collection.delete_one(
+                                    {'_id': pk_field.to_mongo(self.pk)})
+        self._persisted = False
+        session = current_session()
+        if session is not None:
+            session.invalidate(self)
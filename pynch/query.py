@@ -1,50 +1,576 @@
-class QueryManager(object):
+import copy
+import itertools
+import pymongo
+from pymongo.errors import AutoReconnect, CursorNotFound
+from pynch import aio
+from pynch.errors import QueryException
+from pynch.aggregation import join
+from pynch.lookups import Q, compile_query, resolve
+from pynch.fields import (ListField, SetField, DocumentField, ReferenceField,
+                          EmbeddedDocumentField, BooleanField, IntegerField,
+                          FloatField)
+from pynch.session import current_session, model_identity
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# the dtypes of the columns of `QuerySet.to_columns`, fields of any
+# other type make for columns of objects
+COLUMN_TYPES = ((BooleanField, 'bool'), (IntegerField, 'int64'),
+                (FloatField, 'float64'))
+
+
+def column_type(field):
+    for cls, dtype in COLUMN_TYPES:
+        if isinstance(field, cls):
+            return dtype
+    return object
+
+
+class QuerySet(object):
+    """
+    Lazy query over a model's collection. Query sets are immutable, each
+    chained call returns a new one, and nothing is sent to the database
+    until the query set is iterated, at which point it compiles to a
+    single cursor.
+
+        Garden.pynch.objects.filter(acres=0.25).order_by('-acres')[10:20]
+    """
     def __init__(self, model):
         self.model = model
+        self._filters = ()
+        self._order_by = ()
+        self._skip = 0
+        self._limit = 0
+        self._batch_size = 0
+        self._batched = False
+        self._lazy = False
+        self._only = None
+        self._defer = ()
+
+    def _clone(self, **changes):
+        clone = copy.copy(self)
+        clone.__dict__.update(changes)
+        return clone
 
     def __call__(self, **kwargs):
-        return self.model.pynch.find(kwargs)
+        return self.filter(**kwargs)
+
+    def filter(self, *queries, **lookups):
+        """
+        Narrows the results down to the documents matching every one of
+        the `Q` objects and lookups given, see `pynch.lookups`
+
+            Garden.pynch.objects.filter(Q(acres=1) | Q(acres__gt=10),
+                                        flowers__size=3)
+        """
+        query = compile_query(self.model, Q(*queries, **lookups))
+        return self._clone(_filters=self._filters + (query,))
+
+    def exclude(self, *queries, **lookups):
+        query = compile_query(self.model, ~Q(*queries, **lookups))
+        return self._clone(_filters=self._filters + (query,))
+
+    def order_by(self, *fieldnames):
+        """
+        Replaces the ordering of the results, field names prefixed
+        with a `-` sort in descending order
+        """
+        ordering = []
+        for fieldname in fieldnames:
+            direction = pymongo.ASCENDING
+            if fieldname.startswith('-'):
+                fieldname, direction = fieldname[1:], pymongo.DESCENDING
+            path, _, _ = resolve(self.model, fieldname)
+            ordering.append((path, direction))
+        return self._clone(_order_by=tuple(ordering))
+
+    def skip(self, n):
+        return self._clone(_skip=n)
+
+    def limit(self, n):
+        return self._clone(_limit=n)
+
+    def batch_size(self, n):
+        return self._clone(_batch_size=n)
+
+    def batched(self, batched=True):
+        """
+        See `InformationDescriptor.find`
+        """
+        return self._clone(_batched=batched)
+
+    def lazy(self, lazy=True):
+        """
+        See `InformationDescriptor.find`
+        """
+        return self._clone(_lazy=lazy)
+
+    def only(self, *fieldnames):
+        """
+        Only loads the named fields (and the primary key), the rest
+        are fetched the first time one of them is accessed
+        """
+        self._check_fieldnames(fieldnames)
+        return self._clone(_only=fieldnames)
+
+    def defer(self, *fieldnames):
+        """
+        Leaves the named fields out, they are fetched the first time
+        one of them is accessed
+        """
+        self._check_fieldnames(fieldnames)
+        return self._clone(_defer=self._defer + fieldnames)
+
+    def _check_fieldnames(self, fieldnames):
+        for fieldname in fieldnames:
+            if fieldname not in self.model.pynch.fields_by_name:
+                raise QueryException('%s has no field %s' \
+                                        % (self.model.__name__, fieldname))
+
+    def _deferred(self):
+        """
+        Names of the fields left out of the query's results
+        """
+        fields_by_name = self.model.pynch.fields_by_name
+        deferred = set(fields_by_name[name].name for name in self._defer)
+        if self._only is not None:
+            only = set(fields_by_name[name].name for name in self._only)
+            deferred.update(field.name for field in self.model.pynch.fields
+                                        if field.name not in only)
+        # the primary key is always loaded
+        deferred.discard(self.model.pynch.primary_key_field.name)
+        return frozenset(deferred)
+
+    def _projection(self):
+        deferred = self._deferred()
+        if not deferred:
+            return None
+        fields = self.model.pynch.fields
+        # mongo can't mix inclusions and exclusions
+        if self._only is not None:
+            return dict((field.db_field or field.name, 1)
+                            for field in fields if field.name not in deferred)
+        return dict((field.db_field or field.name, 0)
+                            for field in fields if field.name in deferred)
+
+    def _query(self):
+        if not self._filters:
+            return {}
+        if len(self._filters) == 1:
+            return self._filters[0]
+        return {'$and': list(self._filters)}
+
+    def _cursor(self, async_=False):
+        collection = self.model.pynch.async_collection if \
+                        async_ else self.model.pynch.collection
+        cursor = collection.find(self._query(), self._projection())
+        if self._order_by:
+            cursor = cursor.sort(list(self._order_by))
+        if self._skip:
+            cursor = cursor.skip(self._skip)
+        if self._limit:
+            cursor = cursor.limit(self._limit)
+        if self._batch_size:
+            cursor = cursor.batch_size(self._batch_size)
+        return cursor
+
+    def __iter__(self):
+        return self._hydrate(self._cursor())
+
+    def __aiter__(self):
+        return self._ahydrate(self._cursor(async_=True))
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            if key.step is not None or \
+                    (key.start or 0) < 0 or (key.stop or 0) < 0:
+                raise IndexError('Only positive, stepless slices are supported')
+            # the query set currently spans [skip, skip + limit)
+            start = self._skip + (key.start or 0)
+            stop = None if key.stop is None else self._skip + key.stop
+            if self._limit:
+                end = self._skip + self._limit
+                stop = end if stop is None else min(stop, end)
+            if stop is None:
+                return self._clone(_skip=start, _limit=0)
+            if stop <= start:
+                # limit(0) means no limit at all, so match nothing instead
+                return self._clone(_filters=self._filters +
+                                            ({'_id': {'$in': []}},))
+            return self._clone(_skip=start, _limit=stop - start)
+
+        for document in self[key:key + 1]:
+            return document
+        raise IndexError('Query set index out of range')
+
+    def as_dicts(self):
+        """
+        Iterates over the results as plain dictionaries keyed by field
+        name, without building any documents. References are left as
+        DBRefs and embedded documents become dictionaries of their own.
+        """
+        plain = self.model.pynch.codec.plain
+        deferred = self._deferred()
+        for mongo in self._cursor():
+            values = plain(mongo)
+            for name in deferred:
+                del values[name]
+            yield values
+
+    def values_list(self, *fieldnames, **kwargs):
+        """
+        Iterates over the results as tuples of the values of the given
+        fields (of every field by default), or over the values themselves
+        when `flat` is set and a single field is given. Only the fields
+        asked for are fetched. See `as_dicts`.
+        """
+        flat = kwargs.pop('flat', False)
+        if kwargs:
+            raise TypeError('Unexpected arguments %s' % ', '.join(kwargs))
+        if flat and len(fieldnames) != 1:
+            raise QueryException('flat requires a single field')
+
+        query = self.only(*fieldnames) if fieldnames else self
+        fields_by_name = self.model.pynch.fields_by_name
+        fields = [fields_by_name[name] for name in fieldnames] or \
+                    list(self.model.pynch.fields)
+        converters = [(field.db_field or field.name, field.default,
+                       field.to_plain) for field in fields]
+
+        for mongo in query._cursor():
+            values = tuple(to_plain(mongo.get(fieldname, default))
+                           for fieldname, default, to_plain in converters)
+            yield values[0] if flat else values
+
+    def to_columns(self, fields=None, batch_size=10000):
+        """
+        Loads the results as columns: a dictionary, keyed by field name,
+        of numpy masked arrays which are masked where documents have no
+        value (and the field no default, which fills in for missing
+        values as it does for documents and `as_dicts`). Integer, float and boolean fields make for int64, float64
+        and bool arrays, any other field for an array of objects (plain
+        values, see `as_dicts`). Only the fields asked for (every field
+        by default) are fetched, `batch_size` documents at a time, and
+        no documents are built. Requires numpy.
+
+            columns = Garden.pynch.objects(acres__gt=1).to_columns(
+                                                fields=['name', 'acres'])
+            columns['acres'].mean()
+        """
+        if numpy is None:
+            raise ImportError('to_columns requires numpy')
+        fieldnames = list(fields or [field.name for field in
+                                        self.model.pynch.fields])
+        self._check_fieldnames(fieldnames)
+        fields_by_name = self.model.pynch.fields_by_name
+        columns = [(name, fields_by_name[name].db_field or name,
+                    fields_by_name[name].default,
+                    column_type(fields_by_name[name]),
+                    fields_by_name[name].to_plain) for name in fieldnames]
+
+        batches = dict((name, ([], [])) for name in fieldnames)
+        cursor = self.only(*fieldnames).batch_size(batch_size)._cursor()
+        while True:
+            batch = list(itertools.islice(cursor, batch_size))
+            if not batch:
+                break
+            for name, fieldname, default, dtype, to_plain in columns:
+                values = [mongo.get(fieldname, default) for mongo in batch]
+                mask = numpy.fromiter((value is None for value in values),
+                                      bool, len(values))
+                if dtype is object:
+                    data = numpy.empty(len(values), object)
+                    for i, value in enumerate(values):
+                        data[i] = to_plain(value)
+                else:
+                    # missing values are masked, whatever they're filled with
+                    data = numpy.fromiter((0 if value is None else value
+                                           for value in values),
+                                          dtype, len(values))
+                batches[name][0].append(data)
+                batches[name][1].append(mask)
+
+        results = {}
+        for name, _, _, dtype, _ in columns:
+            data, mask = batches[name]
+            if not data:
+                data, mask = [numpy.empty(0, dtype)], [numpy.empty(0, bool)]
+            results[name] = numpy.ma.MaskedArray(numpy.concatenate(data),
+                                                 mask=numpy.concatenate(mask))
+        return results
+
+    def stream(self, batch_size=1000, chunk=None, no_cursor_timeout=False,
+               retries=3):
+        """
+        Iterates over the results as lists of (at most) `chunk` documents,
+        `batch_size` of which are fetched per round trip. Only one chunk
+        is held in memory at a time, so that arbitrarily large result sets
+        can be exported.
+
+        Results come in `_id` order, which lets the stream pick up after
+        the last document it returned when the cursor is killed or the
+        connection dropped, up to `retries` times in a row.
+        """
+        if self._order_by or self._skip:
+            raise QueryException(
+                'Streams are ordered by _id and cannot be sorted or skipped')
+        results = self._resumable(batch_size, no_cursor_timeout, retries)
+        if self._limit:
+            results = itertools.islice(results, self._limit)
+
+        chunk = chunk or batch_size
+        while True:
+            page = list(itertools.islice(results, chunk))
+            if not page:
+                return
+            yield list(self._hydrate(page))
+
+    def _resumable(self, batch_size, no_cursor_timeout, retries):
+        query, projection = self._query(), self._projection()
+        collection = self.model.pynch.collection
+        last, failures = None, 0
+        while True:
+            spec = query
+            if last is not None:
+                after = {'_id': {'$gt': last}}
+                spec = {'$and': [query, after]} if query else after
+            cursor = collection.find(spec, projection,
+                                     sort=[('_id', pymongo.ASCENDING)],
+                                     batch_size=batch_size,
+                                     no_cursor_timeout=no_cursor_timeout)
+            try:
+                for mongo in cursor:
+                    last, failures = mongo['_id'], 0
+                    yield mongo
+                return
+            except (CursorNotFound, AutoReconnect):
+                failures += 1
+                if failures > retries:
+                    raise
+            finally:
+                # cursors without a timeout live on until closed
+                cursor.close()
+
+    def _hydrate(self, results):
+        return self.model.pynch._hydrate(results, self._batched,
+                                         self._lazy, self._deferred())
+
+    def _ahydrate(self, results):
+        if isinstance(results, list):
+            results = aio.iterate(results)
+        return self.model.pynch._ahydrate(results, self._lazy,
+                                          self._deferred(),
+                                          self._batch_size or 100)
+
+    def get(self, **kwargs):
+        """
+        Returns the one document matching the query, raising a
+        QueryException if there are none or more than one. Fetches at
+        most two documents, in a single round trip.
+        """
+        query = self.filter(**kwargs) if kwargs else self
+        document = query._cached()
+        if document is not None:
+            return document
+
+        limit = min(query._limit, 2) if query._limit else 2
+        results = list(query._clone(_limit=limit)._cursor())
+        return next(self._hydrate(self._one(results)))
+
+    async def aget(self, **kwargs):
+        """
+        Asynchronous counterpart of `get`
+        """
+        query = self.filter(**kwargs) if kwargs else self
+        document = query._cached()
+        if document is not None:
+            return document
+
+        limit = min(query._limit, 2) if query._limit else 2
+        cursor = query._clone(_limit=limit)._cursor(async_=True)
+        results = [mongo async for mongo in cursor]
+        documents = self._ahydrate(self._one(results))
+        return [document async for document in documents][0]
+
+    def _cached(self):
+        # lookups by primary key are answered by the open session, if any
+        session = current_session()
+        if session is not None and self._is_pk_lookup():
+            key = model_identity(self.model, self._filters[0]['_id'])
+            return session.get(key)
+        return None
+
+    def _one(self, results):
+        if not results:
+            raise QueryException('No matching documents')
+        if len(results) > 1:
+            raise QueryException('Multiple objects found')
+        return results
+
+    def _is_pk_lookup(self):
+        if len(self._filters) != 1 or self._skip or \
+                list(self._filters[0]) != ['_id']:
+            return False
+        # as opposed to a query operator, ie {'$in': [...]}
+        pk = self._filters[0]['_id']
+        return not (isinstance(pk, dict) and
+                    any(k.startswith('$') for k in pk))
+
+    def first(self):
+        """
+        Returns the first document matching the query, or None
+        """
+        mongo = self.model.pynch.collection.find_one(
+                    self._query(), self._projection(), **self._find_one())
+        if mongo is None:
+            return None
+        return next(self._hydrate([mongo]))
+
+    async def afirst(self):
+        """
+        Asynchronous counterpart of `first`
+        """
+        mongo = await self.model.pynch.async_collection.find_one(
+                    self._query(), self._projection(), **self._find_one())
+        if mongo is None:
+            return None
+        return [document async for document in self._ahydrate([mongo])][0]
+
+    def _find_one(self):
+        kwargs = {}
+        if self._order_by:
+            kwargs['sort'] = list(self._order_by)
+        if self._skip:
+            kwargs['skip'] = self._skip
+        return kwargs
+
+    def get_or_none(self, **kwargs):
+        """
+        Returns the first document matching the query or None. Unlike
+        `get` this doesn't check that the match is unique.
+        """
+        query = self.filter(**kwargs) if kwargs else self
+        return query.first()
+
+    def count(self):
+        return self.model.pynch.collection.count_documents(
+                                            self._query(), **self._count())
+
+    async def acount(self):
+        return await self.model.pynch.async_collection.count_documents(
+                                            self._query(), **self._count())
+
+    def _count(self):
+        kwargs = {}
+        if self._skip:
+            kwargs['skip'] = self._skip
+        if self._limit:
+            kwargs['limit'] = self._limit
+        return kwargs
+
+
+# kept for backwards compatibility
+QueryManager = QuerySet
+
+def plan_search(root, search_term, query_filter=None):
+    """
+    Plans the traversal of a dot separated path of field names, from a
+    saved document (or from every document of a model). Returns the
+    aggregation pipeline, run against the root model's collection, which
+    yields `{'value': ...}` for everything found at the end of the path,
+    along with the function converting those values to python.
+
+    Paths through embedded documents become dotted field paths, paths
+    through references become `$lookup` stages, and containers are
+    unwound so that their elements are traversed one by one.
+    `query_filter` is a condition on the values found, or for documents
+    a query keyed by their field names.
+    """
+    model = root if isinstance(root, type) else type(root)
+    pipeline = []
+    if not isinstance(root, type):
+        if not root._persisted:
+            raise QueryException('Only saved documents can be searched')
+        pk_field = model.pynch.primary_key_field
+        pipeline.append({'$match': {'_id': pk_field.to_mongo(root.pk)}})
+
+    # `current` is the model the path is in, None once the path has
+    # gone past a field of unknown structure (ie a dict field)
+    path, current, to_python = [], model, None
+    for i, term in enumerate(search_term.split('.')):
+        if current is None:
+            path.append(term)
+            to_python = None
+            continue
+        field = current.pynch.fields_by_name.get(term)
+        if field is None:
+            raise QueryException(
+                '%s has no field named %s' % (current.__name__, term))
+        path.append('_id' if field.primary_key else
+                    field.db_field or field.name)
+
+        while isinstance(field, (ListField, SetField)):
+            pipeline.append({'$unwind': '$' + '.'.join(path)})
+            field = field.field
+
+        if isinstance(field, DocumentField) and \
+                isinstance(field.reference, str):
+            field.rebind()
+        if isinstance(field, EmbeddedDocumentField):
+            current = field.reference
+            to_python = current.to_python
+        elif isinstance(field, ReferenceField):
+            alias = '_pynch_%d' % i
+            pipeline.extend(join(model, field.reference,
+                                 '.'.join(path), alias))
+            current = field.reference
+            pipeline.append({'$unwind': '$' + alias})
+            path = [alias]
+            to_python = current.pynch._loader()
+        else:
+            current = None
+            to_python = field.to_python
+
+    path = '.'.join(path)
+    if query_filter is not None:
+        if current is not None and isinstance(query_filter, dict):
+            fields = current.pynch.fields_by_name
+            query_filter = dict(('%s.%s' % (path, fields[name].db_field or name)
+                                    if name in fields else name, condition)
+                                        for name, condition in query_filter.items())
+        else:
+            query_filter = {path: query_filter}
+        pipeline.append({'$match': query_filter})
+    pipeline.append({'$project': {'_id': 0, 'value': '$' + path}})
+    return pipeline, to_python or (lambda value: value)
 
-# FIXME -- Search is a legacy artifact for querying deeply
-#          nested document hierarchies w/o indices. Might be
-#          useful in the future (therefore not throwing away
-#          the code) however the functionality is not fully
-#          implemented and a distraction at the moment.
 
 def search(obj, search_term, query_filter=None):
     """
-    TODO: implement results filtering
+    Yields whatever is found at the end of a dot separated path of field
+    names, from a saved document (or from every document of a model).
+    The traversal runs in the database, see `plan_search`.
 
     class Petal(Model):
         color = StringField()
     class Flower(Model):
         petals = ListField(ReferenceField(Petal))
     class Garden(Model):
-        flowers = ListField(ReferenceField(Flowers))
+        flowers = ListField(ReferenceField(Flower))
     ...
-    # returns a generator with the colors of all the
-    # red or blue hued petals, of all the flowers in
-    # the garden.
-    hue = Q('flowers.petals.color', Q('$or', ['red', 'blue']))
-    garden.search('flowers.petals.color', hue)
-
-    petals = Q('flowers.petals', Q('$count', Q('$gt', 5)))
-    compound_criteria = hue & petals
-    garden.search('flowers.petals.color', compound_criteria)
+    # the colors of the petals of all the flowers in the garden
+    search(garden, 'flowers.petals.color')
+    # of those which are red or blue
+    search(garden, 'flowers.petals.color', {'$in': ['red', 'blue']})
+    # and the big flowers of every garden
+    search(Garden, 'flowers', {'size': {'$gt': 5}})
     """
-    # set root
-    # split dot-notated search term, first element corresponds
-    # to the root attribute
-    terms = search_term.split('.')
-    T, new_T = terms.pop(0), '.'.join(terms)
-    if not T:
-        yield obj
-        raise StopIteration
-    # get the field value at the current level
-    obj = (getattr(obj, T),) if not \
-            isinstance(obj, (list, set)) else (getattr(o, T) for o in obj)
-    # in PY3.3 and greater, this is a perfect example
-    # of when to use the `yield from` syntax
-    for element in obj:
-        for found in search(element, new_T, element):
-            yield found
+    model = obj if isinstance(obj, type) else type(obj)
+    pipeline, to_python = plan_search(obj, search_term, query_filter)
+    for result in model.pynch.collection.aggregate(pipeline, allowDiskUse=True):
+        if 'value' in result:
+            yield to_python(result['value'])
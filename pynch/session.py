@@ -0,0 +1,248 @@
+import collections
+import contextlib
+import contextvars
+from pynch.util import freeze
+
+
+# loading state, ie the stack of identity maps documents are being
+# loaded into, the stack of open sessions and whether references are
+# being loaded lazily. It's kept in context variables rather than per
+# thread so that asyncio tasks sharing a thread each have their own, the
+# stacks are tuples so that a task never changes another task's copy.
+_stack = contextvars.ContextVar('pynch_identity_maps', default=())
+_sessions = contextvars.ContextVar('pynch_sessions', default=())
+_lazy = contextvars.ContextVar('pynch_lazy', default=False)
+
+
+def push(var, value):
+    var.set(var.get() + (value,))
+
+
+def pop(var):
+    var.set(var.get()[:-1])
+
+
+def current():
+    """
+    Returns the innermost active identity map, or None
+    """
+    stack = _stack.get()
+    return stack[-1] if stack else None
+
+
+def current_session():
+    """
+    Returns the innermost open session, or None
+    """
+    sessions = _sessions.get()
+    return sessions[-1] if sessions else None
+
+
+def loading_lazily():
+    """
+    Whether references are currently being loaded as lazy proxies
+    """
+    return _lazy.get()
+
+
+@contextlib.contextmanager
+def lazy_references():
+    """
+    Within the block every reference is loaded as a lazy proxy,
+    regardless of how its field was declared
+    """
+    token = _lazy.set(True)
+    try:
+        yield
+    finally:
+        _lazy.reset(token)
+
+
+def identity(database, collection, pk):
+    # primary keys can be dicts (ie compound keys), which aren't hashable
+    return (database, collection, freeze(pk))
+
+
+def dbref_identity(dbref):
+    return identity(dbref.database, dbref.collection, dbref.id)
+
+
+def model_identity(model, pk):
+    return identity(model._meta['database'].name, model.__name__, pk)
+
+
+class IdentityMap(object):
+    """
+    Keeps track of the raw mongo documents fetched on behalf of references,
+    and of the models hydrated from them, so that each referenced document
+    is queried for and built at most once.
+
+    While active (ie inside a `with` block) `ReferenceField.to_python`
+    consults the map instead of dereferencing each DBRef on its own.
+    """
+    def __init__(self):
+        self.documents = {}
+        self.instances = {}
+
+    def __enter__(self):
+        push(_stack, self)
+        return self
+
+    def __exit__(self, *exc_info):
+        pop(_stack)
+
+    def unresolved(self, references):
+        """
+        Groups the ids of (field, dbref) pairs not yet known to the map by
+        the model they point to. Ids are only ever handed out once.
+        """
+        # documents already held by the session needn't be fetched
+        session = current_session()
+        groups = {}
+        for field, dbref in references:
+            key = dbref_identity(dbref)
+            if session is not None and key in session:
+                continue
+            if key not in self.documents:
+                # placeholder, stays None if the document doesn't exist
+                self.documents[key] = None
+                groups.setdefault(field.reference, []).append(dbref.id)
+        return groups
+
+    def add(self, model, documents):
+        """
+        Records raw documents belonging to `model`, returning the
+        references they contain.
+        """
+        references = []
+        for mongo in documents:
+            self.documents[model_identity(model, mongo['_id'])] = mongo
+            references.extend(model.pynch.references(mongo))
+        return references
+
+    def prefetch(self, model, documents):
+        """
+        Fetches every document referenced, directly or transitively, by
+        `documents` with one `$in` query per referenced model per level.
+        """
+        references = []
+        for mongo in documents:
+            references.extend(model.pynch.references(mongo))
+
+        pending = self.unresolved(references)
+        while pending:
+            references = []
+            for reference, ids in pending.items():
+                found = reference.pynch.collection.find({'_id': {'$in': ids}})
+                references.extend(self.add(reference, found))
+            pending = self.unresolved(references)
+
+    async def aprefetch(self, model, documents):
+        """
+        Asynchronous counterpart of `prefetch`
+        """
+        references = []
+        for mongo in documents:
+            references.extend(model.pynch.references(mongo))
+
+        pending = self.unresolved(references)
+        while pending:
+            references = []
+            for reference, ids in pending.items():
+                cursor = reference.pynch.async_collection.find(
+                                                {'_id': {'$in': ids}})
+                found = [mongo async for mongo in cursor]
+                references.extend(self.add(reference, found))
+            pending = self.unresolved(references)
+
+    def hydrate(self, field, dbref):
+        """
+        Returns the model pointed to by `dbref`, building it at most once
+        """
+        key = dbref_identity(dbref)
+        if key in self.instances:
+            return self.instances[key]
+
+        # fall back on a round trip for documents that weren't prefetched
+        mongo = self.documents[key] if \
+                    key in self.documents else field.dereference(dbref)
+        instance = field.reference.to_python(mongo or {})
+        self.instances[key] = instance
+        return instance
+
+
+class Session(object):
+    """
+    Opt-in identity map spanning a unit of work, so that each document
+    is built at most once however many times it is loaded:
+
+        with Session():
+            for garden in Garden.pynch.objects:
+                # every garden shares the same gardener instance
+                garden.gardener
+
+    While open, queries and reference fields return the documents the
+    session already holds, `get` by primary key skips the database
+    altogether, saved documents replace whatever the session held under
+    their key and deleted documents are evicted. The session holds at
+    most `max_size` documents, evicting the least recently used ones.
+    """
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.documents = collections.OrderedDict()
+
+    def __enter__(self):
+        push(_sessions, self)
+        return self
+
+    def __exit__(self, *exc_info):
+        pop(_sessions)
+
+    def __contains__(self, key):
+        return key in self.documents
+
+    def __len__(self):
+        return len(self.documents)
+
+    def get(self, key):
+        document = self.documents.get(key)
+        if document is not None:
+            self.documents.move_to_end(key)
+        return document
+
+    def add(self, key, document):
+        self.documents[key] = document
+        self.documents.move_to_end(key)
+        while len(self.documents) > self.max_size:
+            self.documents.popitem(last=False)
+        return document
+
+    def _key(self, document):
+        model = type(document)
+        pk = model.pynch.primary_key_field.to_mongo(document.pk)
+        return model_identity(model, pk)
+
+    def add_document(self, document):
+        return self.add(self._key(document), document)
+
+    def invalidate(self, document):
+        """
+        Evicts a document, so that it is reloaded the next time around
+        """
+        self.documents.pop(self._key(document), None)
+
+    def clear(self):
+        self.documents.clear()
+
+    def loader(self, model, to_python):
+        """
+        Wraps `to_python`, the function building documents of `model`,
+        so that it returns the documents held by the session
+        """
+        def load(mongo):
+            key = model_identity(model, mongo['_id'])
+            document = self.get(key)
+            if document is None:
+                document = self.add(key, to_python(mongo))
+            return document
+        return load
@@ -1,3 +1,7 @@
+import importlib
+import weakref
+
+
 class MultiDict(dict):
     """
     Poor man's multidict. Works like a normal dictionary in
@@ -15,34 +19,140 @@ class MultiDict(dict):
         self.setdefault(k, []).append(v)
 
 
+def _tracked(method):
+    """
+    Wraps a container's mutating method so that it reports
+    the mutation to the document owning the container
+    """
+    def mutate(self, *args, **kwargs):
+        result = method(self, *args, **kwargs)
+        self._changed()
+        return result
+    mutate.__name__ = method.__name__
+    return mutate
+
+
+class Tracked(object):
+    """
+    Mixin for containers stored on a document, which tell the document
+    (see `Model._mark_changed`) when they are mutated in place
+    """
+    __slots__ = ()
+
+    def track(self, document, name):
+        self._owner = weakref.ref(document)
+        self._name = name
+        return self
+
+    def _changed(self, appended=None):
+        owner = self._owner and self._owner()
+        if owner is not None:
+            owner._mark_changed(self._name, appended)
+
+
+class TrackedList(Tracked, list):
+    __slots__ = ('_owner', '_name')
+
+    def append(self, x):
+        list.append(self, x)
+        # appending is the one mutation which can be replayed with $push
+        self._changed([x])
+
+    def extend(self, iterable):
+        items = list(iterable)
+        list.extend(self, items)
+        self._changed(items)
+
+    def __iadd__(self, iterable):
+        self.extend(iterable)
+        return self
+
+    insert = _tracked(list.insert)
+    remove = _tracked(list.remove)
+    pop = _tracked(list.pop)
+    clear = _tracked(list.clear)
+    sort = _tracked(list.sort)
+    reverse = _tracked(list.reverse)
+    __setitem__ = _tracked(list.__setitem__)
+    __delitem__ = _tracked(list.__delitem__)
+    __imul__ = _tracked(list.__imul__)
+
+
+class TrackedDict(Tracked, dict):
+    __slots__ = ('_owner', '_name')
+
+    __setitem__ = _tracked(dict.__setitem__)
+    __delitem__ = _tracked(dict.__delitem__)
+    pop = _tracked(dict.pop)
+    popitem = _tracked(dict.popitem)
+    clear = _tracked(dict.clear)
+    update = _tracked(dict.update)
+    setdefault = _tracked(dict.setdefault)
+
+
+class TrackedSet(Tracked, set):
+    __slots__ = ('_owner', '_name')
+
+    add = _tracked(set.add)
+    discard = _tracked(set.discard)
+    remove = _tracked(set.remove)
+    pop = _tracked(set.pop)
+    clear = _tracked(set.clear)
+    update = _tracked(set.update)
+    difference_update = _tracked(set.difference_update)
+    intersection_update = _tracked(set.intersection_update)
+    symmetric_difference_update = _tracked(set.symmetric_difference_update)
+    __ior__ = _tracked(set.__ior__)
+    __iand__ = _tracked(set.__iand__)
+    __isub__ = _tracked(set.__isub__)
+    __ixor__ = _tracked(set.__ixor__)
+
+
 UnboundReference = type('UnboundReference', (), {})
 
 
+# models keyed by their fully qualified name (ie `module.qualname`),
+# populated by the model metaclass as classes are created
+model_registry = {}
+
+
+def register_model(model):
+    """
+    Records a model so that string references to it can be resolved
+    without importing modules or inspecting the call stack. Models
+    defined inside of functions are also registered under their
+    plain name, the most recently defined one winning.
+    """
+    module = model.__module__
+    model_registry['%s.%s' % (module, model.__qualname__)] = model
+    model_registry['%s.%s' % (module, model.__name__)] = model
+
+
 def import_class(to_import, context=''):
     # if `.` not in the import path then we are referencing
     # a class relative to the module in which it belongs.
     # such things occur when running a module as a script,
     # in which case context would be `__main__`
     if '.' not in to_import:
-        module = context
-        clsname = to_import
-    else:
-        # rightmost period demarcates the end of the import
-        # path and the start of the class name
-        d = to_import.rfind('.')
-        # gets the full number of characters in the import path
-        n = len(to_import)
-        # everything before the rightmost period
-        module = to_import[0:d]
-        # everything after the rightmost period
-        clsname = to_import[d+1:n]
+        path = '%s.%s' % (context, to_import) if context else to_import
+        # a plain name which hasn't been registered yet cannot be
+        # imported, it will be bound once its class is created
+        return model_registry.get(path)
+
+    # models which have already been created are simply looked up
+    if to_import in model_registry:
+        return model_registry[to_import]
+
+    # rightmost period demarcates the end of the import
+    # path and the start of the class name
+    module, _, clsname = to_import.rpartition('.')
 
     # same as `from module import clsname`
-    m = __import__(module, [clsname])
+    m = importlib.import_module(module)
     # returns None when the class doesn't exist in the module's
     # namespace, either because the class hasn't been loaded
     # yet, or the class doesn't exist at all
-    return getattr(m, clsname, None)
+    return model_registry.get(to_import) or getattr(m, clsname, None)
 
 
 type_of = lambda cls_or_obj: \
@@ -56,6 +166,18 @@ def raise_(exc):
     raise exc
 
 
+def freeze(value):
+    """
+    Hashable version of a (possibly nested) mongo value, suitable
+    for use as a dictionary key
+    """
+    if isinstance(value, dict):
+        return tuple(sorted((k, freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
 def dir_(thing):
     """
     retrieves the actual values of attribtes referenced by `dir`
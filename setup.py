@@ -5,6 +5,7 @@ setup(
     name="Pynch",
     version="1",
     packages=find_packages(),
+    extras_require={'async': ['motor'], 'columns': ['numpy']},
     description='Pythonic orm for mongodb',
     author='Dan Cohn',
     author_email='daniel.spencer.cohn@gmail.com',
@@ -1,11 +1,34 @@
+import asyncio
+import os
 import unittest
-from pynch.db import DB
-from pynch.model import Model, PrimaryKey
-from pynch.query import search
+from unittest import mock
+from bson.dbref import DBRef
+from pymongo import IndexModel, InsertOne, UpdateOne
+from pymongo.collection import Collection
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from pynch.db import (DB, ConnectionManager, MockConnection, MockDatabase,
+                      connections)
+from pynch.model import Model, PrimaryKey, UnitOfWork
+from pynch.query import plan_search, search
+from pynch.session import (IdentityMap, Session, current_session,
+                           model_identity)
 from pynch.fields import *
 from pynch.errors import *
+from pynch.indexes import ensure_indexes, index_model, index_models, index_plan
+from pynch.lookups import Q
+from pynch.aggregation import Count, Push, Sum
 from test_project import *
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# the suite runs against the in memory store, unless told otherwise
+if not os.environ.get('PYNCH_TEST_MONGOD'):
+    connections.factory = MockConnection
+
 
 class PynchSanityCheckTestSuite(unittest.TestCase):
     """
@@ -14,7 +37,7 @@ class PynchSanityCheckTestSuite(unittest.TestCase):
     static project.
     """
     def setUp(self):
-        Garden.pynch.collection.remove()
+        Garden.pynch.collection.delete_many({})
 
     def test_run_suite_from_sample_project(self):
         # populate garden
@@ -449,6 +472,1154 @@ class PKTestSuite(unittest.TestCase):
         pass
 
 
+class FieldRegistryTestSuite(unittest.TestCase):
+    def test_fields_are_listed_once_in_declaration_order(self):
+        class A(TestModel):
+            name = StringField(primary_key=True)
+            number = IntegerField(db_field='num')
+
+        class B(A):
+            ratio = FloatField()
+
+        self.assertEquals([f.name for f in A.pynch.fields], ['name', 'number'])
+        self.assertEquals([f.name for f in B.pynch.fields],
+                          ['name', 'number', 'ratio'])
+        self.assertIs(B.pynch.fields_by_name['_id'], B.name)
+        self.assertIs(B.pynch.fields_by_db_field['num'], B.number)
+
+    def test_registry_is_invalidated_when_fields_change(self):
+        class A(TestModel):
+            name = StringField()
+
+        class B(A):
+            pass
+
+        A.extra = StringField()
+        A.extra.set('extra', A)
+        self.assertTrue('extra' in B.pynch.fields_by_name)
+
+        del A.extra
+        self.assertFalse('extra' in A.pynch.fields_by_name)
+        self.assertFalse('extra' in B.pynch.fields_by_name)
+
+
+class ReferenceResolutionTestSuite(unittest.TestCase):
+    def test_references_resolve_through_the_model_registry(self):
+        class A(TestModel):
+            children = ListField(ReferenceField('self'))
+            parent = ReferenceField('A')
+
+        class B(TestModel):
+            a = ReferenceField('test_project.Flower')
+
+        self.assertIs(A.children.field.reference, A)
+        self.assertIs(A.parent.reference, A)
+        self.assertIs(B.a.reference, Flower)
+
+    def test_forward_references_are_bound_on_first_use(self):
+        class A(TestModel):
+            b = ReferenceField('ForwardB')
+
+        self.assertEquals(A.b.reference, 'ForwardB')
+
+        class ForwardB(TestModel):
+            pass
+
+        a = A(b=ForwardB())
+        self.assertIs(A.b.reference, ForwardB)
+
+
+class BatchedLoadingTestSuite(unittest.TestCase):
+    def setUp(self):
+        Garden.pynch.collection.delete_many({})
+
+    def test_references_are_grouped_by_model(self):
+        jones = BugStomper(name='Mr. Jones')
+        me = Gardener(name='Jim', instructor=Gardener(name='Mr. Jones'))
+        rose, daisy = Flower(name='rose'), Flower(name='daisy')
+        mongo = {'gardener': Garden.gardener.to_mongo(me),
+                 'stomper': Garden.stomper.to_mongo(jones),
+                 'flowers': [Garden.flowers.field.to_mongo(rose),
+                             Garden.flowers.field.to_mongo(daisy)]}
+
+        references = list(Garden.pynch.references(mongo))
+        self.assertEquals(len(references), 4)
+
+        identity_map = IdentityMap()
+        groups = identity_map.unresolved(references)
+        self.assertEquals(groups[Flower], [rose.pk, daisy.pk])
+        self.assertEquals(groups[Gardener], [me.pk])
+        self.assertEquals(groups[BugStomper], [jones.pk])
+        # ids are only ever handed out once
+        self.assertEquals(identity_map.unresolved(references), {})
+
+    def test_batched_find(self):
+        jones = BugStomper(name='Mr. Jones')
+        me = Gardener(name='Jim', instructor=Gardener(name='Mr. Jones'))
+        for acres in (0.25, 0.5):
+            garden = Garden(gardener=me, stomper=jones, acres=acres)
+            garden.flowers = [Flower(name='rose'), Flower(name='daisy')]
+            garden.save()
+
+        gardens = list(Garden.pynch.find({}, batched=True))
+        self.assertEquals(len(gardens), 2)
+        for garden in gardens:
+            names = [flower.name for flower in garden.flowers]
+            self.assertListEqual(names, ['rose', 'daisy'])
+            self.assertEquals(garden.gardener.instructor.name, 'Mr. Jones')
+        # shared references are only built once per page
+        self.assertIs(gardens[0].gardener, gardens[1].gardener)
+
+        x = Garden.pynch.get(_id=garden.pk, batched=True)
+        self.assertEquals(x.gardener.name, 'Jim')
+
+
+class LazyReferenceTestSuite(unittest.TestCase):
+    def test_lazy_field_loads_a_proxy(self):
+        class A(TestModel):
+            name = StringField()
+
+        class B(TestModel):
+            a = ReferenceField(A, lazy=True)
+
+        a = A(name='x')
+        b = B.to_python({'_id': 1, 'a': B.a.to_mongo(a)})
+        self.assertTrue(isinstance(b.a, A))
+        self.assertEquals(type(b.a), LazyReference)
+        # the primary key is known without a round trip
+        self.assertEquals(b.a.pk, a.pk)
+        self.assertFalse(b.a._is_loaded())
+
+    def test_lazy_find(self):
+        Garden.pynch.collection.delete_many({})
+        me = Gardener(name='Jim')
+        garden = Garden(gardener=me, flowers=[Flower(name='rose')])
+        garden.save()
+
+        x = next(Garden.pynch.find({'_id': garden.pk}, lazy=True))
+        self.assertEquals(type(x.gardener), LazyReference)
+        self.assertEquals(x.gardener.pk, me.pk)
+        self.assertFalse(x.gardener._is_loaded())
+        self.assertEquals(x.gardener.name, 'Jim')
+        self.assertTrue(x.gardener._is_loaded())
+        self.assertEquals([f.name for f in x.flowers], ['rose'])
+
+        y = Garden.pynch.get(_id=garden.pk, lazy=True)
+        self.assertEquals(type(y.gardener), LazyReference)
+
+
+class DirtyTrackingTestSuite(unittest.TestCase):
+    def test_loaded_documents_track_changes(self):
+        class A(TestModel):
+            name = StringField()
+            size = IntegerField()
+            tags = ListField(StringField(), db_field='t')
+
+        a = A.to_python({'_id': 1, 'name': 'x', 'size': 1, 't': ['a']})
+        self.assertEquals(a._changes, {})
+        self.assertTrue(a._persisted)
+
+        a.size = 2
+        a.tags.append('b')
+        a.tags.extend(['c'])
+        del a.name
+        self.assertEquals(a._changes, {'size': None, 'name': None,
+                                       'tags': ['b', 'c']})
+
+        mongo = {'_id': 1, 'name': None, 'size': 2, 't': ['a', 'b', 'c']}
+        self.assertEquals(a._update_spec(mongo),
+                          {'$set': {'size': 2},
+                           '$unset': {'name': ''},
+                           '$push': {'t': {'$each': ['b', 'c']}}})
+
+        # any other mutation rewrites the whole list
+        a.tags[0] = 'z'
+        mongo['t'][0] = 'z'
+        self.assertEquals(a._update_spec(mongo)['$set']['t'], ['z', 'b', 'c'])
+
+    def test_changes_to_embedded_documents_are_detected(self):
+        class A(TestModel):
+            name = StringField()
+
+        class B(TestModel):
+            a = EmbeddedDocumentField(A)
+
+        b = B.to_python({'_id': 1, 'a': {'_id': 2, 'name': 'x'}})
+        self.assertFalse(b._is_dirty())
+        b.a.name = 'y'
+        self.assertTrue(b._is_dirty())
+        b._mark_saved()
+        self.assertFalse(b._is_dirty())
+
+    def test_save_only_sends_changes(self):
+        class A(TestModel):
+            name = StringField()
+            tags = ListField(StringField())
+
+        a = A(name='x', tags=['a'])
+        a.save()
+        a.tags.append('b')
+        a.save()
+        self.assertEquals(a._changes, {})
+        mongo = A.pynch.collection.find_one({'_id': a.pk})
+        self.assertEquals(mongo['tags'], ['a', 'b'])
+        self.assertEquals(mongo['name'], 'x')
+
+
+class UnitOfWorkTestSuite(unittest.TestCase):
+    def test_writes_are_grouped_per_collection(self):
+        jones = BugStomper(name='Mr. Jones')
+        me = Gardener(name='Jim', instructor=Gardener(name='Mr. Smith'))
+        garden = Garden(gardener=me, stomper=jones, acres=0.25)
+        garden.flowers = [Flower(name='rose'), Flower(name='daisy')]
+
+        writes = UnitOfWork().add(garden).writes
+        self.assertEquals(len(writes[Garden]), 1)
+        self.assertEquals(len(writes[Gardener]), 2)
+        self.assertEquals(len(writes[BugStomper]), 1)
+        self.assertEquals(len(writes[Flower]), 2)
+
+    def test_cycles_are_only_visited_once(self):
+        a, b = Gardener(name='a'), Gardener(name='b')
+        a.instructor, b.instructor = b, a
+        writes = UnitOfWork().add(a).writes
+        self.assertEquals(len(writes[Gardener]), 2)
+
+    def test_unchanged_documents_are_skipped(self):
+        flower = Flower.to_python({'_id': 'rose', 'name': 'rose'})
+        garden = Garden(flowers=[flower])
+        writes = UnitOfWork().add(garden).writes
+        self.assertFalse(Flower in writes)
+
+        flower.name = 'daisy'
+        writes = UnitOfWork().add(garden).writes
+        self.assertEquals(writes[Flower][0][1],
+                          UpdateOne({'_id': 'rose'}, {'$set': {'name': 'daisy'}}))
+
+
+class BulkSaveTestSuite(unittest.TestCase):
+    def test_bulk_save_reports_failures_per_document(self):
+        class A(TestModel):
+            name = StringField(required=True)
+
+        A.pynch.collection.delete_many({})
+        documents = [A(name='a'), A(), A(name='b'), A(name='c')]
+        result = A.pynch.bulk_save(documents, batch_size=2)
+
+        self.assertEquals(result.saved, 3)
+        self.assertEquals(len(result.errors), 1)
+        document, exception = result.errors[0]
+        self.assertIs(document, documents[1])
+        self.assertTrue(isinstance(exception, DocumentValidationException))
+        self.assertEquals(A.pynch.collection.count_documents({}), 3)
+
+    def test_ordered_bulk_save_stops_at_first_failure(self):
+        class A(TestModel):
+            name = StringField(required=True)
+
+        A.pynch.collection.delete_many({})
+        result = A.pynch.bulk_save([A(name='a'), A(), A(name='b')],
+                                   batch_size=1, ordered=True)
+        self.assertEquals(result.saved, 1)
+        self.assertEquals(len(result.errors), 1)
+
+    def test_ordered_bulk_save_writes_the_batch_up_to_the_failure(self):
+        class A(TestModel):
+            name = StringField(required=True)
+
+        A.pynch.collection.delete_many({})
+        documents = [A(name='a'), A(), A(name='b')]
+        result = A.pynch.bulk_save(documents, batch_size=3, ordered=True)
+        self.assertEquals(result.saved, 1)
+        self.assertEquals([document for document, _ in result.errors],
+                          [documents[1]])
+        self.assertEquals([a['name'] for a in A.pynch.collection.find()], ['a'])
+
+    def test_documents_referencing_invalid_documents_are_not_saved(self):
+        class B(TestModel):
+            name = StringField(required=True)
+
+        class A(TestModel):
+            name = StringField()
+            b = ReferenceField(B)
+
+        A.pynch.collection.delete_many({})
+        B.pynch.collection.delete_many({})
+        valid = B(name='b')
+        documents = [A(name='x', b=B()), A(name='y', b=valid)]
+        result = A.pynch.bulk_save(documents, ordered=False)
+
+        self.assertEquals(result.saved, 2)
+        self.assertEquals([document for document, _ in result.errors],
+                          [documents[0]])
+        self.assertEquals([a['name'] for a in A.pynch.collection.find()], ['y'])
+        self.assertEquals(B.pynch.collection.count_documents({}), 1)
+
+
+class QuerySetTestSuite(unittest.TestCase):
+    def test_query_sets_are_immutable(self):
+        objects = Garden.pynch.objects
+        query = objects.filter(acres=0.25)
+        self.assertFalse(query is objects)
+        self.assertEquals(objects._query(), {})
+        self.assertEquals(query._query(), {'acres': 0.25})
+        self.assertEquals(query.exclude(_id=1)._query(),
+                          {'$and': [{'acres': 0.25}, {'$nor': [{'_id': 1}]}]})
+
+    def test_order_by_uses_db_fields(self):
+        class A(TestModel):
+            name = StringField(db_field='n')
+            size = IntegerField()
+
+        query = A.pynch.objects.order_by('-name', 'size')
+        self.assertEquals(query._order_by, (('n', -1), ('size', 1)))
+
+    def test_slicing_compiles_to_skip_and_limit(self):
+        query = Garden.pynch.objects.skip(5)[10:20]
+        self.assertEquals((query._skip, query._limit), (15, 10))
+        query = query[2:]
+        self.assertEquals((query._skip, query._limit), (17, 8))
+
+    def test_iteration(self):
+        class A(TestModel):
+            size = IntegerField()
+
+        A.pynch.collection.delete_many({})
+        for size in range(10):
+            A(size=size).save()
+
+        query = A.pynch.objects.filter(size={'$gte': 2}).order_by('-size')
+        self.assertEquals([a.size for a in query.limit(3)], [9, 8, 7])
+        self.assertEquals([a.size for a in query[1:3]], [8, 7])
+        self.assertEquals(query[0].size, 9)
+        self.assertEquals(query.count(), 8)
+
+
+class DeferredFieldsTestSuite(unittest.TestCase):
+    def test_only_and_defer_compile_to_projections(self):
+        class A(TestModel):
+            name = StringField(db_field='n')
+            size = IntegerField()
+            tags = ListField(StringField())
+
+        query = A.pynch.objects.only('name')
+        self.assertEquals(query._projection(), {'_id': 1, 'n': 1})
+        self.assertEquals(query._deferred(), frozenset(['size', 'tags']))
+
+        query = A.pynch.objects.defer('name', 'tags')
+        self.assertEquals(query._projection(), {'n': 0, 'tags': 0})
+        self.assertEquals(A.pynch.objects._projection(), None)
+        self.assertRaises(QueryException, lambda: A.pynch.objects.only('x'))
+
+    def test_deferred_fields_are_fetched_on_access(self):
+        class A(TestModel):
+            name = StringField()
+            size = IntegerField()
+
+        A.pynch.collection.delete_many({})
+        A(name='x', size=1).save()
+
+        a = A.pynch.objects.only('name')[0]
+        self.assertEquals(a.__dict__.get('size'), None)
+        self.assertEquals(a._deferred, frozenset(['size']))
+        a.name = 'y'
+        a.save()
+        self.assertEquals(a.size, 1)
+        self.assertEquals(a._deferred, frozenset())
+        self.assertEquals(A.pynch.get(_id=a.pk).name, 'y')
+
+    def test_loading_deferred_fields_is_not_a_change(self):
+        class A(TestModel):
+            name = StringField()
+            code = StringField(max_length=1)
+            tags = ListField(StringField())
+
+        A.pynch.collection.delete_many({})
+        A(name='x', code='a', tags=['a', 'b']).save()
+        # what's in the database is trusted, even if it no longer validates
+        A.pynch.collection.update_one({}, {'$set': {'code': 'abc'}})
+
+        a = A.pynch.objects.only('name')[0]
+        self.assertEquals((a.code, a.tags), ('abc', ['a', 'b']))
+        self.assertFalse(a._is_dirty())
+        # changes made once loaded are tracked as usual
+        a.tags.append('c')
+        self.assertEquals(a._changes, {'tags': ['c']})
+
+
+class GetTestSuite(unittest.TestCase):
+    def test_get(self):
+        class A(TestModel):
+            name = StringField()
+
+        A.pynch.collection.delete_many({})
+        A(name='x').save()
+        A(name='x').save()
+        a = A(name='y').save()
+
+        self.assertEquals(A.pynch.get(name='y').pk, a.pk)
+        self.assertRaises(QueryException, lambda: A.pynch.get(name='x'))
+        self.assertRaises(QueryException, lambda: A.pynch.get(name='z'))
+
+    def test_first_and_get_or_none(self):
+        class A(TestModel):
+            name = StringField()
+            size = IntegerField()
+
+        A.pynch.collection.delete_many({})
+        for size in range(3):
+            A(name='x', size=size).save()
+
+        self.assertEquals(A.pynch.get_or_none(name='z'), None)
+        self.assertEquals(A.pynch.get_or_none(size=1).size, 1)
+        query = A.pynch.objects.only('name').order_by('-size')
+        a = query.first()
+        self.assertEquals(a._deferred, frozenset(['size']))
+        self.assertEquals(a.size, 2)
+
+
+class SessionTestSuite(unittest.TestCase):
+    def test_least_recently_used_documents_are_evicted(self):
+        session = Session(max_size=2)
+        session.add('a', 1)
+        session.add('b', 2)
+        session.get('a')
+        session.add('c', 3)
+        self.assertEquals(list(session.documents), ['a', 'c'])
+        self.assertEquals(session.get('b'), None)
+
+    def test_loader_builds_each_document_once(self):
+        built = []
+
+        def to_python(mongo):
+            built.append(mongo)
+            return object()
+
+        load = Session().loader(Person, to_python)
+        self.assertTrue(load({'_id': 1}) is load({'_id': 1}))
+        self.assertEquals(len(built), 1)
+
+    def test_documents_are_shared_within_a_session(self):
+        class A(TestModel):
+            name = StringField()
+
+        A.pynch.collection.delete_many({})
+        a = A(name='x').save()
+
+        with Session() as session:
+            found = next(A.pynch.find({'name': 'x'}))
+            self.assertTrue(A.pynch.get(_id=a.pk) is found)
+            found.delete()
+            key = model_identity(A, found.pk)
+            self.assertFalse(key in session)
+            found.save()
+            self.assertTrue(session.get(key) is found)
+
+
+class CodecTestSuite(unittest.TestCase):
+    def test_generated_converters_match_the_fields(self):
+        class A(TestModel):
+            name = StringField(db_field='n')
+            size = IntegerField(default=3)
+            tags = ListField(StringField())
+
+        mongo = {'_id': 1, 'n': 'x', 'tags': ['a']}
+        a = A.__new__(A)
+        A.pynch.codec.load(a, mongo)
+        self.assertEquals((a.pk, a.name, a.size, a.tags), (1, 'x', 3, ['a']))
+
+        a = A(name='x', tags=['a'])
+        self.assertEquals(a.to_mongo(), {'_id': a.pk, 'n': 'x',
+                                         'size': 3, 'tags': ['a']})
+
+    def test_converters_are_rebuilt_when_fields_change(self):
+        class A(TestModel):
+            name = StringField()
+
+        codec = A.pynch.codec
+        A.size = IntegerField()
+        A.size.set('size', A)
+        self.assertFalse(A.pynch.codec is codec)
+        self.assertEquals(A._from_mongo({'_id': 1, 'size': 2}).size, 2)
+
+
+class FromMongoTestSuite(unittest.TestCase):
+    def test_loading_skips_validation(self):
+        class A(TestModel):
+            name = StringField(max_length=1)
+            tags = ListField(StringField())
+
+        # stored before max_length was introduced, say
+        a = A.to_python({'_id': 1, 'name': 'xyz', 'tags': ['a']})
+        self.assertEquals(a.name, 'xyz')
+        self.assertEquals(a._changes, {})
+        self.assertTrue(a._persisted)
+
+        # containers are still tracked
+        a.tags.append('b')
+        self.assertEquals(a._changes, {'tags': ['b']})
+        self.assertRaises(DocumentValidationException,
+                          lambda: A(name='xyz'))
+
+
+class CompactModelTestSuite(unittest.TestCase):
+    def test_compact_documents_store_fields_in_slots(self):
+        class A(Model):
+            _meta = {'database': DB(name='test'), 'compact': True}
+            name = StringField(db_field='n')
+            tags = ListField(StringField())
+
+        a = A(name='x', tags=['a'])
+        self.assertFalse(hasattr(a, '__dict__'))
+        self.assertEquals(a.to_mongo(), {'_id': a.pk, 'n': 'x', 'tags': ['a']})
+
+        b = A.to_python(a.to_mongo())
+        self.assertEquals(a, b)
+        b.tags.append('b')
+        self.assertEquals(b._changes, {'tags': ['b']})
+        del b.name
+        self.assertEquals(getattr(b, 'name', None), None)
+
+    def test_compact_models_inherit_from_compact_models(self):
+        class A(Model):
+            _meta = {'database': DB(name='test'), 'compact': True}
+            name = StringField()
+
+        class B(A):
+            size = IntegerField()
+
+        b = B(name='x', size=1)
+        self.assertEquals((b.name, b.size), ('x', 1))
+        self.assertEquals(A(b).name, 'x')
+
+        def regular_base():
+            class C(TestModel):
+                name = StringField()
+
+            class D(C):
+                _meta = {'compact': True}
+
+        self.assertRaises(InheritanceException, regular_base)
+
+
+class StreamTestSuite(unittest.TestCase):
+    def test_stream_yields_chunks_in_id_order(self):
+        class A(TestModel):
+            _id = IntegerField()
+            name = StringField()
+
+        A.pynch.collection.delete_many({})
+        for i in range(1, 8):
+            A(_id=i, name='x' if i % 2 else 'y').save()
+
+        chunks = list(A.pynch.stream(batch_size=2, chunk=3))
+        self.assertEquals([[a.pk for a in chunk] for chunk in chunks],
+                          [[1, 2, 3], [4, 5, 6], [7]])
+        chunks = A.pynch.objects.filter(name='x').limit(2).stream(chunk=5)
+        self.assertEquals([[a.pk for a in chunk] for chunk in chunks], [[1, 3]])
+
+    def test_streams_cannot_be_sorted(self):
+        query = Person.pynch.objects.order_by('name')
+        self.assertRaises(QueryException, lambda: next(query.stream()))
+
+
+class PlainValuesTestSuite(unittest.TestCase):
+    def test_plain_values_never_build_documents(self):
+        class Petal(Model):
+            color = StringField(db_field='c')
+
+        class A(TestModel):
+            name = StringField(db_field='n')
+            petals = ListField(EmbeddedDocumentField(Petal))
+            gardener = ReferenceField(Gardener)
+
+        dbref = DBRef('Gardener', 1)
+        mongo = {'_id': 1, 'n': 'x', 'petals': [{'_id': 2, 'c': 'red'}],
+                 'gardener': dbref}
+        self.assertEquals(A.pynch.codec.plain(mongo),
+                          {'_id': 1, 'name': 'x', 'gardener': dbref,
+                           'petals': [{'_id': 2, 'color': 'red'}]})
+
+    def test_as_dicts_and_values_list(self):
+        class A(TestModel):
+            name = StringField(db_field='n')
+            size = IntegerField()
+
+        A.pynch.collection.delete_many({})
+        a = A(name='x', size=1).save()
+
+        self.assertEquals(list(A.pynch.objects.as_dicts()),
+                          [{'_id': a.pk, 'name': 'x', 'size': 1}])
+        self.assertEquals(list(A.pynch.objects.only('name').as_dicts()),
+                          [{'_id': a.pk, 'name': 'x'}])
+        self.assertEquals(list(A.pynch.objects.values_list('size', 'name')),
+                          [(1, 'x')])
+        self.assertEquals(list(A.pynch.objects.values_list('name', flat=True)),
+                          ['x'])
+
+
+class AsyncTestSuite(unittest.TestCase):
+    def test_async_queries_and_saves(self):
+        class A(TestModel):
+            name = StringField()
+            gardener = ReferenceField(Gardener)
+
+        A.pynch.collection.delete_many({})
+        gardener = Gardener(name='g')
+
+        async def run():
+            a = await A(name='x', gardener=gardener).asave()
+            self.assertEquals((await A.pynch.aget(name='x')).pk, a.pk)
+            found = [b async for b in A.pynch.objects.filter(name='x')]
+            self.assertEquals(found[0].gardener.name, 'g')
+            self.assertEquals(await A.pynch.objects.acount(), 1)
+            await a.adelete()
+            self.assertEquals(await A.pynch.objects.afirst(), None)
+
+        asyncio.run(run())
+
+    def test_concurrent_tasks_keep_their_own_sessions(self):
+        class A(TestModel):
+            name = StringField()
+
+        A.pynch.collection.delete_many({})
+        A(name='x').save()
+        A(name='y').save()
+
+        async def load(name, entered, loaded):
+            with Session() as session:
+                entered[name].set()
+                # both sessions are open while either task loads
+                for event in entered.values():
+                    await event.wait()
+                await A.pynch.aget(name=name)
+                self.assertTrue(current_session() is session)
+                loaded[name].set()
+                for event in loaded.values():
+                    await event.wait()
+                return [a.name for a in session.documents.values()]
+
+        async def run():
+            entered = {'x': asyncio.Event(), 'y': asyncio.Event()}
+            loaded = {'x': asyncio.Event(), 'y': asyncio.Event()}
+            names = await asyncio.gather(load('x', entered, loaded),
+                                         load('y', entered, loaded))
+            self.assertEquals(names, [['x'], ['y']])
+            self.assertEquals(current_session(), None)
+
+        asyncio.run(run())
+
+    def test_delete_uses_the_pymongo_api(self):
+        class A(TestModel):
+            _id = PrimaryKey()
+
+        # stands in for a collection of the installed pymongo, which
+        # doesn't have the legacy api
+        A.pynch.collection = mock.create_autospec(Collection, instance=True)
+        a = A(_id='x')
+        a._persisted = True
+        a.delete()
+        A.pynch.collection.delete_one.assert_called_once_with({'_id': 'x'})
+        self.assertFalse(a._persisted)
+
+
+class ConnectionManagerTestSuite(unittest.TestCase):
+    def test_clients_are_shared_and_configurable(self):
+        manager = ConnectionManager(maxPoolSize=7)
+        manager.configure('localhost', 27017, readPreference='secondary')
+        db = DB(name='test', manager=manager)
+
+        client = db.client()
+        self.assertTrue(DB(name='other', manager=manager).client() is client)
+        self.assertEquals(client.options.pool_options.max_pool_size, 7)
+        self.assertEquals(client.read_preference.mongos_mode, 'secondary')
+        self.assertTrue(DB(name='test').client() is not client)
+
+        manager.close_all()
+        self.assertTrue(db.client() is not client)
+
+    def test_forked_processes_get_their_own_clients(self):
+        manager = ConnectionManager()
+        client = manager.client('localhost', 27017)
+        # as seen from a child process
+        manager.pid = -1
+        self.assertTrue(manager.client('localhost', 27017) is not client)
+        self.assertEquals(manager.generation, 1)
+
+
+class LazyConnectionTestSuite(unittest.TestCase):
+    def test_collections_are_resolved_on_first_use(self):
+        manager = ConnectionManager()
+
+        class A(Model):
+            _meta = {'database': DB(name='test', manager=manager)}
+            name = StringField(unique=True)
+
+        self.assertEquals(manager.clients, {})
+        collection = A.pynch.write_collection
+        self.assertEquals(len(manager.clients), 1)
+        self.assertEquals(collection.name, 'A')
+        self.assertTrue(A.pynch.collection is A.pynch.collection)
+
+        manager.close_all()
+        self.assertTrue(A.pynch.collection is not collection)
+
+    def test_async_collections_are_resolved_again(self):
+        manager = ConnectionManager(factory=MockConnection)
+
+        class A(Model):
+            _meta = {'database': DB(name='test', manager=manager)}
+            name = StringField()
+
+        async def names():
+            return [a.name async for a in A.pynch.objects]
+
+        A(name='x').save()
+        collection = A.pynch.async_collection
+        self.assertEquals(asyncio.run(names()), ['x'])
+
+        # the in memory clients come back empty
+        manager.close_all()
+        A(name='y').save()
+        self.assertTrue(A.pynch.async_collection is not collection)
+        self.assertEquals(asyncio.run(names()), ['y'])
+
+        # collections set by hand are kept
+        A.pynch.async_collection = collection
+        manager.close_all()
+        self.assertTrue(A.pynch.async_collection is collection)
+
+    def test_index_models(self):
+        class A(TestModel):
+            _meta = {'index': ['size']}
+            name = StringField(db_field='n', unique=True)
+            size = IntegerField()
+            acres = FloatField()
+
+        indexes = [index.document for index in index_models(A)]
+        self.assertEquals([(index['key'], index.get('unique', False))
+                           for index in indexes],
+                          [({'n': 1}, True), ({'size': 1}, False)])
+
+    def test_unique_index_declared_twice(self):
+        class A(TestModel):
+            _meta = {'index': ['name', {'fields': 'name', 'sparse': True}]}
+            name = StringField(unique=True)
+
+        indexes = [index.document for index in index_models(A)]
+        self.assertEquals(indexes,
+                          [{'key': {'name': 1}, 'name': 'name_1', 'unique': True}])
+
+    def test_index_specs(self):
+        class A(TestModel):
+            _meta = {'index': [['-size', 'name'],
+                               {'fields': 'size', 'expire_after': 60},
+                               {'fields': ['name'], 'sparse': True,
+                                'partial': {'size': {'$gt': 1}}}]}
+            name = StringField(db_field='n', unique_with='size')
+            size = IntegerField()
+
+        indexes = [index.document for index in index_models(A)]
+        self.assertEquals(indexes, [
+            {'key': {'n': 1, 'size': 1}, 'name': 'n_1_size_1', 'unique': True},
+            {'key': {'size': -1, 'n': 1}, 'name': 'size_-1_n_1'},
+            {'key': {'size': 1}, 'name': 'size_1', 'expireAfterSeconds': 60},
+            {'key': {'n': 1}, 'name': 'n_1', 'sparse': True,
+             'partialFilterExpression': {'size': {'$gt': 1}}}])
+        self.assertRaises(ValidationException,
+                          lambda: index_model(A, {'keys': ['name']}))
+
+    def test_existing_indexes_are_left_alone(self):
+        wanted = [IndexModel([('n', 1)], unique=True),
+                  IndexModel([('size', 1)]),
+                  IndexModel([('acres', -1)])]
+        existing = {'_id_': {'key': [('_id', 1)]},
+                    'n_1': {'key': [('n', 1.0)], 'unique': True, 'v': 2},
+                    'size_1': {'key': [('size', 1)], 'sparse': True}}
+        drop, create = index_plan(wanted, existing)
+        self.assertEquals(drop, ['size_1'])
+        self.assertEquals([index.document['name'] for index in create],
+                          ['size_1', 'acres_-1'])
+
+
+class MemoryStoreTestSuite(unittest.TestCase):
+    def setUp(self):
+        self.db = MockConnection()['test']
+        self.collection = self.db.things
+        self.collection.insert_many([
+            {'_id': 1, 'name': 'rose', 'size': 3, 'tags': ['red', 'big'],
+             'petals': [{'color': 'red', 'n': 5}]},
+            {'_id': 2, 'name': 'daisy', 'size': 1, 'tags': ['white'],
+             'petals': [{'color': 'white', 'n': 20}, {'color': 'yellow'}]},
+            {'_id': 3, 'name': 'Tulip', 'size': 2.5}])
+
+    def ids(self, query, **kwargs):
+        return [doc['_id'] for doc in self.collection.find(query, **kwargs)]
+
+    def test_query_operators(self):
+        self.assertEquals(self.ids({'size': {'$gt': 1, '$lte': 3}}), [1, 3])
+        self.assertEquals(self.ids({'name': {'$in': ['rose', 'daisy']}}), [1, 2])
+        self.assertEquals(self.ids({'tags': 'red'}), [1])
+        self.assertEquals(self.ids({'tags': {'$size': 1}}), [2])
+        self.assertEquals(self.ids({'tags': {'$exists': False}}), [3])
+        self.assertEquals(self.ids({'tags': None}), [3])
+        self.assertEquals(self.ids({'petals.color': 'yellow'}), [2])
+        self.assertEquals(self.ids({'petals': {'$elemMatch': {
+                                        'color': 'red', 'n': {'$gte': 5}}}}), [1])
+        self.assertEquals(self.ids({'name': {'$regex': '^t', '$options': 'i'}}),
+                          [3])
+        self.assertEquals(self.ids({'$or': [{'size': 1}, {'name': 'Tulip'}],
+                                    'size': {'$ne': 1}}), [3])
+        # comparisons only hold between values of the same type
+        self.assertEquals(self.ids({'name': {'$gt': 1}}), [])
+        self.assertRaises(NotImplementedError,
+                          lambda: self.ids({'size': {'$mod': [2, 0]}}))
+
+    def test_dbrefs_are_reached_into(self):
+        self.collection.update_one({'_id': 1}, {'$set': {
+                'gardener': DBRef('Gardener', 'g'),
+                'friends': [DBRef('Gardener', 'g'), DBRef('Gardener', 'h')]}})
+        self.assertEquals(self.ids({'gardener.$id': 'g'}), [1])
+        self.assertEquals(self.ids({'friends.$id': 'h'}), [1])
+        self.assertEquals(self.ids({'friends.$id': {'$in': ['x', 'g']}}), [1])
+        self.assertEquals(self.ids({'friends.$id': 'x'}), [])
+
+    def test_projections_sorts_and_paging(self):
+        self.assertEquals(self.ids({}, sort=[('size', -1)]), [1, 3, 2])
+        cursor = self.collection.find({}).sort('name').skip(1).limit(1)
+        self.assertEquals([doc['_id'] for doc in cursor], [2])
+        self.assertEquals(self.collection.find_one(1, {'petals.color': 1}),
+                          {'_id': 1, 'petals': [{'color': 'red'}]})
+        self.assertEquals(self.collection.find_one(3, {'_id': 0, 'size': 0}),
+                          {'name': 'Tulip'})
+        # documents handed out are copies
+        self.collection.find_one(1)['tags'].append('x')
+        self.assertEquals(self.collection.find_one(1)['tags'], ['red', 'big'])
+
+    def test_updates(self):
+        self.collection.update_one({'_id': 1}, {
+            '$set': {'name': 'Rose'}, '$inc': {'size': 1},
+            '$push': {'tags': {'$each': ['a', 'b']}}, '$unset': {'petals': 1}})
+        self.collection.update_one({'_id': 1}, {'$pull': {'tags': 'big'},
+                                                '$addToSet': {'tags': 'a'}})
+        self.assertEquals(self.collection.find_one(1), {
+            '_id': 1, 'name': 'Rose', 'size': 4, 'tags': ['red', 'a', 'b']})
+
+        result = self.collection.update_one({'name': 'lily'},
+                                            {'$set': {'size': 1}}, upsert=True)
+        self.assertEquals(self.collection.find_one(result.upserted_id),
+                          {'_id': result.upserted_id, 'name': 'lily', 'size': 1})
+        self.assertEquals(self.collection.delete_many({'size': 1}).deleted_count, 2)
+        self.assertEquals(self.collection.count_documents({}), 2)
+
+    def test_indexes(self):
+        self.collection.create_index('name', unique=True)
+        self.collection.create_index([('size', -1)], sparse=True)
+        self.assertEquals(sorted(self.collection.index_information()),
+                          ['_id_', 'name_1', 'size_-1'])
+        self.assertRaises(DuplicateKeyError,
+                          lambda: self.collection.insert_one({'name': 'rose'}))
+        self.assertRaises(DuplicateKeyError,
+                          lambda: self.collection.insert_one({'_id': 1}))
+
+        with self.assertRaises(BulkWriteError) as raised:
+            self.collection.bulk_write([InsertOne({'_id': 4, 'name': 'x'}),
+                                        UpdateOne({'_id': 4},
+                                                  {'$set': {'name': 'rose'}}),
+                                        InsertOne({'_id': 5, 'name': 'y'})],
+                                       ordered=False)
+        self.assertEquals([(error['index'], error['code'])
+                           for error in raised.exception.details['writeErrors']],
+                          [(1, 11000)])
+        self.assertEquals(self.ids({'name': {'$in': ['x', 'y']}}), [4, 5])
+
+        # the index follows the documents it covers
+        self.collection.update_one({'_id': 1}, {'$set': {'name': 'lily'}})
+        self.assertEquals(self.ids({'name': 'rose'}), [])
+        self.assertEquals(self.ids({'name': 'lily'}), [1])
+
+    def test_unnamed_databases_are_kept_in_memory(self):
+        class Stem(Model):
+            _meta = {'database': DB()}
+            length = IntegerField()
+
+        class Bouquet(Model):
+            _meta = {'database': DB(), 'index': ['name']}
+            name = StringField(unique=True)
+            stems = ListField(ReferenceField(Stem))
+
+        self.assertTrue(isinstance(Bouquet.pynch.db, MockDatabase))
+        Bouquet.pynch.collection.delete_many({})
+        ensure_indexes([Bouquet])
+        Bouquet(name='b', stems=[Stem(length=3)]).save()
+        self.assertRaises(DuplicateKeyError, Bouquet(name='b').save)
+
+        bouquet = Bouquet.pynch.get(name='b')
+        self.assertEquals([stem.length for stem in bouquet.stems], [3])
+        stem = Stem.pynch.db.dereference(DBRef('Stem', bouquet.stems[0].pk))
+        self.assertEquals(stem['length'], 3)
+        bouquet.delete()
+        self.assertEquals(Bouquet.pynch.objects.count(), 0)
+
+
+class SearchTestSuite(unittest.TestCase):
+    def setUp(self):
+        class Petal(Model):
+            color = StringField(db_field='c')
+
+        class Bloom(TestModel):
+            name = StringField()
+            petals = ListField(EmbeddedDocumentField(Petal))
+
+        class Bed(TestModel):
+            blooms = ListField(ReferenceField(Bloom))
+
+        Bloom.pynch.collection.delete_many({})
+        Bed.pynch.collection.delete_many({})
+        self.Bloom, self.Bed = Bloom, Bed
+        self.rose = Bloom(name='rose', petals=[Petal(color='red'),
+                                               Petal(color='pink')])
+        self.daisy = Bloom(name='daisy', petals=[Petal(color='white')])
+        self.bed = Bed(blooms=[self.rose, self.daisy]).save()
+        Bed(blooms=[self.daisy]).save()
+
+    def test_paths_through_references_are_joined(self):
+        pipeline, _ = plan_search(self.bed, 'blooms.petals.color')
+        self.assertEquals([list(stage)[0] for stage in pipeline],
+                          ['$match', '$unwind', '$addFields', '$lookup',
+                           '$unwind', '$unwind', '$project'])
+        self.assertEquals(pipeline[-1],
+                          {'$project': {'_id': 0, 'value': '$_pynch_0.petals.c'}})
+        self.assertEquals(list(search(self.bed, 'blooms.petals.color')),
+                          ['red', 'pink', 'white'])
+        self.assertEquals(list(search(self.bed, 'blooms.petals.color',
+                                      {'$in': ['pink', 'white']})),
+                          ['pink', 'white'])
+
+    def test_documents_are_found(self):
+        found = list(search(self.bed, 'blooms', {'name': 'daisy'}))
+        self.assertEquals([bloom.pk for bloom in found], [self.daisy.pk])
+        self.assertTrue(isinstance(found[0], self.Bloom))
+        colors = [petal.color for petal in search(self.Bed, 'blooms.petals')]
+        self.assertEquals(colors, ['red', 'pink', 'white', 'white'])
+
+    def test_bad_searches(self):
+        self.assertRaises(QueryException,
+                          lambda: plan_search(self.bed, 'blooms.stem'))
+        self.assertRaises(QueryException,
+                          lambda: plan_search(self.Bed(), 'blooms'))
+
+
+class LookupTestSuite(unittest.TestCase):
+    def setUp(self):
+        class Petal(Model):
+            color = StringField(db_field='c')
+
+        class A(TestModel):
+            name = StringField(db_field='n')
+            acres = FloatField()
+            petals = ListField(EmbeddedDocumentField(Petal), db_field='p')
+            gardener = ReferenceField(Gardener)
+            tags = ListField(StringField())
+
+        self.A, self.Petal = A, Petal
+
+    def query(self, *args, **kwargs):
+        return self.A.pynch.objects.filter(*args, **kwargs)._query()
+
+    def test_lookups_use_db_fields_and_convert_values(self):
+        self.assertEquals(self.query(name='x', acres__gt=1),
+                          {'n': 'x', 'acres': {'$gt': 1.0}})
+        self.assertEquals(self.query(petals__color__in=['red'], petals__size=2),
+                          {'p.c': {'$in': ['red']}, 'p': {'$size': 2}})
+        self.assertEquals(self.query(name__istartswith='a.b'),
+                          {'n': {'$regex': '^a\\.b', '$options': 'i'}})
+        jim = Gardener(name='Jim')
+        self.assertEquals(self.query(gardener=jim),
+                          {'gardener.$id': jim.pk})
+        self.assertEquals(self.query(gardener__in=[jim, DBRef('Gardener', 1)]),
+                          {'gardener.$id': {'$in': [jim.pk, 1]}})
+        self.assertEquals(self.query(acres={'$gte': 1, '$exists': True}),
+                          {'acres': {'$gte': 1.0, '$exists': True}})
+        self.assertEquals(self.query(_id=1, raw__key=2), {'_id': 1, 'raw.key': 2})
+
+    def test_q_objects_combine(self):
+        q = (Q(name='x') | Q(acres__lt=1)) & ~Q(tags='a')
+        self.assertEquals(self.query(q, acres__gt=0), {
+            '$or': [{'n': 'x'}, {'acres': {'$lt': 1.0}}],
+            '$nor': [{'tags': 'a'}],
+            'acres': {'$gt': 0.0}})
+        self.assertEquals(self.query(Q(acres__gt=1), acres__lt=3),
+                          {'acres': {'$gt': 1.0, '$lt': 3.0}})
+        self.assertEquals(self.query(Q(acres=1), acres__lt=3),
+                          {'$and': [{'acres': 1.0}, {'acres': {'$lt': 3.0}}]})
+        self.assertEquals(self.A.pynch.objects.exclude(name='x')._query(),
+                          {'$nor': [{'n': 'x'}]})
+
+    def test_bad_lookups(self):
+        self.assertRaises(QueryException, lambda: self.query(petals__size__x=1))
+        self.assertRaises(QueryException, lambda: self.query(gardener__name='x'))
+        self.assertRaises(QueryException, lambda: self.query(name__contains=5))
+        self.assertRaises(QueryException, lambda: self.query(acres='abc'))
+        self.assertRaises(QueryException, lambda: self.query(acres__in=1))
+
+    def test_lists_of_references_are_looked_up_by_id(self):
+        Garden.pynch.collection.delete_many({})
+        rose, daisy = Flower(name='rose').save(), Flower(name='daisy').save()
+        Garden(acres=1.0, flowers=[rose, daisy]).save()
+        Garden(acres=2.0, flowers=[daisy]).save()
+
+        gardens = Garden.pynch.objects
+        self.assertEquals(gardens.filter(flowers=rose)._query(),
+                          {'flowers.$id': rose.pk})
+        self.assertEquals([g.acres for g in gardens.filter(flowers=rose)], [1.0])
+        self.assertEquals([g.acres for g in gardens.filter(flowers__in=[rose])],
+                          [1.0])
+        self.assertEquals(gardens.filter(flowers=daisy.pk).count(), 2)
+        self.assertEquals(gardens.filter(flowers__size=1).count(), 1)
+
+    def test_query_shapes_are_compiled_once(self):
+        shapes = self.A.pynch.query_shapes
+        self.query(name='x', acres__gt=1)
+        compiled = dict(shapes)
+        self.assertEquals(self.query(acres__gt=2, name='y'),
+                          {'n': 'y', 'acres': {'$gt': 2.0}})
+        self.assertEquals(shapes, compiled)
+
+    def test_renamed_fields_are_found(self):
+        A = self.A
+        A.pynch.collection.delete_many({})
+        A(name='x', petals=[self.Petal(color='red')]).save()
+        self.assertEquals([a.name for a in A.pynch.find({'name': 'x'})], ['x'])
+        self.assertEquals(A.pynch.objects.filter(petals__color='red').count(), 1)
+        self.assertEquals(A.pynch.objects.filter(name__ne='x').count(), 0)
+
+
+class AggregationTestSuite(unittest.TestCase):
+    def setUp(self):
+        class Grower(TestModel):
+            name = StringField(primary_key=True)
+
+        class Plot(TestModel):
+            acres = FloatField(db_field='a')
+            grower = ReferenceField(Grower)
+            flowers = ListField(StringField(), db_field='f')
+
+        Grower.pynch.collection.delete_many({})
+        Plot.pynch.collection.delete_many({})
+        self.Grower, self.Plot = Grower, Plot
+        jim, ann = Grower(name='jim'), Grower(name='ann')
+        Plot(acres=1.0, grower=jim, flowers=['rose', 'daisy']).save()
+        Plot(acres=2.5, grower=jim, flowers=['rose']).save()
+        Plot(acres=0.5, grower=ann, flowers=[]).save()
+
+    def test_pipelines_use_db_fields(self):
+        aggregation = self.Plot.pynch.aggregate() \
+                        .match(acres__gt=0) \
+                        .group('grower', acres=Sum('acres'), plots=Count()) \
+                        .match(acres__gt=1) \
+                        .sort('-acres')
+        self.assertEquals(aggregation.pipeline(), [
+            {'$match': {'a': {'$gt': 0.0}}},
+            {'$group': {'_id': '$grower', 'acres': {'$sum': '$a'},
+                        'plots': {'$sum': 1}}},
+            {'$match': {'acres': {'$gt': 1}}},
+            {'$sort': {'acres': -1}}])
+        self.assertEquals([(row['_id'].id, row['acres'], row['plots'])
+                           for row in aggregation], [('jim', 3.5, 2)])
+
+    def test_field_names_are_translated_once(self):
+        class A(TestModel):
+            x = IntegerField(db_field='y')
+            y = IntegerField(db_field='z')
+
+        aggregation = A.pynch.aggregate().group(
+                        x=Sum('x'), y=Sum('$y'), both=Push(['$x', '$y']))
+        self.assertEquals(aggregation.pipeline(), [
+            {'$group': {'_id': None, 'x': {'$sum': '$y'}, 'y': {'$sum': '$z'},
+                        'both': {'$push': ['$y', '$z']}}}])
+
+    def test_unwinding_and_projecting(self):
+        rows = self.Plot.pynch.aggregate() \
+                    .unwind('flowers') \
+                    .group('flowers', acres=Push('acres')) \
+                    .project(flower='$_id', plots={'$size': '$acres'}) \
+                    .sort('flower')
+        self.assertEquals([(row['flower'], row['plots']) for row in rows],
+                          [('daisy', 1), ('rose', 2)])
+
+    def test_lookups_and_hydration(self):
+        aggregation = self.Plot.pynch.aggregate().sort('acres')
+        plots = list(aggregation.hydrate())
+        self.assertEquals([plot.acres for plot in plots], [0.5, 1.0, 2.5])
+        self.assertTrue(isinstance(plots[0], self.Plot))
+
+        growers = aggregation.lookup('grower', into='growers') \
+                        .unwind('growers') \
+                        .stage({'$replaceRoot': {'newRoot': '$growers'}}) \
+                        .hydrate(self.Grower)
+        self.assertEquals([grower.name for grower in growers],
+                          ['ann', 'jim', 'jim'])
+        self.assertRaises(QueryException,
+                          lambda: aggregation.lookup('acres'))
+
+    def test_lookups_stay_within_a_database(self):
+        # gardens, flowers and gardeners are each kept in their own database
+        self.assertRaises(QueryException,
+                          lambda: Garden.pynch.aggregate().lookup('flowers'))
+        self.assertRaises(QueryException,
+                          lambda: plan_search(Garden, 'gardener.name'))
+
+
+@unittest.skipIf(numpy is None, 'numpy is not installed')
+class ColumnsTestSuite(unittest.TestCase):
+    def test_columns_are_typed_and_masked(self):
+        class A(TestModel):
+            name = StringField(db_field='n')
+            size = IntegerField()
+            acres = FloatField()
+            wild = BooleanField()
+
+        A.pynch.collection.delete_many({})
+        A(name='x', size=1, acres=0.5, wild=True).save()
+        A(name='y', acres=2.0).save()
+        A(size=3, wild=False).save()
+
+        columns = A.pynch.objects.order_by('size').to_columns(
+                                    fields=['name', 'size', 'acres', 'wild'],
+                                    batch_size=2)
+        self.assertEquals([(name, column.dtype.name)
+                           for name, column in sorted(columns.items())],
+                          [('acres', 'float64'), ('name', 'object'),
+                           ('size', 'int64'), ('wild', 'bool')])
+        self.assertEquals(columns['size'].tolist(), [None, 1, 3])
+        self.assertEquals(columns['name'].tolist(), ['y', 'x', None])
+        self.assertEquals(columns['acres'].mask.tolist(), [False, False, True])
+        self.assertEquals(columns['acres'].sum(), 2.5)
+
+        empty = A.pynch.objects(size=10).to_columns(fields=['size'])
+        self.assertEquals(len(empty['size']), 0)
+        self.assertRaises(QueryException,
+                          lambda: A.pynch.objects.to_columns(fields=['x']))
+
+    def test_defaults_fill_in_for_missing_values(self):
+        class A(TestModel):
+            name = StringField(default='x')
+            size = IntegerField(default=3)
+            acres = FloatField()
+
+        A.pynch.collection.delete_many({})
+        A.pynch.collection.insert_many([{'_id': 1}, {'_id': 2, 'size': 5}])
+
+        columns = A.pynch.objects.order_by('_id').to_columns()
+        self.assertEquals(columns['size'].tolist(), [3, 5])
+        self.assertEquals(columns['name'].tolist(), ['x', 'x'])
+        self.assertEquals(columns['acres'].tolist(), [None, None])
+        dicts = A.pynch.objects.order_by('_id').as_dicts()
+        self.assertEquals([(d['name'], d['size']) for d in dicts],
+                          [('x', 3), ('x', 5)])
+
+
 # class A(Base):
 #     b = ListField(ReferenceField('B'))
 